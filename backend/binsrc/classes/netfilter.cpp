@@ -1,5 +1,8 @@
 #include <vector>
 #include <thread>
+#include <atomic>
+#include <mutex>
+#include <memory>
 #include <type_traits>
 #include "../utils.cpp"
 #include "nfqueue.cpp"
@@ -10,6 +13,21 @@
 namespace Firegex {
 namespace NfQueue {
 
+/*
+Worker of a stream with n_workers workers (jump consistent hash, Lamping and Veach):
+when a worker is added or removed only the streams of that worker change owner
+*/
+inline size_t stream_worker_index(const stream_id& sid, size_t n_workers) {
+    uint64_t key = hash_stream_id(sid);
+    int64_t b = -1, j = 0;
+    while (j < (int64_t)n_workers) {
+        b = j;
+        key = key * 2862933555777941757ULL + 1;
+        j = (int64_t)((b + 1) * (double(1LL << 31) / double((key >> 33) + 1)));
+    }
+    return b;
+}
+
 template <typename Derived>
 class ThreadNfQueue {
 public:
@@ -17,18 +35,46 @@ public:
     virtual ~ThreadNfQueue() = default;
 
     std::thread thr;
-    BlockingQueue<PktRequest<Derived>*> queue;
+    WorkerQueue<PktRequest<Derived>*> queue; // A ring for each reader of the MultiThreadQueue (see WorkerQueue in utils.cpp)
+    VerdictBatch verdicts;
+    size_t worker_index = 0;
+    const std::atomic<size_t>* n_workers = nullptr; // Active workers of the pool, updated on resize
+    const std::vector<std::unique_ptr<Derived>>* workers = nullptr; // Workers of the pool, the state of the moved streams can be given to their new owner
+    std::atomic<bool> resize_pending{false};
 
     virtual void before_loop() {}
 	virtual void handle_next_packet(PktRequest<Derived>* pkt){}
-    
+    // Called when the pool is resized: the streams not owned anymore by the worker have to be released
+    virtual void on_resize(size_t index, size_t n_active) {}
+    // Called when the queue of the worker is empty, before waiting for the next packet
+    virtual void on_idle() {}
+
+    void handle(PktRequest<Derived>* pkt) {
+        if (verdicts.enabled()) {
+            pkt->verdicts = &verdicts;
+        }
+        static_cast<Derived*>(this)->handle_next_packet(pkt);
+        delete pkt;
+        verdicts.flush_if_needed();
+    }
+
     void loop() {
         static_cast<Derived*>(this)->before_loop();
         PktRequest<Derived>* pkt;
         for(;;) {
-            queue.take(pkt);
-            static_cast<Derived*>(this)->handle_next_packet(pkt);
-            delete pkt;
+            if (resize_pending.exchange(false)) {
+                // The packets already dispatched with the old number of workers are handled before releasing the streams
+                while (queue.try_take(pkt)) {
+                    handle(pkt);
+                }
+                static_cast<Derived*>(this)->on_resize(worker_index, n_workers->load());
+            }
+            if (!queue.try_take(pkt)) {
+                verdicts.flush(); // No more packets to handle, the verdicts are not delayed waiting for the batch
+                static_cast<Derived*>(this)->on_idle();
+                if (!queue.take(pkt)) continue; // Woken up by a resize
+            }
+            handle(pkt);
         }
     }
 
@@ -37,65 +83,196 @@ public:
     }
 };
 
-template <typename Worker, typename = is_base_of<ThreadNfQueue<Worker>, Worker>>
-void __real_handler(PktRequest<std::vector<Worker>>* pkt) {
-    const size_t idx = hash_stream_id(pkt->sid) % pkt->ctx->size();
+/*
+Workers of a MultiThreadQueue: the vector is reserved to MAX_WORKERS so the readers can access it while
+new workers are added, only the first n_active workers receive packets.
+Removed workers are kept (and reused when the pool grows again), they only handle the packets already queued.
+*/
+template <typename Worker>
+struct WorkerPool {
+    static constexpr size_t MAX_WORKERS = 256;
+    std::vector<std::unique_ptr<Worker>> workers;
+    std::atomic<size_t> n_active{0};
 
+    WorkerPool() {
+        workers.reserve(MAX_WORKERS);
+    }
+
+    inline Worker* worker_for(const stream_id& sid) {
+        return workers[stream_worker_index(sid, n_active.load(std::memory_order_acquire))].get();
+    }
+};
+
+// Index of the nfqueue read by the current thread, it's the producer index in the queues of the workers
+inline thread_local size_t reader_index = 0;
+
+template <typename Worker, typename = is_base_of<ThreadNfQueue<Worker>, Worker>>
+void __real_handler(PktRequest<WorkerPool<Worker>>* pkt) {
     auto* converted_pkt = reinterpret_cast<PktRequest<Worker>*>(pkt);
-    converted_pkt->ctx = &((*pkt->ctx)[idx]);
-    
-    converted_pkt->ctx->queue.put(converted_pkt);
+    converted_pkt->ctx = pkt->ctx->worker_for(pkt->sid);
+
+    converted_pkt->ctx->queue.put(reader_index, converted_pkt);
 }
 
 
+/*
+Binds a contiguous range of n_queues nfqueues, every queue has its own netlink socket and reader thread.
+The nftables rule spreads the packets between the queues hashing the flow addresses, then the readers
+send every packet to the worker of its stream (the same worker for every queue).
+*/
 template <typename Worker, typename = is_base_of<ThreadNfQueue<Worker>, Worker>>
 class MultiThreadQueue {
     static_assert(std::is_base_of_v<ThreadNfQueue<Worker>, Worker>,
         "Worker must inherit from ThreadNfQueue<Worker>");
 
 private:
-    std::vector<Worker> workers;
-    NfQueue<std::vector<Worker>, __real_handler<Worker>> * nfq;
+    typedef NfQueue<WorkerPool<Worker>, __real_handler<Worker>> WorkersNfQueue;
+    WorkerPool<Worker> pool;
+    std::vector<WorkersNfQueue*> nfqs;
+    std::vector<std::thread> readers;
+    pthread_t main_reader; // Reads the first queue, the thread calling start
+    std::vector<int> cpus; // FIREGEX_CPU_AFFINITY (or the list of the last resize), the workers and the readers are pinned round robin
+    batch_settings batch;
+    std::mutex resize_lock;
+    bool started = false;
     uint16_t queue_num_;
-	
-    
+
+    void add_worker() {
+        auto worker = std::make_unique<Worker>();
+        worker->worker_index = pool.workers.size();
+        worker->n_workers = &pool.n_active;
+        worker->workers = &pool.workers;
+        worker->queue.set_producers(n_queues);
+        // Merging the accepts in a batch verdict is safe only if a worker reads all the packets of the queue
+        worker->verdicts.configure(batch, pool.workers.empty());
+        pool.workers.push_back(std::move(worker));
+    }
+
+    void start_worker(size_t index) {
+        pool.workers[index]->run_thread_loop();
+        pin_thread(pool.workers[index]->thr.native_handle(), index);
+    }
+
 public:
-    const size_t n_threads;
+    const size_t n_queues;
     static constexpr int QUEUE_BASE_NUM = 1000;
 
-    explicit MultiThreadQueue(size_t n_threads) 
-        : n_threads(n_threads), workers(n_threads) 
+    explicit MultiThreadQueue(size_t n_threads, size_t n_queues = 1)
+        : n_queues(n_queues)
     {
         if(n_threads == 0) throw std::invalid_argument("At least 1 thread required");
-        
-        for(uint16_t qnum = QUEUE_BASE_NUM; ; qnum++) {
+        if(n_threads > WorkerPool<Worker>::MAX_WORKERS) throw std::invalid_argument("Too many threads");
+        if(n_queues == 0) throw std::invalid_argument("At least 1 queue required");
+
+        for(uint32_t qnum = QUEUE_BASE_NUM; ; ) {
+            if(qnum + n_queues - 1 > std::numeric_limits<uint16_t>::max())
+                throw std::runtime_error("No available queue numbers");
             try {
-                nfq = new NfQueue<std::vector<Worker>, __real_handler<Worker>>(qnum);
+                for(size_t i = 0; i < n_queues; i++) {
+                    nfqs.push_back(new WorkersNfQueue(qnum + i));
+                }
                 queue_num_ = qnum;
                 break;
             }
             catch(const std::invalid_argument&) {
-                if(qnum == std::numeric_limits<uint16_t>::max())
-                    throw std::runtime_error("No available queue numbers");
+                // Restart the search after the busy queue
+                qnum += nfqs.size() + 1;
+                for(auto nfq : nfqs) delete nfq;
+                nfqs.clear();
             }
         }
+        batch = batch_settings::from_env();
+        cpus = parse_cpu_list(getenv("FIREGEX_CPU_AFFINITY"));
+        for(size_t i = 0; i < n_threads; i++) {
+            add_worker();
+        }
+        if(n_threads > 1) {
+            pool.workers[0]->verdicts.disable_merge();
+        }
+        pool.n_active.store(n_threads);
     }
 
     ~MultiThreadQueue() {
-        delete nfq;
+        for(auto nfq : nfqs) delete nfq;
     }
 
     void start() {
-        for(auto& worker : workers) {
-            worker.run_thread_loop();
+        {
+            std::lock_guard<std::mutex> lk(resize_lock);
+            for(size_t i = 0; i < pool.workers.size(); i++) {
+                start_worker(i);
+            }
+            for(size_t i = 1; i < nfqs.size(); i++) {
+                readers.emplace_back([this, i]() {
+                    reader_index = i;
+                    for (;;){
+                        nfqs[i]->handle_next_packet(&pool);
+                    }
+                });
+                pin_thread(readers.back().native_handle(), i);
+            }
+            main_reader = pthread_self();
+            pin_thread(main_reader, 0);
+            started = true;
         }
 		for (;;){
-        	nfq->handle_next_packet(&workers);
+        	nfqs[0]->handle_next_packet(&pool);
 		}
     }
 
+    /*
+    Changes the number of active workers while the queue is running (called by the control thread).
+    Only the streams of the added/removed workers change owner: they are released by the old owner
+    and restart their state on the new one (the StreamFollowers pick them up as partial streams).
+    If new_cpus is not empty the threads are pinned again round robin on it (e.g. the cpus allocated for the new size)
+    */
+    void resize(size_t n_threads, const std::vector<int>& new_cpus = {}) {
+        if(n_threads == 0) throw std::invalid_argument("At least 1 thread required");
+        if(n_threads > WorkerPool<Worker>::MAX_WORKERS) throw std::invalid_argument("Too many threads");
+        std::lock_guard<std::mutex> lk(resize_lock);
+        if(!new_cpus.empty() && new_cpus != cpus) {
+            cpus = new_cpus;
+            if(started) repin_threads();
+        }
+        if(n_threads == pool.n_active.load()) return;
+        while(pool.workers.size() < n_threads) {
+            add_worker();
+            if(started) start_worker(pool.workers.size() - 1);
+        }
+        if(n_threads > 1) {
+            // Before the packets are dispatched to other workers: the ids of the queue will be interleaved
+            pool.workers[0]->verdicts.disable_merge();
+        }
+        pool.n_active.store(n_threads, std::memory_order_release);
+        for(auto& worker : pool.workers) {
+            worker->resize_pending.store(true);
+            worker->queue.wake();
+        }
+    }
+
+    // Called with resize_lock held, after the queue is started
+    void repin_threads() {
+        for(size_t i = 0; i < pool.workers.size(); i++) {
+            pin_thread(pool.workers[i]->thr.native_handle(), i);
+        }
+        for(size_t i = 0; i < readers.size(); i++) {
+            pin_thread(readers[i].native_handle(), i + 1);
+        }
+        pin_thread(main_reader, 0);
+    }
+
+    void pin_thread(pthread_t thread, size_t index) {
+        if(cpus.empty()) return;
+        int cpu = cpus[index % cpus.size()];
+        if(!set_thread_affinity(thread, cpu)) {
+            std::cerr << "[warning] [MultiThreadQueue.pin_thread] can't pin thread " << index << " to cpu " << cpu << std::endl;
+        }
+    }
+
+    size_t n_threads() const { return pool.n_active.load(); }
     uint16_t queue_num() const { return queue_num_; }
+    uint16_t last_queue_num() const { return queue_num_ + n_queues - 1; }
 };
 
 }} // namespace Firegex::NfQueue
-#endif // NETFILTER_CLASS_CPP
\ No newline at end of file
+#endif // NETFILTER_CLASS_CPP
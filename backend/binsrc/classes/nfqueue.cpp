@@ -7,7 +7,14 @@
 #include <tins/tcp_ip/stream_identifier.h>
 #include <libmnl/libmnl.h>
 #include <tins/tins.h>
-#include <map>
+#include <memory>
+#include <mutex>
+#include <vector>
+#include <string_view>
+#include <chrono>
+#include <atomic>
+#include <sys/socket.h>
+#include "stream_map.cpp"
 
 using namespace std;
 
@@ -28,7 +35,186 @@ struct tcp_ack_seq_ctx{
 	}
 };
 
-typedef map<stream_id, tcp_ack_seq_ctx*> tcp_ack_map;
+typedef StreamMap<tcp_ack_seq_ctx*> tcp_ack_map;
+
+const size_t NFQUEUE_BUFFER_SIZE = 0xffff + (MNL_SOCKET_BUFFER_SIZE/2);
+const size_t DEFAULT_MAX_FREE_BUFFERS = 256;
+
+/*
+Receive buffers recycled between the netlink reader and the workers: the reader receives every message in a
+buffer taken from the pool and the packets keep a reference to it, so the payload is never copied.
+When the last packet of a buffer is deleted the buffer goes back to the pool (up to max_free buffers are kept).
+Buffers are not zeroed: only the pages written by the kernel are actually resident.
+*/
+class BufferPool: public enable_shared_from_this<BufferPool> {
+	private:
+	mutex pool_lock;
+	vector<char*> free_buffers;
+	const size_t max_free;
+
+	void release(char* buffer){
+		{
+			lock_guard<mutex> lk(pool_lock);
+			if (free_buffers.size() < max_free){
+				free_buffers.push_back(buffer);
+				return;
+			}
+		}
+		delete[] buffer;
+	}
+
+	public:
+	BufferPool(size_t max_free = DEFAULT_MAX_FREE_BUFFERS): max_free(max_free) {}
+
+	shared_ptr<char> acquire(){
+		char* buffer = nullptr;
+		{
+			lock_guard<mutex> lk(pool_lock);
+			if (!free_buffers.empty()){
+				buffer = free_buffers.back();
+				free_buffers.pop_back();
+			}
+		}
+		if (buffer == nullptr){
+			buffer = new char[NFQUEUE_BUFFER_SIZE];
+		}
+		// The deleter keeps the pool alive until all its buffers are released
+		return shared_ptr<char>(buffer, [pool = shared_from_this()](char* buf){ pool->release(buf); });
+	}
+
+	~BufferPool(){
+		for (auto buffer: free_buffers){
+			delete[] buffer;
+		}
+	}
+};
+
+const size_t MAX_VERDICT_BATCH_BYTES = 0x20000; // Keep a batch under the default netlink socket send buffer
+const int DEFAULT_BATCH_LATENCY_US = 500;
+
+/*
+Batching settings of the queue, from the environment:
+FIREGEX_NFQUEUE_BATCH_SIZE - max packets received with a single recvmmsg and max verdicts sent with a single send (1 = no batching)
+FIREGEX_NFQUEUE_BATCH_LATENCY_US - max time a verdict can wait in the batch (verdicts are sent anyway when a worker has no more packets)
+*/
+struct batch_settings {
+	size_t size = 1;
+	chrono::microseconds latency{DEFAULT_BATCH_LATENCY_US};
+
+	static batch_settings from_env(){
+		batch_settings settings;
+		char* size_str = getenv("FIREGEX_NFQUEUE_BATCH_SIZE");
+		if (size_str != nullptr && ::atoi(size_str) > 1){
+			settings.size = ::atoi(size_str);
+		}
+		char* latency_str = getenv("FIREGEX_NFQUEUE_BATCH_LATENCY_US");
+		if (latency_str != nullptr && ::atoi(latency_str) >= 0){
+			settings.latency = chrono::microseconds(::atoi(latency_str));
+		}
+		return settings;
+	}
+};
+
+/*
+Verdicts of a worker waiting to be sent to the kernel with a single send.
+Consecutive accepts without payload are merged in a NFQNL_MSG_VERDICT_BATCH (accepts all the packets with id <= the last id):
+this is allowed only if the worker is the only one reading the queue, otherwise it could accept packets of the other workers.
+The batch verdict is always the last message sent, so the verdicts of the packets before it are already applied.
+*/
+class VerdictBatch {
+	private:
+	mnl_socket* nl = nullptr;
+	string buffer;
+	size_t pending = 0;
+	size_t max_size = 1;
+	chrono::microseconds max_latency{0};
+	chrono::steady_clock::time_point first_pending;
+	atomic<bool> merge_accepts{false}; // Disabled by the control thread when the queue gets more workers
+	bool accept_pending = false;
+	uint16_t accept_queue = 0;
+	uint32_t accept_last_id = 0;
+
+	inline void add_pending(mnl_socket* sock){
+		if (pending != 0 && sock != nl){
+			flush(); // The kernel accepts the verdicts only from the socket bound to the queue of the packet
+		}
+		nl = sock;
+		if (pending == 0){
+			first_pending = chrono::steady_clock::now();
+		}
+		pending++;
+	}
+
+	public:
+	void configure(const batch_settings& settings, bool single_reader){
+		max_size = settings.size;
+		max_latency = settings.latency;
+		merge_accepts = single_reader;
+	}
+
+	void disable_merge(){
+		merge_accepts.store(false);
+	}
+
+	inline bool enabled(){
+		return max_size > 1;
+	}
+
+	void put(mnl_socket* sock, const nlmsghdr* nlh){
+		if (!enabled()){
+			if (mnl_socket_sendto(sock, nlh, nlh->nlmsg_len) < 0) {
+				throw runtime_error( "mnl_socket_send" );
+			}
+			return;
+		}
+		if (buffer.size() + nlh->nlmsg_len > MAX_VERDICT_BATCH_BYTES){
+			flush();
+		}
+		add_pending(sock);
+		buffer.append((const char*)nlh, nlh->nlmsg_len);
+		flush_if_needed();
+	}
+
+	// queue_num and packet_id in host byte order
+	void accept(mnl_socket* sock, uint16_t queue_num, uint32_t packet_id){
+		if (!enabled() || !merge_accepts){
+			char buf[MNL_SOCKET_BUFFER_SIZE];
+			struct nlmsghdr *nlh_verdict = nfq_nlmsg_put(buf, NFQNL_MSG_VERDICT, queue_num);
+			nfq_nlmsg_verdict_put(nlh_verdict, packet_id, NF_ACCEPT);
+			return put(sock, nlh_verdict);
+		}
+		add_pending(sock);
+		accept_pending = true;
+		accept_queue = queue_num;
+		accept_last_id = packet_id;
+		flush_if_needed();
+	}
+
+	void flush(){
+		if (accept_pending){
+			char buf[MNL_SOCKET_BUFFER_SIZE];
+			struct nlmsghdr *nlh_verdict = nfq_nlmsg_put(buf, NFQNL_MSG_VERDICT_BATCH, accept_queue);
+			nfq_nlmsg_verdict_put(nlh_verdict, accept_last_id, NF_ACCEPT);
+			buffer.append((const char*)nlh_verdict, nlh_verdict->nlmsg_len);
+			accept_pending = false;
+		}
+		pending = 0;
+		if (buffer.empty()){
+			return;
+		}
+		ssize_t res = mnl_socket_sendto(nl, buffer.data(), buffer.size());
+		buffer.clear();
+		if (res < 0) {
+			throw runtime_error( "mnl_socket_send" );
+		}
+	}
+
+	inline void flush_if_needed(){
+		if (pending != 0 && (pending >= max_size || chrono::steady_clock::now() - first_pending >= max_latency)){
+			flush();
+		}
+	}
+};
 
 template<typename T>
 class PktRequest {
@@ -50,14 +236,17 @@ class PktRequest {
 	L4Proto l4_proto;
 	bool is_input;
 
-	string packet;
+	string_view packet;
 	stream_id sid;
 
 	tcp_ack_seq_ctx* ack_seq_offset = nullptr;
 
 	T* ctx = nullptr;
+	VerdictBatch* verdicts = nullptr; // If set the verdict is added to the worker batch instead of being sent immediately
 
 	private:
+	shared_ptr<char> recv_buffer; // netlink buffer where the packet has been received (packet points inside it)
+	string rebuilt_packet; // storage of the packet when it is serialized again (mangled or fixed)
 
 	static inline size_t inner_data_size(Tins::PDU* pdu){
 		if (pdu == nullptr){
@@ -115,19 +304,20 @@ class PktRequest {
 
 	public:
 
-	PktRequest(const char* payload, size_t plen, T* ctx, mnl_socket* nl, nfgenmsg *nfg, nfqnl_msg_packet_hdr *ph, bool is_input):
+	PktRequest(shared_ptr<char> recv_buffer, const char* payload, size_t plen, T* ctx, mnl_socket* nl, nfgenmsg *nfg, nfqnl_msg_packet_hdr *ph, bool is_input):
 		ctx(ctx), nl(nl), res_id(nfg->res_id),
 		packet_id(ph->packet_id), is_input(is_input),
-		packet(string(payload, plen)),
+		recv_buffer(recv_buffer),
+		packet(payload, plen),
 		action(FilterAction::NOACTION),
 		is_ipv6((payload[0] & 0xf0) == 0x60)
 	{
 		if (is_ipv6){
-			ipv6 = new Tins::IPv6((uint8_t*)packet.c_str(), plen);
+			ipv6 = new Tins::IPv6((const uint8_t*)packet.data(), plen);
 			sid = stream_id::make_identifier(*ipv6);
 			_original_size = ipv6->size();
 		}else{
-			ipv4 = new Tins::IP((uint8_t*)packet.c_str(), plen);
+			ipv4 = new Tins::IP((const uint8_t*)packet.data(), plen);
 			sid = stream_id::make_identifier(*ipv4);
 			_original_size = ipv4->size();
 		}
@@ -144,7 +334,7 @@ class PktRequest {
 		return _header_size;
 	}
 
-	char* data(){
+	const char* data(){
 		return packet.data()+_header_size;
 	}
 
@@ -158,8 +348,8 @@ class PktRequest {
 
 	void reserialize(){
 		auto data = serialize();
-		packet.resize(data.size());
-		memcpy(packet.data(), data.data(), data.size());
+		rebuilt_packet.assign((const char*)data.data(), data.size());
+		packet = rebuilt_packet;
 	}
 
 	void set_data(const char* data, const size_t& data_size){
@@ -255,7 +445,7 @@ class PktRequest {
 			delete bef_raw->release_inner_pdu();
 			auto new_data_size = packet.size()-_header_size;
 			if (new_data_size > 0){
-				bef_raw /= move(Tins::RawPDU((uint8_t*)packet.data()+_header_size, new_data_size));
+				bef_raw /= move(Tins::RawPDU((const uint8_t*)packet.data()+_header_size, new_data_size));
 			}
 		}
 	}
@@ -345,6 +535,9 @@ class PktRequest {
 
 	private:
 	void perform_action(bool do_serialize = true){
+		if (action == FilterAction::ACCEPT && !need_tcp_fixing && verdicts != nullptr){
+			return verdicts->accept(nl, ntohs(res_id), ntohl(packet_id));
+		}
 		char buf[MNL_SOCKET_BUFFER_SIZE+packet.size()];
 		struct nlmsghdr *nlh_verdict = nfq_nlmsg_put(buf, NFQNL_MSG_VERDICT, ntohs(res_id));
 		switch (action)
@@ -388,7 +581,9 @@ class PktRequest {
 			default:
 				throw invalid_argument("Invalid action");
 		}
-		if (mnl_socket_sendto(nl, nlh_verdict, nlh_verdict->nlmsg_len) < 0) {
+		if (verdicts != nullptr){
+			verdicts->put(nl, nlh_verdict);
+		}else if (mnl_socket_sendto(nl, nlh_verdict, nlh_verdict->nlmsg_len) < 0) {
 			throw runtime_error( "mnl_socket_send" );
 		}
 	}
@@ -398,9 +593,9 @@ class PktRequest {
 struct internal_nfqueue_execution_data_tmp{
     mnl_socket* nl = nullptr;
     void *data = nullptr;
+    shared_ptr<char> buffer;
 };
 
-const size_t NFQUEUE_BUFFER_SIZE = 0xffff + (MNL_SOCKET_BUFFER_SIZE/2);
 /*  NfQueue wrapper class to handle nfqueue packets
     this class is made to be possible enqueue multiple packets to multiple threads
     --> handle function is responsable to delete the PktRequest object */
@@ -409,8 +604,13 @@ class NfQueue {
     private:
 	mnl_socket* nl = nullptr;
 	unsigned int portid;
+	shared_ptr<BufferPool> buffer_pool = make_shared<BufferPool>();
+	batch_settings batch = batch_settings::from_env();
+	vector<shared_ptr<char>> batch_buffers; // buffers for recvmmsg, a slot is refilled only if its buffer has been used
+	vector<mmsghdr> batch_msgs;
+	vector<iovec> batch_iovs;
     public:
-	char* queue_msg_buffer = nullptr;
+	char* queue_msg_buffer = nullptr; // used only for the configuration messages
 	const uint16_t queue_num;
 
 	NfQueue(u_int16_t queue_num): queue_num(queue_num) {
@@ -487,19 +687,44 @@ class NfQueue {
 	}
 
 	void handle_next_packet(D* data){
-		int ret = _recv_packet();
+		if (batch.size > 1){
+			return handle_next_batch(data);
+		}
+		shared_ptr<char> buffer = buffer_pool->acquire();
+		int ret = mnl_socket_recvfrom(nl, buffer.get(), NFQUEUE_BUFFER_SIZE);
 		if (ret == -1) {
 			throw runtime_error( "mnl_socket_recvfrom" );
 		}
-		internal_nfqueue_execution_data_tmp raw_ptr = {
-			nl: nl,
-			data: data
-		};
+		_run_callbacks(buffer, ret, data);
+	}
 
-		ret = mnl_cb_run(queue_msg_buffer, ret, 0, portid, _real_queue_cb, &raw_ptr);
-		if (ret <= 0){
-			cerr << "[error] [NfQueue.handle_next_packet] mnl_cb_run error with: " << ret << endl;
-			throw runtime_error( "mnl_cb_run error!" );
+	// Receives up to batch.size messages with a single syscall (waits only for the first one)
+	void handle_next_batch(D* data){
+		if (batch_buffers.size() != batch.size){
+			batch_buffers.resize(batch.size);
+			batch_msgs.resize(batch.size);
+			batch_iovs.resize(batch.size);
+		}
+		for (size_t i = 0; i < batch.size; i++){
+			if (!batch_buffers[i]){
+				batch_buffers[i] = buffer_pool->acquire();
+			}
+			batch_iovs[i] = { batch_buffers[i].get(), NFQUEUE_BUFFER_SIZE };
+			batch_msgs[i] = {};
+			batch_msgs[i].msg_hdr.msg_iov = &batch_iovs[i];
+			batch_msgs[i].msg_hdr.msg_iovlen = 1;
+		}
+		int n_msgs = recvmmsg(mnl_socket_get_fd(nl), batch_msgs.data(), batch.size, MSG_WAITFORONE, nullptr);
+		if (n_msgs == -1) {
+			throw runtime_error( "recvmmsg" );
+		}
+		for (int i = 0; i < n_msgs; i++){
+			shared_ptr<char> buffer = move(batch_buffers[i]);
+			if (batch_msgs[i].msg_hdr.msg_flags & MSG_TRUNC){
+				cerr << "[error] [NfQueue.handle_next_batch] truncated netlink message, skipping" << endl;
+				continue;
+			}
+			_run_callbacks(buffer, batch_msgs[i].msg_len, data);
 		}
 	}
 	
@@ -510,6 +735,20 @@ class NfQueue {
     
     private:
 
+	void _run_callbacks(shared_ptr<char>& buffer, size_t size, D* data){
+		internal_nfqueue_execution_data_tmp raw_ptr = {
+			nl: nl,
+			data: data,
+			buffer: buffer
+		};
+
+		int ret = mnl_cb_run(buffer.get(), size, 0, portid, _real_queue_cb, &raw_ptr);
+		if (ret <= 0){
+			cerr << "[error] [NfQueue.handle_next_packet] mnl_cb_run error with: " << ret << endl;
+			throw runtime_error( "mnl_cb_run error!" );
+		}
+	}
+
     static int _real_queue_cb(const nlmsghdr *nlh, void *data_ptr) {
 		
         internal_nfqueue_execution_data_tmp* info = (internal_nfqueue_execution_data_tmp*) data_ptr;
@@ -540,7 +779,7 @@ class NfQueue {
 
 		bool is_input = ntohl(mnl_attr_get_u32(attr[NFQA_MARK])) & 0x1; // == 0x1337 that is odd
 		handle_func(new PktRequest<D>(
-			payload, plen, (D*)info->data, info->nl, nfg, ph, is_input
+			info->buffer, payload, plen, (D*)info->data, info->nl, nfg, ph, is_input
 		));
 		
 		return MNL_CB_OK;
@@ -566,23 +805,5 @@ class NfQueue {
 
 };
 
-
-
-uint32_t hash_stream_id(const stream_id &sid) {
-    uint32_t addr_hash = 0;
-    const uint32_t* min_addr = reinterpret_cast<const uint32_t*>(sid.min_address.data());
-    const uint32_t* max_addr = reinterpret_cast<const uint32_t*>(sid.max_address.data());
-    addr_hash ^= min_addr[0] ^ min_addr[1] ^ min_addr[2] ^ min_addr[3];
-    addr_hash ^= max_addr[0] ^ max_addr[1] ^ max_addr[2] ^ max_addr[3];
-
-    uint32_t ports = (static_cast<uint32_t>(sid.min_address_port) << 16) | sid.max_address_port;
-    
-    uint32_t hash = addr_hash ^ ports;
-    
-    hash *= 0x9e3779b9;
-    
-    return hash;
-}
-
 }}
 #endif // NFQUEUE_CLASS_CPP
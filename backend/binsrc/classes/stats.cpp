@@ -0,0 +1,375 @@
+#ifndef STATS_CLASS_CPP
+#define STATS_CLASS_CPP
+
+#include <unistd.h>
+#include <endian.h>
+#include <cerrno>
+#include <cstring>
+#include <string>
+#include <vector>
+#include <map>
+#include <memory>
+#include <atomic>
+#include <mutex>
+#include <thread>
+#include <chrono>
+#include <functional>
+#include <algorithm>
+#include <stdexcept>
+#include <iostream>
+
+using namespace std;
+
+namespace Firegex {
+namespace Stats {
+
+/*
+Stats records are sent to the backend on the same stream used for the text messages.
+Text messages are lines starting with an ascii letter (QUEUE, ACK, BLOCKED...), binary frames
+start with FRAME_MAGIC so the backend can distinguish them reading only the first byte:
+
+| magic (u8) | type (u8) | config version (u16) | n of records (u16) | records... |
+
+RULE_COUNTERS records: | rule index (u32) | blocked (u32) | mangled (u32) |
+	The rule index is the position of the rule in the configuration sent by the backend.
+WORKER_COUNTERS records (config version is 0): | packets (u64) | bytes (u64) | exceptions (u64) |
+	A record for each worker thread, in the order they have been registered.
+WORKER_GAUGES records (config version is 0): | queue depth (u64) | queue full waits (u64) | streams (u64) | stream evictions (u64) |
+	A record for each worker thread as WORKER_COUNTERS: the packets waiting in the worker queue when the
+	snapshot is taken, how many times a reader waited because the queue was full, the streams tracked
+	by the worker and how many of them have been evicted (table full or idle timeout).
+STREAM_VERSIONS records (config version is 0): | config version (u32) | streams (u64) |
+	The streams of all the workers matched with each configuration: after an update the open streams
+	continue on the configuration they started with until closed (the versions listed are still in use).
+WORKER_GC records (config version is 0): | collections (u64) | gc time in us (u64) |
+	A record for each worker thread as WORKER_COUNTERS, the garbage collections of the python interpreter
+	of the worker (only nfproxy, the frame is not sent if no worker collected in the snapshot interval).
+
+Counters are deltas from the previous snapshot (the queue depth and the streams are the current value). All the integers are big endian.
+*/
+
+const uint8_t FRAME_MAGIC = 0x00;
+const size_t FRAME_HEADER_SIZE = 6;
+const size_t MAX_FRAME_RECORDS = 0xffff;
+const int DEFAULT_SNAPSHOT_MS = 100;
+
+enum FrameType: uint8_t { RULE_COUNTERS = 0x01, WORKER_COUNTERS = 0x02, WORKER_GAUGES = 0x03, STREAM_VERSIONS = 0x04, WORKER_GC = 0x05 };
+enum class StatsProto { TEXT, BINARY };
+
+StatsProto parse_stats_proto(const char* value){
+	if (value != nullptr && strcmp(value, "binary") == 0){
+		return StatsProto::BINARY;
+	}
+	return StatsProto::TEXT;
+}
+
+// Serializes the writes of all the threads on the same file descriptor (a message is never splitted)
+class OutputChannel {
+	private:
+	int fd;
+	mutex write_lock;
+	public:
+	OutputChannel(int fd = STDOUT_FILENO): fd(fd) {}
+
+	void set_fd(int new_fd){
+		lock_guard<mutex> lk(write_lock);
+		fd = new_fd;
+	}
+
+	void send(const char* data, size_t size){
+		lock_guard<mutex> lk(write_lock);
+		while (size > 0){
+			ssize_t written = ::write(fd, data, size);
+			if (written < 0){
+				if (errno == EINTR) continue;
+				throw runtime_error(string("write error: ") + strerror(errno));
+			}
+			data += written;
+			size -= written;
+		}
+	}
+
+	void send(const string& data){
+		send(data.data(), data.size());
+	}
+
+	void line(const string& msg){
+		send(msg + "\n");
+	}
+};
+
+inline void put_be32(char* &ptr, uint32_t value){
+	value = htobe32(value);
+	memcpy(ptr, &value, 4);
+	ptr += 4;
+}
+
+inline void put_be64(char* &ptr, uint64_t value){
+	value = htobe64(value);
+	memcpy(ptr, &value, 8);
+	ptr += 8;
+}
+
+// records are already encoded, record_size is needed to split them in multiple frames
+void send_frames(OutputChannel& out, FrameType type, uint16_t ver, const string& records, size_t record_size){
+	size_t n_records = records.size()/record_size;
+	for (size_t from = 0; from < n_records; from += MAX_FRAME_RECORDS){
+		size_t to = min(n_records, from + MAX_FRAME_RECORDS);
+		string frame(FRAME_HEADER_SIZE, '\0');
+		uint16_t be_ver = htobe16(ver);
+		uint16_t be_len = htobe16(to-from);
+		frame[0] = FRAME_MAGIC;
+		frame[1] = type;
+		memcpy(frame.data()+2, &be_ver, 2);
+		memcpy(frame.data()+4, &be_len, 2);
+		frame.append(records, from*record_size, (to-from)*record_size);
+		out.send(frame);
+	}
+}
+
+struct rule_counters {
+	atomic<uint32_t> blocked{0};
+	atomic<uint32_t> mangled{0};
+};
+
+struct queue_gauges {
+	uint64_t depth = 0;
+	uint64_t full_waits = 0; // Delta from the previous read
+};
+
+struct counters_table {
+	const uint16_t ver;
+	vector<rule_counters> rules;
+	atomic<uint64_t> streams{0}; // streams matched with this version, set by the worker
+	counters_table(uint16_t ver, size_t n_rules): ver(ver), rules(n_rules) {}
+};
+
+/*
+Counters owned by a single worker thread: the worker only does relaxed atomic increments,
+the reporter thread reads and resets them with an exchange, so no lock is taken on the packet path.
+The mutex is used only when the worker switches to a new configuration (and by the reporter)
+*/
+class WorkerCounters {
+	private:
+	mutex table_lock;
+	shared_ptr<counters_table> table;
+	vector<shared_ptr<counters_table>> older; // tables of old versions kept by the worker, their streams can still be blocked
+	vector<shared_ptr<counters_table>> retired; // tables of old versions not yet collected
+	public:
+	atomic<uint64_t> packets{0};
+	atomic<uint64_t> bytes{0};
+	atomic<uint64_t> exceptions{0};
+	// Set by the worker before registering the counters, reads the gauges of its packets queue
+	function<queue_gauges()> queue_probe;
+	atomic<uint64_t> streams{0};
+	atomic<uint64_t> evictions{0};
+	atomic<uint64_t> gc_collections{0};
+	atomic<uint64_t> gc_time_us{0};
+
+	/*
+	Called by the worker when its configuration changes, returns the replaced table.
+	With keep_replaced the replaced table is collected (and its streams reported) until release_table is called.
+	*/
+	shared_ptr<counters_table> switch_config(uint16_t ver, size_t n_rules, bool keep_replaced = false){
+		lock_guard<mutex> lk(table_lock);
+		shared_ptr<counters_table> replaced = table;
+		if (replaced){
+			(keep_replaced ? older : retired).push_back(replaced);
+		}
+		table = make_shared<counters_table>(ver, n_rules);
+		return replaced;
+	}
+
+	// Called by the worker when the last stream of a version kept with switch_config is closed
+	void release_table(const shared_ptr<counters_table>& released){
+		lock_guard<mutex> lk(table_lock);
+		auto it = find(older.begin(), older.end(), released);
+		if (it != older.end()){
+			retired.push_back(*it);
+			older.erase(it);
+		}
+	}
+
+	inline void packet_seen(){
+		packets.fetch_add(1, memory_order_relaxed);
+	}
+
+	inline void bytes_scanned(size_t size){
+		bytes.fetch_add(size, memory_order_relaxed);
+	}
+
+	inline void exception(){
+		exceptions.fetch_add(1, memory_order_relaxed);
+	}
+
+	// current_count: the streams matched with the current version (the ones of the older versions are set on their tables)
+	inline void streams_open(size_t count, size_t current_count){
+		streams.store(count, memory_order_relaxed);
+		if (table){
+			table->streams.store(current_count, memory_order_relaxed);
+		}
+	}
+
+	inline void streams_evicted(size_t count){
+		if (count != 0){
+			evictions.fetch_add(count, memory_order_relaxed);
+		}
+	}
+
+	inline void gc_collected(uint64_t time_us){
+		gc_collections.fetch_add(1, memory_order_relaxed);
+		gc_time_us.fetch_add(time_us, memory_order_relaxed);
+	}
+
+	// rules_table: the table of the version of the stream if not the current one
+	inline void blocked(uint32_t rule, counters_table* rules_table = nullptr){
+		if (rules_table == nullptr){
+			rules_table = table.get();
+		}
+		if (rules_table != nullptr && rule < rules_table->rules.size()){
+			rules_table->rules[rule].blocked.fetch_add(1, memory_order_relaxed);
+		}
+	}
+
+	inline void mangled(uint32_t rule){
+		if (table && rule < table->rules.size()){
+			table->rules[rule].mangled.fetch_add(1, memory_order_relaxed);
+		}
+	}
+
+	// Called by the reporter: returns the tables to collect (the retired ones are released after this call)
+	vector<shared_ptr<counters_table>> tables_to_collect(){
+		lock_guard<mutex> lk(table_lock);
+		vector<shared_ptr<counters_table>> res;
+		res.swap(retired);
+		res.insert(res.end(), older.begin(), older.end());
+		if (table){
+			res.push_back(table);
+		}
+		return res;
+	}
+
+	// Called by the reporter: adds the streams of the worker to the count of their version
+	void count_stream_versions(map<uint16_t, uint64_t>& versions){
+		lock_guard<mutex> lk(table_lock);
+		for (auto& older_table: older){
+			versions[older_table->ver] += older_table->streams.load(memory_order_relaxed);
+		}
+		if (table){
+			versions[table->ver] += table->streams.load(memory_order_relaxed);
+		}
+	}
+};
+
+/*
+Publishes a snapshot of the counters of all the registered workers every interval.
+In TEXT mode the reporter is not started and the workers send a line for each event.
+*/
+class StatsReporter {
+	private:
+	OutputChannel& out;
+	StatsProto proto = StatsProto::TEXT;
+	chrono::milliseconds interval{DEFAULT_SNAPSHOT_MS};
+	mutex workers_lock;
+	vector<WorkerCounters*> workers;
+
+	void reporter_loop(){
+		for(;;){
+			this_thread::sleep_for(interval);
+			try{
+				snapshot();
+			}catch(const std::exception& e){
+				cerr << "[error] [StatsReporter.reporter_loop] " << e.what() << endl;
+			}
+		}
+	}
+
+	public:
+	StatsReporter(OutputChannel& out): out(out) {}
+
+	inline bool binary() const {
+		return proto == StatsProto::BINARY;
+	}
+
+	void start(StatsProto stats_proto, int interval_ms){
+		proto = stats_proto;
+		interval = chrono::milliseconds(interval_ms > 0 ? interval_ms : DEFAULT_SNAPSHOT_MS);
+		if (binary()){
+			thread(&StatsReporter::reporter_loop, this).detach();
+		}
+	}
+
+	void register_worker(WorkerCounters* counters){
+		lock_guard<mutex> lk(workers_lock);
+		workers.push_back(counters);
+	}
+
+	void snapshot(){
+		map<uint16_t, map<uint32_t, pair<uint32_t, uint32_t>>> rules; // ver -> rule -> (blocked, mangled)
+		string worker_records, gauge_records, gc_records;
+		bool gc_seen = false;
+		map<uint16_t, uint64_t> stream_versions;
+		{
+			lock_guard<mutex> lk(workers_lock);
+			worker_records.resize(workers.size()*24);
+			gauge_records.resize(workers.size()*32);
+			gc_records.resize(workers.size()*16);
+			char* ptr = worker_records.data();
+			char* gauge_ptr = gauge_records.data();
+			char* gc_ptr = gc_records.data();
+			for (auto worker: workers){
+				put_be64(ptr, worker->packets.exchange(0, memory_order_relaxed));
+				put_be64(ptr, worker->bytes.exchange(0, memory_order_relaxed));
+				put_be64(ptr, worker->exceptions.exchange(0, memory_order_relaxed));
+				queue_gauges gauges = worker->queue_probe ? worker->queue_probe() : queue_gauges{};
+				put_be64(gauge_ptr, gauges.depth);
+				put_be64(gauge_ptr, gauges.full_waits);
+				put_be64(gauge_ptr, worker->streams.load(memory_order_relaxed));
+				put_be64(gauge_ptr, worker->evictions.exchange(0, memory_order_relaxed));
+				uint64_t gc_collections = worker->gc_collections.exchange(0, memory_order_relaxed);
+				gc_seen = gc_seen || gc_collections != 0;
+				put_be64(gc_ptr, gc_collections);
+				put_be64(gc_ptr, worker->gc_time_us.exchange(0, memory_order_relaxed));
+				worker->count_stream_versions(stream_versions);
+				for (auto& table: worker->tables_to_collect()){
+					for (uint32_t i = 0; i < table->rules.size(); i++){
+						uint32_t blocked = table->rules[i].blocked.exchange(0, memory_order_relaxed);
+						uint32_t mangled = table->rules[i].mangled.exchange(0, memory_order_relaxed);
+						if (blocked != 0 || mangled != 0){
+							auto& counters = rules[table->ver][i];
+							counters.first += blocked;
+							counters.second += mangled;
+						}
+					}
+				}
+			}
+		}
+		for (auto& [ver, ver_rules]: rules){
+			string records(ver_rules.size()*12, '\0');
+			char* ptr = records.data();
+			for (auto& [rule, counters]: ver_rules){
+				put_be32(ptr, rule);
+				put_be32(ptr, counters.first);
+				put_be32(ptr, counters.second);
+			}
+			send_frames(out, FrameType::RULE_COUNTERS, ver, records, 12);
+		}
+		if (!worker_records.empty()){
+			send_frames(out, FrameType::WORKER_COUNTERS, 0, worker_records, 24);
+			send_frames(out, FrameType::WORKER_GAUGES, 0, gauge_records, 32);
+			string version_records(stream_versions.size()*12, '\0');
+			char* ptr = version_records.data();
+			for (auto& [ver, count]: stream_versions){
+				put_be32(ptr, ver);
+				put_be64(ptr, count);
+			}
+			send_frames(out, FrameType::STREAM_VERSIONS, 0, version_records, 12);
+			if (gc_seen){
+				send_frames(out, FrameType::WORKER_GC, 0, gc_records, 16);
+			}
+		}
+	}
+};
+
+}}
+#endif // STATS_CLASS_CPP
@@ -0,0 +1,170 @@
+#ifndef STREAM_MAP_CLASS_CPP
+#define STREAM_MAP_CLASS_CPP
+
+#include <tins/tcp_ip/stream_identifier.h>
+#include <cstdint>
+#include <cstring>
+#include <vector>
+#include <utility>
+
+using namespace std;
+
+namespace Firegex {
+namespace NfQueue {
+
+typedef Tins::TCPIP::StreamIdentifier stream_id;
+
+uint32_t hash_stream_id(const stream_id &sid) {
+    uint32_t addr_hash = 0;
+    const uint32_t* min_addr = reinterpret_cast<const uint32_t*>(sid.min_address.data());
+    const uint32_t* max_addr = reinterpret_cast<const uint32_t*>(sid.max_address.data());
+    addr_hash ^= min_addr[0] ^ min_addr[1] ^ min_addr[2] ^ min_addr[3];
+    addr_hash ^= max_addr[0] ^ max_addr[1] ^ max_addr[2] ^ max_addr[3];
+
+    uint32_t ports = (static_cast<uint32_t>(sid.min_address_port) << 16) | sid.max_address_port;
+
+    uint32_t hash = addr_hash ^ ports;
+
+    hash *= 0x9e3779b9;
+
+    return hash;
+}
+
+// Inlined comparison (StreamIdentifier::operator== is defined in libtins)
+inline bool stream_id_equal(const stream_id& a, const stream_id& b) {
+    return a.min_address_port == b.min_address_port && a.max_address_port == b.max_address_port &&
+        memcmp(a.min_address.data(), b.min_address.data(), a.min_address.size()) == 0 &&
+        memcmp(a.max_address.data(), b.max_address.data(), a.max_address.size()) == 0;
+}
+
+/*
+Open addressing hash table (linear probing) keyed by stream id, used for the per packet stream lookups.
+The hashes are kept in a separate array: a probe reads only 4 bytes per slot and compares the keys only when
+the hash matches. Deletions shift back the following entries, so there are no tombstones.
+The pointers returned by find/try_emplace are valid until the next insertion or deletion.
+*/
+template <typename V>
+class StreamMap {
+    private:
+    static constexpr size_t MIN_CAPACITY = 16;
+    static constexpr uint32_t EMPTY = 0;
+
+    struct entry {
+        stream_id key;
+        V value;
+    };
+
+    vector<uint32_t> hashes; // EMPTY for free slots
+    vector<entry> entries;
+    size_t count = 0;
+    size_t mask = 0;
+    int shift = 64;
+
+    static inline uint32_t slot_hash(const stream_id& sid) {
+        uint32_t hash = hash_stream_id(sid);
+        return hash == EMPTY ? 1 : hash;
+    }
+
+    // Fibonacci hashing: the high bits of the product are the well mixed ones
+    inline size_t home_slot(uint32_t hash) const {
+        return (uint64_t(hash) * 0x9E3779B97F4A7C15ULL) >> shift;
+    }
+
+    size_t find_slot(const stream_id& sid, uint32_t hash) const {
+        if (count == 0) return SIZE_MAX;
+        for (size_t i = home_slot(hash); ; i = (i + 1) & mask) {
+            if (hashes[i] == EMPTY) return SIZE_MAX;
+            if (hashes[i] == hash && stream_id_equal(entries[i].key, sid)) return i;
+        }
+    }
+
+    void rehash(size_t capacity) {
+        vector<uint32_t> old_hashes(capacity, EMPTY);
+        vector<entry> old_entries(capacity);
+        old_hashes.swap(hashes);
+        old_entries.swap(entries);
+        mask = capacity - 1;
+        shift = 64 - __builtin_ctzll(capacity);
+        for (size_t i = 0; i < old_hashes.size(); i++) {
+            if (old_hashes[i] == EMPTY) continue;
+            size_t j = home_slot(old_hashes[i]);
+            while (hashes[j] != EMPTY) j = (j + 1) & mask;
+            hashes[j] = old_hashes[i];
+            entries[j] = std::move(old_entries[i]);
+        }
+    }
+
+    void erase_slot(size_t i) {
+        // Backward shift: move back the entries of the cluster that can be moved closer to their home slot
+        for (size_t j = (i + 1) & mask; hashes[j] != EMPTY; j = (j + 1) & mask) {
+            size_t home = home_slot(hashes[j]);
+            if (((j - home) & mask) >= ((j - i) & mask)) {
+                hashes[i] = hashes[j];
+                entries[i] = std::move(entries[j]);
+                i = j;
+            }
+        }
+        hashes[i] = EMPTY;
+        entries[i] = entry{};
+        count--;
+    }
+
+    public:
+    StreamMap() {
+        rehash(MIN_CAPACITY);
+    }
+
+    inline size_t size() const { return count; }
+    inline bool empty() const { return count == 0; }
+
+    V* find(const stream_id& sid) {
+        size_t i = find_slot(sid, slot_hash(sid));
+        return i == SIZE_MAX ? nullptr : &entries[i].value;
+    }
+
+    // Returns the value of the stream (default constructed if added) and if it has been added
+    pair<V*, bool> try_emplace(const stream_id& sid) {
+        uint32_t hash = slot_hash(sid);
+        size_t i = find_slot(sid, hash);
+        if (i != SIZE_MAX) return {&entries[i].value, false};
+        if ((count + 1) * 4 > hashes.size() * 3) { // Max load factor 0.75
+            rehash(hashes.size() * 2);
+        }
+        for (i = home_slot(hash); hashes[i] != EMPTY; i = (i + 1) & mask);
+        hashes[i] = hash;
+        entries[i].key = sid;
+        entries[i].value = V{};
+        count++;
+        return {&entries[i].value, true};
+    }
+
+    void insert_or_assign(const stream_id& sid, V value) {
+        *try_emplace(sid).first = std::move(value);
+    }
+
+    bool erase(const stream_id& sid) {
+        size_t i = find_slot(sid, slot_hash(sid));
+        if (i == SIZE_MAX) return false;
+        erase_slot(i);
+        return true;
+    }
+
+    // Calls func(const stream_id&, V&) for every stream, the map must not be changed by func
+    template <typename F>
+    void for_each(F&& func) {
+        for (size_t i = 0; i < hashes.size(); i++) {
+            if (hashes[i] != EMPTY) func(entries[i].key, entries[i].value);
+        }
+    }
+
+    void clear() {
+        hashes.assign(MIN_CAPACITY, EMPTY);
+        entries.assign(MIN_CAPACITY, entry{});
+        mask = MIN_CAPACITY - 1;
+        shift = 64 - __builtin_ctzll(MIN_CAPACITY);
+        count = 0;
+    }
+};
+
+}} // namespace Firegex::NfQueue
+#endif // STREAM_MAP_CLASS_CPP
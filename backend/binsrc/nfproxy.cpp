@@ -13,6 +13,7 @@
 using namespace std;
 using namespace Firegex::PyProxy;
 using Firegex::NfQueue::MultiThreadQueue;
+using Firegex::Stats::parse_stats_proto;
 
 /*
 
@@ -36,23 +37,26 @@ The code is now edited adding an intestation and a end statement:
 <user_code>
 __firegex_pyfilter_enabled = ["invalid_curl_agent", "func3"] # This list is dynamically generated by firegex backend
 __firegex_proto = "http"
+__firegex_config_ver = 1 # Version of the configuration, used with the filter index as key of the stats frames
 import firegex.nfproxy.internals
 firegex.nfproxy.internals.compile(globals(), locals()) # This function can save other global variables, to use by the packet handler and is used generally to check and optimize the code
 ````
 (First lines are the same to keep line of code consistent on exceptions messages)
 
-This code will be executed only once, and is needed to build the global and local context to use
-The globals and locals generated here are copied for each connection, and are used to handle the packets
+This code will be executed only once by every worker, and is needed to build the global context to use
+The globals generated here are copied for each connection by firegex.nfproxy.internals.clone (see filter_template
+in pyproxy/stream_ctx.cpp), and are used to handle the packets
 
 Using C API will be injected in global context the following informations:
 
-__firegex_packet_info = {
-	"data" = b"raw data found on L4",
-	"raw_packet" = b"raw packet",
-	"is_input" = True, # If the packet is incoming from a client
-	"is_ipv6" = False, # If the packet is ipv6
-	"is_tcp" = True, # If the packet is tcp
-}
+__firegex_packet_info = <packet object> # See pyproxy/packet.cpp, read by RawPacket in firegex.nfproxy.internals.data
+	.data # bytes of the raw data found on L4
+	.raw_packet # bytes of the raw packet (serialized only when requested)
+	.is_input = True # If the packet is incoming from a client
+	.is_ipv6 = False # If the packet is ipv6
+	.is_tcp = True # If the packet is tcp
+	.l4_size, .header_size # Sizes of the L4 payload and of the headers of the raw packet
+The buffers are not copied until a filter reads them (or keeps the object after the packet has been handled)
 
 As result the packet handler is responsible to return a dictionary in the global context with the following dictionary:
 __firegex_pyfilter_result = {
@@ -79,18 +83,65 @@ The TCP stream is sorted by libtins using c++ code, but the c++ code is not resp
 So firegex handle_packet has to implement a way to limit memory usage, this dipends on what methods you choose to use to filter packets
 firegex lib will give you all the needed possibilities to do this is many ways
 
+Stats are sent on the control socket as BLOCKED/MANGLED/EXCEPTION lines (FIREGEX_STATS_PROTO=text, default)
+or as binary counters snapshots every FIREGEX_STATS_BATCH_MS (FIREGEX_STATS_PROTO=binary, see classes/stats.cpp)
+
+The binary binds NQUEUES (default NTHREADS) contiguous nfqueues, printing "QUEUE <first> <last>", every queue is read by its own thread
+Workers and queue readers are pinned round robin to the cpus in FIREGEX_CPU_AFFINITY (e.g. 0-3,6), if set
+Packets are received and verdicts are sent in batches of FIREGEX_NFQUEUE_BATCH_SIZE (default 1, no batching),
+a verdict waits in the batch at most FIREGEX_NFQUEUE_BATCH_LATENCY_US (see VerdictBatch in classes/nfqueue.cpp)
+The interpreters of the workers are garbage collected following FIREGEX_PY_GC_THRESHOLDS (e.g. 700,10,10),
+FIREGEX_PY_GC_EVERY_PACKETS, FIREGEX_PY_GC_INTERVAL_MS and FIREGEX_PY_GC_ON_IDLE (see pyproxy/gc_policy.cpp)
+
 Final note: is not raccomanded to use variables that starts with __firegex_ in your code, because they may break the nfproxy
 */
 
 
 
-void config_updater (){
+/*
+Control commands are messages starting with '!' (not valid python code):
+!THREADS <n> [<cpu list>] - changes the number of workers of the running queue, pinning the threads on the cpu list if given
+*/
+void control_command(const string& message, MultiThreadQueue<PyProxyQueue>& queue){
+	istringstream command_stream(message.substr(1));
+	string command;
+	command_stream >> command;
+	try{
+		if (command == "THREADS"){
+			int n_threads = 0;
+			if (!(command_stream >> n_threads) || n_threads <= 0){
+				throw invalid_argument("Invalid number of threads");
+			}
+			string cpu_list; // Optional, empty keeps the current pinning
+			command_stream >> cpu_list;
+			vector<int> cpus = parse_cpu_list(cpu_list.c_str());
+			if (!cpu_list.empty() && cpus.empty()){
+				throw invalid_argument("Invalid cpu list");
+			}
+			queue.resize(n_threads, cpus);
+			cerr << "[info] [updater] Workers resized to " << n_threads << endl;
+		}else{
+			throw invalid_argument("Unknown command " + command);
+		}
+		control_out.line("ACK OK");
+	}catch(const std::exception& e){
+		cerr << "[error] [updater] Control command failed: " << e.what() << endl;
+		control_out.line(string("ACK FAIL ") + e.what());
+	}
+}
+
+void config_updater (MultiThreadQueue<PyProxyQueue>& queue){
 	while (true){
 		PyThreadState* state = PyEval_SaveThread(); // Release GIL while doing IO operation
 		uint32_t code_size;
 		memcpy(&code_size, control_socket.recv(4).c_str(), 4);
 		code_size = be32toh(code_size);
 		string code = control_socket.recv(code_size);
+		if (!code.empty() && code[0] == '!'){
+			control_command(code, queue); // The new workers wait for the GIL released here
+			PyEval_AcquireThread(state);
+			continue;
+		}
 		#ifdef DEBUG
 		cerr << "[DEBUG] [updater] Received code: " << code << endl;
 		#endif
@@ -99,10 +150,10 @@ void config_updater (){
 		try{
 			config.reset(new PyCodeConfig(code));
 			cerr << "[info] [updater] Config update done" << endl;
-			control_socket << "ACK OK" << endl;
+			control_out.line("ACK OK");
 		}catch(const std::exception& e){
 			cerr << "[error] [updater] Failed to build new configuration!" << endl;
-			control_socket << "ACK FAIL " << e.what() << endl;
+			control_out.line(string("ACK FAIL ") + e.what());
 		}
 	}
 }
@@ -123,17 +174,27 @@ int main(int argc, char *argv[]) {
    	if (n_threads_str != nullptr) n_of_threads = ::atoi(n_threads_str);
 	if(n_of_threads <= 0) n_of_threads = 1;
 
+	int n_of_queues = n_of_threads;
+   	char * n_queues_str = getenv("NQUEUES");
+   	if (n_queues_str != nullptr) n_of_queues = ::atoi(n_queues_str);
+	if(n_of_queues <= 0) n_of_queues = n_of_threads;
+
+	int stats_batch_ms = 0;
+	char * stats_batch_str = getenv("FIREGEX_STATS_BATCH_MS");
+	if (stats_batch_str != nullptr) stats_batch_ms = ::atoi(stats_batch_str);
+	stats_reporter.start(parse_stats_proto(getenv("FIREGEX_STATS_PROTO")), stats_batch_ms);
+
 	config.reset(new PyCodeConfig());
 
-	MultiThreadQueue<PyProxyQueue> queue(n_of_threads);
+	MultiThreadQueue<PyProxyQueue> queue(n_of_threads, n_of_queues);
 
-	control_socket << "QUEUE " << queue.queue_num() << endl;
+	control_out.line("QUEUE " + to_string(queue.queue_num()) + " " + to_string(queue.last_queue_num()));
 
-	cerr << "[info] [main] Queue: " << queue.queue_num() << " threads assigned: " << n_of_threads << endl;
+	cerr << "[info] [main] Queues: " << queue.queue_num() << "-" << queue.last_queue_num() << " threads assigned: " << n_of_threads << endl;
 
 	thread qthr([&](){
 		queue.start();
 	});
-	config_updater();
+	config_updater(queue);
 	qthr.join();
 }
@@ -1,20 +1,75 @@
 #include "regex/regex_rules.cpp"
 #include "regex/regexfilter.cpp"
 #include "classes/netfilter.cpp"
+#include "classes/stats.cpp"
 #include <syncstream>
 #include <iostream>
 
 using namespace std;
 using namespace Firegex::Regex;
 using Firegex::NfQueue::MultiThreadQueue;
+using Firegex::Stats::parse_stats_proto;
 
 /*
 Compile options:
+USE_BLOCKING_QUEUE - use a blocking queue (conditional variable, queue and mutex) instead of the SPSC rings between readers and workers
 USE_PIPES_FOR_BLOKING_QUEUE - use pipes instead of conditional variable, queue and mutex for blocking queue
+
+Environment:
+FIREGEX_STATS_PROTO - "binary" to send counters snapshots as binary frames (see classes/stats.cpp), "text" (default) for BLOCKED lines
+FIREGEX_STATS_BATCH_MS - in binary mode, interval in ms between the counters snapshots
+NTHREADS - number of workers filtering the packets (default 1)
+NQUEUES - number of nfqueues bound (contiguous range), each one read by its own thread (default NTHREADS)
+FIREGEX_CPU_AFFINITY - cpu list (e.g. 0-3,6) where the workers and the queue readers are pinned, round robin (default no pinning)
+FIREGEX_NFQUEUE_BATCH_SIZE - max packets received and verdicts sent with a single syscall (default 1, no batching)
+FIREGEX_NFQUEUE_BATCH_LATENCY_US - max time in us a verdict can wait in the batch (default 500)
+FIREGEX_MAX_STREAMS - max streams tracked by the service (split between the workers), the least recently used are evicted (default 65536, 0 unlimited)
+FIREGEX_STREAM_TIMEOUT_S - streams (and UDP flows) idle for more than this number of seconds are evicted (default 300, 0 never)
+FIREGEX_TCP_DIRECT_SCAN - "1" to scan the TCP payloads in order directly from the packets, without the libtins reassembly (stream mode only)
+FIREGEX_UDP_FLOW - "1" to match the datagrams of a UDP flow (same addresses and ports) as a stream, until idle for FIREGEX_STREAM_TIMEOUT_S (stream mode only)
+FIREGEX_HS_CACHE_DIR - directory of the compiled hyperscan databases cache (see regex/hs_cache.cpp), disabled if not set
+FIREGEX_HS_CACHE_MAX - max number of databases kept in the cache (default 64)
+FIREGEX_TEST_REGEX - only test the compilation of the regex and exit
+FIREGEX_REGEX_VALIDATOR - run as regex validator (see regex_validator) instead of filtering packets
+
+Configuration lines are space separated encoded rules, optionally preceded by "#<version>":
+the version is used in the stats frames to let the backend map the rule indexes to its filters
 */
 
 
-void config_updater (){
+/*
+Control commands are stdin lines starting with '!' (a configuration line starts with '#' or a rule):
+!THREADS <n> [<cpu list>] - changes the number of workers of the running queue, pinning the threads on the cpu list if given
+*/
+void control_command(const string& line, MultiThreadQueue<RegexNfQueue>& queue_manager){
+	istringstream command_stream(line.substr(1));
+	string command;
+	command_stream >> command;
+	try{
+		if (command == "THREADS"){
+			int n_threads = 0;
+			if (!(command_stream >> n_threads) || n_threads <= 0){
+				throw invalid_argument("Invalid number of threads");
+			}
+			string cpu_list; // Optional, empty keeps the current pinning
+			command_stream >> cpu_list;
+			vector<int> cpus = parse_cpu_list(cpu_list.c_str());
+			if (!cpu_list.empty() && cpus.empty()){
+				throw invalid_argument("Invalid cpu list");
+			}
+			queue_manager.resize(n_threads, cpus);
+			cerr << "[info] [updater] Workers resized to " << n_threads << endl;
+		}else{
+			throw invalid_argument("Unknown command " + command);
+		}
+		control_out.line("ACK OK");
+	}catch(const std::exception& e){
+		cerr << "[error] [updater] Control command failed: " << e.what() << endl;
+		control_out.line(string("ACK FAIL ") + e.what());
+	}
+}
+
+void config_updater (MultiThreadQueue<RegexNfQueue>& queue_manager){
 	string line;
 	while (true){
 		getline(cin, line);
@@ -26,31 +81,73 @@ void config_updater (){
 			cerr << "[fatal] [updater] cin.bad()" << endl;
 			exit(EXIT_FAILURE);
 		}
+		if (!line.empty() && line[0] == '!'){
+			control_command(line, queue_manager);
+			continue;
+		}
 		cerr << "[info] [updater] Updating configuration with line " << line << endl;
 		istringstream config_stream(line);
 		vector<string> raw_rules;
+		uint16_t config_ver = 0;
 		
 		while(!config_stream.eof()){
 			string data;
 			config_stream >> data;
 			if (data != "" && data != "\n"){
+				if (data[0] == '#'){
+					config_ver = (uint16_t)::atoi(data.c_str()+1);
+					continue;
+				}
 				raw_rules.push_back(data);
 			}
 		}
 		try{
-			regex_config.reset(new RegexRules(raw_rules, regex_config->stream_mode()));
-			cerr << "[info] [updater] Config update done to ver "<< regex_config->ver() << endl;
-			osyncstream(cout) << "ACK OK" << endl;
+			shared_ptr<RegexRules> current_config = regex_config.load(memory_order_acquire);
+			shared_ptr<RegexRules> new_config(new RegexRules(raw_rules, current_config->stream_mode(), config_ver));
+			// The scratches of the workers are allocated before the configuration is published
+			new_config->prepare_scratches(queue_manager.n_threads(), current_config.get());
+			regex_config.store(new_config, memory_order_release);
+			cerr << "[info] [updater] Config update done to ver "<< new_config->ver() << endl;
+			control_out.line("ACK OK");
 		}catch(const std::exception& e){
 			cerr << "[error] [updater] Failed to build new configuration!" << endl;
-			osyncstream(cout) << "ACK FAIL " << e.what() << endl;
+			control_out.line(string("ACK FAIL ") + e.what());
 		}
 	}
 	
 }
 
+/*
+Validation mode: every line on stdin is a space separated list of encoded rules (the same format of the
+configuration lines), for each rule a line "OK" or "FAIL <error>" is written on stdout in the same order
+*/
+int regex_validator(){
+	string line;
+	while (getline(cin, line)){
+		istringstream rules_stream(line);
+		string rule, result;
+		while (rules_stream >> rule){
+			try{
+				decoded_regex decoded = decode_regex(rule);
+				RegexRules::compile_regex(decoded.regex.c_str(), decoded.is_case_sensitive);
+				result += "OK\n";
+			}catch(const std::exception& e){
+				string err = e.what();
+				replace(err.begin(), err.end(), '\n', ' ');
+				result += "FAIL " + err + "\n";
+			}
+		}
+		cout << result << flush;
+	}
+	return 0;
+}
+
 int main(int argc, char *argv[]){
 
+	if (getenv("FIREGEX_REGEX_VALIDATOR") != nullptr){
+		return regex_validator();
+	}
+
 	char * test_regex = getenv("FIREGEX_TEST_REGEX");
 	if (test_regex != nullptr){
 		cerr << "[info] [main] Testing regex: " << test_regex << endl;
@@ -70,6 +167,11 @@ int main(int argc, char *argv[]){
    	if (n_threads_str != nullptr) n_of_threads = ::atoi(n_threads_str);
 	if(n_of_threads <= 0) n_of_threads = 1;
 
+	int n_of_queues = n_of_threads;
+   	char * n_queues_str = getenv("NQUEUES");
+   	if (n_queues_str != nullptr) n_of_queues = ::atoi(n_queues_str);
+	if(n_of_queues <= 0) n_of_queues = n_of_threads;
+
 	char * matchmode = getenv("MATCH_MODE");
 	bool stream_mode = true;
 	if (matchmode != nullptr && strcmp(matchmode, "block") == 0){
@@ -78,16 +180,21 @@ int main(int argc, char *argv[]){
 	
 	bool fail_open = strcmp(getenv("FIREGEX_NFQUEUE_FAIL_OPEN"), "1") == 0;
 
-	regex_config.reset(new RegexRules(stream_mode));
+	int stats_batch_ms = 0;
+	char * stats_batch_str = getenv("FIREGEX_STATS_BATCH_MS");
+	if (stats_batch_str != nullptr) stats_batch_ms = ::atoi(stats_batch_str);
+	stats_reporter.start(parse_stats_proto(getenv("FIREGEX_STATS_PROTO")), stats_batch_ms);
+
+	regex_config.store(make_shared<RegexRules>(stream_mode));
 
-	MultiThreadQueue<RegexNfQueue> queue_manager(n_of_threads);
-	osyncstream(cout) << "QUEUE " << queue_manager.queue_num() << endl;
-	cerr << "[info] [main] Queue: " << queue_manager.queue_num() << " threads assigned: " << n_of_threads << " stream mode: " << stream_mode << " fail open: " << fail_open << endl;
+	MultiThreadQueue<RegexNfQueue> queue_manager(n_of_threads, n_of_queues);
+	control_out.line("QUEUE " + to_string(queue_manager.queue_num()) + " " + to_string(queue_manager.last_queue_num()));
+	cerr << "[info] [main] Queues: " << queue_manager.queue_num() << "-" << queue_manager.last_queue_num() << " threads assigned: " << n_of_threads << " stream mode: " << stream_mode << " fail open: " << fail_open << endl;
 
 	thread qthr([&](){
 		queue_manager.start();
 	});
-	config_updater();
+	config_updater(queue_manager);
 	qthr.join();
 
 }
@@ -0,0 +1,150 @@
+#ifndef PROXY_TUNNEL_GC_POLICY_CPP
+#define PROXY_TUNNEL_GC_POLICY_CPP
+
+#include <Python.h>
+#include <chrono>
+#include <sstream>
+#include <iostream>
+#include "../classes/stats.cpp"
+
+using namespace std;
+
+namespace Firegex {
+namespace PyProxy {
+
+/*
+Garbage collection of the worker interpreters: the filters are never interrupted by a full collection,
+the cycles are released by the automatic generational collection (FIREGEX_PY_GC_THRESHOLDS, as gc.set_threshold)
+and by the full collections forced by the policy:
+- every FIREGEX_PY_GC_EVERY_PACKETS packets handled by the worker (0 disabled)
+- every FIREGEX_PY_GC_INTERVAL_MS, checked after each packet (0 disabled)
+- when the worker queue is empty after handling some packets (FIREGEX_PY_GC_ON_IDLE = "1")
+*/
+struct gc_settings {
+	long thresholds[3] = {-1, -1, -1}; // -1 keeps the python default of the generation, 0 in the first disables the automatic collection
+	uint64_t every_packets = 0;
+	chrono::milliseconds interval{0};
+	bool on_idle = true;
+
+	static gc_settings from_env(){
+		gc_settings settings;
+		char* thresholds_str = getenv("FIREGEX_PY_GC_THRESHOLDS");
+		if (thresholds_str != nullptr){
+			istringstream thresholds_stream(thresholds_str);
+			string value;
+			for (int i = 0; i < 3 && getline(thresholds_stream, value, ','); i++){
+				if (!value.empty() && ::atol(value.c_str()) >= 0){
+					settings.thresholds[i] = ::atol(value.c_str());
+				}
+			}
+		}
+		char* packets_str = getenv("FIREGEX_PY_GC_EVERY_PACKETS");
+		if (packets_str != nullptr && ::atoll(packets_str) >= 0){
+			settings.every_packets = ::atoll(packets_str);
+		}
+		char* interval_str = getenv("FIREGEX_PY_GC_INTERVAL_MS");
+		if (interval_str != nullptr && ::atoi(interval_str) >= 0){
+			settings.interval = chrono::milliseconds(::atoi(interval_str));
+		}
+		char* idle_str = getenv("FIREGEX_PY_GC_ON_IDLE");
+		if (idle_str != nullptr){
+			settings.on_idle = strcmp(idle_str, "1") == 0;
+		}
+		return settings;
+	}
+};
+
+/*
+GC policy of a worker, used only by the thread of its interpreter.
+The time of every collection (automatic or forced) is measured with a gc.callbacks entry and added to the worker counters
+*/
+class GcPolicy {
+	private:
+	gc_settings settings = gc_settings::from_env();
+	Stats::WorkerCounters* counters = nullptr;
+	uint64_t packets = 0; // Handled since the last forced collection
+	chrono::steady_clock::time_point last_collect = chrono::steady_clock::now();
+	chrono::steady_clock::time_point collect_start;
+
+	static PyObject* gc_callback(PyObject* self, PyObject* args){
+		GcPolicy* policy = (GcPolicy*)PyCapsule_GetPointer(self, nullptr);
+		const char* phase = nullptr;
+		PyObject* info = nullptr;
+		if (policy == nullptr || !PyArg_ParseTuple(args, "sO", &phase, &info)){
+			return nullptr;
+		}
+		if (strcmp(phase, "start") == 0){
+			policy->collect_start = chrono::steady_clock::now();
+		}else if (policy->counters != nullptr){
+			auto elapsed = chrono::duration_cast<chrono::microseconds>(chrono::steady_clock::now() - policy->collect_start);
+			policy->counters->gc_collected(elapsed.count());
+		}
+		Py_RETURN_NONE;
+	}
+
+	inline static PyMethodDef gc_callback_def = {"firegex_gc_callback", gc_callback, METH_VARARGS, nullptr};
+
+	public:
+
+	// Called in the worker interpreter: sets the thresholds and registers the timing callback
+	void setup(Stats::WorkerCounters* worker_counters){
+		counters = worker_counters;
+		PyObject* gc_module = PyImport_ImportModule("gc");
+		if (gc_module == nullptr){
+			PyErr_Print();
+			cerr << "[error] [GcPolicy.setup] Failed to import the gc module" << endl;
+			return;
+		}
+		PyObject* current = PyObject_CallMethod(gc_module, "get_threshold", nullptr);
+		if (current != nullptr && PyTuple_Check(current) && PyTuple_Size(current) == 3){
+			for (int i = 0; i < 3; i++){
+				if (settings.thresholds[i] < 0){
+					settings.thresholds[i] = PyLong_AsLong(PyTuple_GetItem(current, i));
+				}
+			}
+			PyObject* res = PyObject_CallMethod(gc_module, "set_threshold", "lll", settings.thresholds[0], settings.thresholds[1], settings.thresholds[2]);
+			Py_XDECREF(res);
+		}
+		Py_XDECREF(current);
+		PyObject* capsule = PyCapsule_New(this, nullptr, nullptr);
+		PyObject* callback = PyCFunction_New(&gc_callback_def, capsule);
+		PyObject* callbacks = PyObject_GetAttrString(gc_module, "callbacks");
+		if (callback == nullptr || callbacks == nullptr || PyList_Append(callbacks, callback) != 0){
+			cerr << "[error] [GcPolicy.setup] Failed to register the gc callback, the gc time is not measured" << endl;
+		}
+		if (PyErr_Occurred()){
+			PyErr_Print();
+		}
+		Py_XDECREF(callbacks);
+		Py_XDECREF(callback);
+		Py_XDECREF(capsule);
+		Py_DECREF(gc_module);
+	}
+
+	void collect(){
+		PyGC_Collect();
+		packets = 0;
+		last_collect = chrono::steady_clock::now();
+	}
+
+	// Called after a packet has been handled by the filters
+	inline void packet_handled(){
+		packets++;
+		if (settings.every_packets != 0 && packets >= settings.every_packets){
+			return collect();
+		}
+		if (settings.interval.count() != 0 && chrono::steady_clock::now() - last_collect >= settings.interval){
+			return collect();
+		}
+	}
+
+	// Called when the worker queue is empty: the collection doesn't delay any waiting packet
+	inline void idle(){
+		if (settings.on_idle && packets != 0){
+			collect();
+		}
+	}
+};
+
+}}
+#endif // PROXY_TUNNEL_GC_POLICY_CPP
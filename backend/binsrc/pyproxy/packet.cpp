@@ -0,0 +1,159 @@
+#ifndef PROXY_TUNNEL_PACKET_CPP
+#define PROXY_TUNNEL_PACKET_CPP
+
+#include <Python.h>
+#include <iostream>
+#include <string_view>
+#include "../classes/nfqueue.cpp"
+
+using namespace std;
+
+namespace Firegex {
+namespace PyProxy {
+
+class PyProxyQueue;
+
+/*
+Packet passed to the filters as __firegex_packet_info (read by RawPacket in firegex.nfproxy.internals.data).
+data and raw_packet are copied from the buffers of the packet into bytes on the first access (the raw packet
+is serialized again only when requested): nothing is copied until a filter reads them. No view over the packet
+buffers is exported, the memory is reused for the next packets after the verdict.
+release_py_packet detaches the object from the packet before the verdict, a filter keeping it reads the bytes
+copied on release. A type is created for every worker interpreter (see new_py_packet_type).
+*/
+struct py_packet {
+	PyObject_HEAD
+	NfQueue::PktRequest<PyProxyQueue>* pkt; // nullptr when released
+	const char* data;
+	Py_ssize_t data_size;
+	PyObject* data_bytes;
+	PyObject* raw_packet_bytes;
+	char is_input;
+	char is_ipv6;
+	char is_tcp;
+	long l4_size;
+	long header_size;
+};
+
+static PyObject* py_packet_released(){
+	PyErr_SetString(PyExc_ValueError, "The packet buffers are available only while the packet is handled");
+	return nullptr;
+}
+
+static PyObject* py_packet_get_data(PyObject* self, void*){
+	py_packet* packet = (py_packet*)self;
+	if (packet->data_bytes == nullptr){
+		if (packet->pkt == nullptr) return py_packet_released();
+		packet->data_bytes = PyBytes_FromStringAndSize(packet->data, packet->data_size);
+		if (packet->data_bytes == nullptr) return nullptr;
+	}
+	return Py_NewRef(packet->data_bytes);
+}
+
+static PyObject* py_packet_get_raw_packet(PyObject* self, void*){
+	py_packet* packet = (py_packet*)self;
+	if (packet->raw_packet_bytes == nullptr){
+		if (packet->pkt == nullptr) return py_packet_released();
+		try{
+			packet->pkt->reserialize();
+		}catch(const std::exception& e){
+			PyErr_SetString(PyExc_RuntimeError, e.what());
+			return nullptr;
+		}
+		auto raw_packet = packet->pkt->packet;
+		packet->raw_packet_bytes = PyBytes_FromStringAndSize((const char*)raw_packet.data(), raw_packet.size());
+		if (packet->raw_packet_bytes == nullptr) return nullptr;
+	}
+	return Py_NewRef(packet->raw_packet_bytes);
+}
+
+static void py_packet_dealloc(PyObject* self){
+	py_packet* packet = (py_packet*)self;
+	PyTypeObject* type = Py_TYPE(self);
+	Py_XDECREF(packet->data_bytes);
+	Py_XDECREF(packet->raw_packet_bytes);
+	PyObject_Free(self);
+	Py_DECREF(type);
+}
+
+static PyGetSetDef py_packet_getset[] = {
+	{"data", py_packet_get_data, nullptr, "The data of the packet assembled and sorted from TCP (bytes)", nullptr},
+	{"raw_packet", py_packet_get_raw_packet, nullptr, "The raw packet with IP and TCP headers (bytes)", nullptr},
+	{nullptr}
+};
+
+static PyMemberDef py_packet_members[] = {
+	{"is_input", Py_T_BOOL, offsetof(py_packet, is_input), Py_READONLY, nullptr},
+	{"is_ipv6", Py_T_BOOL, offsetof(py_packet, is_ipv6), Py_READONLY, nullptr},
+	{"is_tcp", Py_T_BOOL, offsetof(py_packet, is_tcp), Py_READONLY, nullptr},
+	{"l4_size", Py_T_LONG, offsetof(py_packet, l4_size), Py_READONLY, nullptr},
+	{"header_size", Py_T_LONG, offsetof(py_packet, header_size), Py_READONLY, nullptr},
+	{nullptr}
+};
+
+static PyType_Slot py_packet_slots[] = {
+	{Py_tp_dealloc, (void*)py_packet_dealloc},
+	{Py_tp_getset, py_packet_getset},
+	{Py_tp_members, py_packet_members},
+	{0, nullptr}
+};
+
+static PyType_Spec py_packet_spec = {
+	"firegex.nfproxy.NativePacket",
+	sizeof(py_packet),
+	0,
+	Py_TPFLAGS_DEFAULT | Py_TPFLAGS_DISALLOW_INSTANTIATION,
+	py_packet_slots
+};
+
+// Called in the worker interpreter, returns a new reference
+PyTypeObject* new_py_packet_type(){
+	PyTypeObject* type = (PyTypeObject*)PyType_FromSpec(&py_packet_spec);
+	if (type == nullptr){
+		PyErr_Print();
+		throw invalid_argument("Failed to create the packet type");
+	}
+	return type;
+}
+
+// The packet and its data have to be valid until release_py_packet is called
+PyObject* new_py_packet(PyTypeObject* type, NfQueue::PktRequest<PyProxyQueue>* pkt, string_view data){
+	py_packet* packet = PyObject_New(py_packet, type);
+	if (packet == nullptr){
+		PyErr_Print();
+		throw invalid_argument("Failed to create the packet object");
+	}
+	packet->pkt = pkt;
+	packet->data = data.data();
+	packet->data_size = data.size();
+	packet->data_bytes = nullptr;
+	packet->raw_packet_bytes = nullptr;
+	packet->is_input = pkt->is_input;
+	packet->is_ipv6 = pkt->is_ipv6;
+	packet->is_tcp = pkt->l4_proto == NfQueue::L4Proto::TCP;
+	packet->l4_size = pkt->data_size();
+	packet->header_size = pkt->header_size();
+	return (PyObject*)packet;
+}
+
+/*
+Detaches the object from the packet, called before the verdict with the only reference of the caller left if the
+filters didn't keep the object: else the buffers not read yet are copied, the object is still readable later.
+*/
+void release_py_packet(PyObject* obj){
+	py_packet* packet = (py_packet*)obj;
+	if (Py_REFCNT(obj) > 1){
+		for (auto getter: {py_packet_get_data, py_packet_get_raw_packet}){
+			PyObject* res = getter(obj, nullptr);
+			if (res == nullptr){
+				PyErr_Print();
+				cerr << "[error] [release_py_packet] Failed to copy a packet buffer of a packet kept by the filters" << endl;
+			}
+			Py_XDECREF(res);
+		}
+	}
+	packet->pkt = nullptr;
+}
+
+}}
+#endif // PROXY_TUNNEL_PACKET_CPP
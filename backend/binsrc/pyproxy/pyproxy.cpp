@@ -19,6 +19,7 @@
 #include "../classes/nfqueue.cpp"
 #include "stream_ctx.cpp"
 #include "settings.cpp"
+#include "gc_policy.cpp"
 #include <Python.h>
 
 using Tins::TCPIP::Stream;
@@ -31,10 +32,13 @@ namespace PyProxy {
 class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 	private:
 	u_int16_t latest_config_ver = 0;
+	shared_ptr<PyCodeConfig> stats_config; // Config used to map the filter names to the stats indexes
 	public:
+	Stats::WorkerCounters counters;
 	stream_ctx sctx;
 	StreamFollower follower;
 	PyThreadState * tstate = nullptr;
+	GcPolicy gc;
 
 	PyInterpreterConfig py_thread_config = {
 		.use_main_obmalloc = 0,
@@ -47,8 +51,11 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 	};
 	NfQueue::PktRequest<PyProxyQueue>* pkt;
 	NfQueue::tcp_ack_seq_ctx* current_tcp_ack = nullptr;
+	tcp_ack_handoff moved_tcp_acks; // Of the connections moved to this worker on resize
 
 	PyObject* handle_packet_code = nullptr;
+	PyTypeObject* packet_type = nullptr; // Of the packets passed to the filters, created in the worker interpreter
+	unique_ptr<filter_template> stream_template; // Of the last config seen by the worker, built when a stream is opened
 
     void before_loop() override {
 		PyStatus pystatus;
@@ -70,22 +77,43 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 			PyGC_Enable();
 		}
 
+		gc.setup(&counters);
+
 		handle_packet_code = unmarshal_code(py_handle_packet_code);
+		packet_type = new_py_packet_type();
 		// Setting callbacks for the stream follower
+		// The connections moved to this worker on resize (or already open) are followed from their next packet
+		follower.follow_partial_streams(true);
 		follower.new_stream_callback(bind(on_new_stream, placeholders::_1, this));
 		follower.stream_termination_callback(bind(on_stream_close, placeholders::_1, this));
+		counters.queue_probe = [this]() {
+			return Stats::queue_gauges{queue.size(), queue.full_waits.exchange(0, memory_order_relaxed)};
+		};
+		stats_reporter.register_worker(&counters);
     }
 
 	inline void print_blocked_reason(const string& func_name){
-		control_socket << "BLOCKED " << func_name << endl;
+		if (stats_reporter.binary()){
+			counters.blocked(stats_config->filter_index(func_name));
+		}else{
+			control_out.line("BLOCKED " + func_name);
+		}
 	}
 
 	inline void print_mangle_reason(const string& func_name){
-		control_socket << "MANGLED " << func_name << endl;
+		if (stats_reporter.binary()){
+			counters.mangled(stats_config->filter_index(func_name));
+		}else{
+			control_out.line("MANGLED " + func_name);
+		}
 	}
 
 	inline void print_exception_reason(){
-		control_socket << "EXCEPTION" << endl;
+		if (stats_reporter.binary()){
+			counters.exception();
+		}else{
+			control_out.line("EXCEPTION");
+		}
 	}
 
 	//If the stream has already been matched, drop all data, and try to close the connection
@@ -97,14 +125,17 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 		pyq->pkt->drop();// This is needed because the callback has to take the updated pkt pointer!
 	}
 
-	void filter_action(NfQueue::PktRequest<PyProxyQueue>* pkt, Stream& stream, const string& data){
+	void filter_action(NfQueue::PktRequest<PyProxyQueue>* pkt, Stream& stream, string_view data){
 		auto stream_search = sctx.streams_ctx.find(pkt->sid);
 		pyfilter_ctx* stream_match;
-		if (stream_search == sctx.streams_ctx.end()){
+		if (stream_search == nullptr){
 			shared_ptr<PyCodeConfig> conf = config;
+			if (!stream_template || stream_template->config != conf){
+				stream_template.reset(); // The globals of the previous config are released before executing the new code
+				stream_template = make_unique<filter_template>(conf);
+			}
 			//If config is not set, ignore the stream
-			PyObject* compiled_code = conf->compiled_code();
-			if (compiled_code == nullptr){
+			if (!stream_template->has_code()){
 				stream.client_data_callback(nullptr);
 				stream.server_data_callback(nullptr);
 				stream.ignore_client_data();
@@ -112,7 +143,7 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 				return pkt->accept();
 			}else{
 				try{
-					stream_match = new pyfilter_ctx(compiled_code, handle_packet_code);
+					stream_match = new pyfilter_ctx(stream_template->stream_glob(), handle_packet_code);
 				}catch(invalid_argument& e){
 					cerr << "[error] [filter_action] Failed to create the filter context" << endl;
 					print_exception_reason();
@@ -126,10 +157,12 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 				sctx.streams_ctx.insert_or_assign(pkt->sid, stream_match);
 			}
 		}else{
-			stream_match = stream_search->second;
+			stream_match = *stream_search;
 		}		
 
-		auto result = stream_match->handle_packet(pkt, data);
+		counters.bytes_scanned(data.size());
+		auto result = stream_match->handle_packet(pkt, data, packet_type);
+		gc.packet_handled();
 		switch(result.action){
 			case PyFilterResponse::ACCEPT:
 				return pkt->accept();
@@ -169,21 +202,21 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 	}
 
 
-	static void on_data_recv(Stream& stream, PyProxyQueue* pyq, const string& data) {
+	static void on_data_recv(Stream& stream, PyProxyQueue* pyq, string_view data) {
 		pyq->pkt->fix_data_payload();
 		pyq->filter_action(pyq->pkt, stream, data); //Only here the rebuilt_tcp_data is set
 	}
 	
 	//Input data filtering
 	static void on_client_data(Stream& stream, PyProxyQueue* pyq) {
-		auto data = stream.client_payload();
-		on_data_recv(stream, pyq, string((char*)data.data(), data.size()));
+		const auto& data = stream.client_payload();
+		on_data_recv(stream, pyq, string_view((const char*)data.data(), data.size()));
 	}
 	
 	//Server data filtering
 	static void on_server_data(Stream& stream, PyProxyQueue* pyq) {
-		auto data = stream.server_payload();
-		on_data_recv(stream, pyq, string((char*)data.data(), data.size()));
+		const auto& data = stream.server_payload();
+		on_data_recv(stream, pyq, string_view((const char*)data.data(), data.size()));
 	}
 	
 	// A stream was terminated. The second argument is the reason why it was terminated
@@ -199,19 +232,19 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 			stream.enable_recovery_mode(10 * 1024);
 		}
 
-		if (pyq->current_tcp_ack != nullptr){
-			pyq->current_tcp_ack->reset();
-		}else{
+		if (pyq->current_tcp_ack == nullptr){
 			pyq->current_tcp_ack = new NfQueue::tcp_ack_seq_ctx();
 			pyq->sctx.tcp_ack_ctx.insert_or_assign(pyq->pkt->sid, pyq->current_tcp_ack);
 			pyq->pkt->ack_seq_offset = pyq->current_tcp_ack; // Set ack context
+		}else if (!stream.is_partial_stream()){
+			pyq->current_tcp_ack->reset();
+			//Should not happen, but with this we can be sure about this
+			auto tcp_ack_search = pyq->sctx.tcp_ack_ctx.find(pyq->pkt->sid);
+			if (tcp_ack_search != nullptr){
+				(*tcp_ack_search)->reset();
+			}
 		}
-
-		//Should not happen, but with this we can be sure about this
-		auto tcp_ack_search = pyq->sctx.tcp_ack_ctx.find(pyq->pkt->sid);
-		if (tcp_ack_search != pyq->sctx.tcp_ack_ctx.end()){
-			tcp_ack_search->second->reset();
-		}
+		// else: a connection moved from another worker, the offsets of its mangled packets are kept
 		
 		stream.client_data_callback(bind(on_client_data, placeholders::_1, pyq));
 		stream.server_data_callback(bind(on_server_data, placeholders::_1, pyq));
@@ -220,14 +253,22 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 
 	void handle_next_packet(NfQueue::PktRequest<PyProxyQueue>* _pkt) override{
 		pkt = _pkt; // Setting packet context
+		counters.packet_seen();
+
+		shared_ptr<PyCodeConfig> conf = config;
+		if (conf != stats_config){
+			stats_config = conf;
+			counters.switch_config(conf->version, conf->filters_count());
+		}
 
 		if (pkt->l4_proto != NfQueue::L4Proto::TCP){
 			throw invalid_argument("Only TCP and UDP are supported");
 		}
 
+		moved_tcp_acks.take(sctx.tcp_ack_ctx);
 		auto tcp_ack_search = sctx.tcp_ack_ctx.find(pkt->sid);
-		if (tcp_ack_search != sctx.tcp_ack_ctx.end()){
-			current_tcp_ack = tcp_ack_search->second;
+		if (tcp_ack_search != nullptr){
+			current_tcp_ack = *tcp_ack_search;
 			pkt->ack_seq_offset = current_tcp_ack;
 		}else{
 			current_tcp_ack = nullptr;
@@ -248,7 +289,30 @@ class PyProxyQueue: public NfQueue::ThreadNfQueue<PyProxyQueue> {
 		}
 	}
 
+	void on_idle() override{
+		gc.idle();
+	}
+
+	void on_resize(size_t index, size_t n_active) override{
+		auto released = sctx.release_streams_if([&](const stream_id& sid){
+			return NfQueue::stream_worker_index(sid, n_active) != index;
+		});
+		current_tcp_ack = nullptr;
+		// The tcp_ack contexts are given to the new owners of the streams, grouped by worker
+		vector<vector<pair<stream_id, NfQueue::tcp_ack_seq_ctx*>>> moved(n_active);
+		for (auto& [sid, tcp_ack]: released){
+			moved[NfQueue::stream_worker_index(sid, n_active)].emplace_back(sid, tcp_ack);
+		}
+		for (size_t i = 0; i < n_active; i++){
+			if (!moved[i].empty()){
+				(*workers)[i]->moved_tcp_acks.give(std::move(moved[i]));
+			}
+		}
+	}
+
 	~PyProxyQueue() {
+		stream_template.reset();
+		Py_XDECREF(packet_type);
 		// Closing first the interpreter
 		
 		Py_EndInterpreter(tstate);
@@ -6,7 +6,9 @@
 #include <vector>
 #include <memory>
 #include <iostream>
+#include <unordered_map>
 #include "../utils.cpp"
+#include "../classes/stats.cpp"
 
 using namespace std;
 
@@ -17,6 +19,8 @@ class PyCodeConfig;
 
 shared_ptr<PyCodeConfig> config;
 UnixClientConnection control_socket;
+Stats::OutputChannel control_out(-1); // Set on the control socket by init_control_socket
+Stats::StatsReporter stats_reporter(control_out);
 
 PyObject* unmarshal_code(string encoded_code){
 	if (encoded_code.empty()) return nullptr;
@@ -24,8 +28,21 @@ PyObject* unmarshal_code(string encoded_code){
 }
 
 class PyCodeConfig{
+	private:
+		unordered_map<string, uint32_t> filters_index;
 	public:
 		string encoded_code;
+		uint16_t version = 0;
+
+		// Index of the filter in __firegex_pyfilter_enabled (used as rule index in the stats frames)
+		uint32_t filter_index(const string& name){
+			auto it = filters_index.find(name);
+			return it == filters_index.end() ? UINT32_MAX : it->second;
+		}
+
+		size_t filters_count(){
+			return filters_index.size();
+		}
 
 		PyCodeConfig(const string& pycode){
 			PyObject* compiled_code = Py_CompileStringExFlags(pycode.c_str(), "<pyfilter>", Py_file_input, NULL, 2);
@@ -35,13 +52,15 @@ class PyCodeConfig{
 			}
 			PyObject* glob = PyDict_New();
 			PyObject* result = PyEval_EvalCode(compiled_code, glob, glob);
-			Py_DECREF(glob);
 			if (PyErr_Occurred()){
 				PyErr_Print();
+				Py_DECREF(glob);
 				Py_DECREF(compiled_code);
 				std::cerr << "[fatal] [main] Failed to execute the code" << endl;
 				throw invalid_argument("Failed to execute the code, maybe an invalid filter code has been provided");
 			}
+			load_stats_info(glob);
+			Py_DECREF(glob);
 			Py_XDECREF(result);
 			PyObject* code_dump = PyMarshal_WriteObjectToString(compiled_code, 4);
 			Py_DECREF(compiled_code);
@@ -64,6 +83,23 @@ class PyCodeConfig{
 			return unmarshal_code(encoded_code);
 		}
 
+		// Read the enabled filters and the config version set by the backend in the code globals
+		void load_stats_info(PyObject* glob){
+			PyObject* enabled = PyDict_GetItemString(glob, "__firegex_pyfilter_enabled");
+			if (enabled != nullptr && PyList_Check(enabled)){
+				for (Py_ssize_t i = 0; i < PyList_Size(enabled); i++){
+					PyObject* name = PyList_GetItem(enabled, i);
+					if (PyUnicode_Check(name)){
+						filters_index[PyUnicode_AsUTF8(name)] = i;
+					}
+				}
+			}
+			PyObject* ver = PyDict_GetItemString(glob, "__firegex_config_ver");
+			if (ver != nullptr && PyLong_Check(ver)){
+				version = (uint16_t)PyLong_AsLong(ver);
+			}
+		}
+
 		PyCodeConfig(){}
 };
 
@@ -72,6 +108,7 @@ void init_control_socket(){
 	if (socket_path == nullptr) throw invalid_argument("FIREGEX_NFPROXY_SOCK not set");
 	if (strlen(socket_path) >= 108) throw invalid_argument("FIREGEX_NFPROXY_SOCK too long");
 	control_socket = UnixClientConnection(socket_path);
+	control_out.set_fd(control_socket.sockfd);
 }
 
 string py_handle_packet_code;
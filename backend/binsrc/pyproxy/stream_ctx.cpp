@@ -4,11 +4,15 @@
 
 #include <iostream>
 #include <tins/tcp_ip/stream_identifier.h>
-#include <map>
+#include <vector>
+#include <functional>
+#include <mutex>
+#include <atomic>
 #include <Python.h>
 #include "../classes/netfilter.cpp"
 #include "../classes/nfqueue.cpp"
 #include "settings.cpp"
+#include "packet.cpp"
 #include "../utils.cpp"
 
 using namespace std;
@@ -52,30 +56,98 @@ struct py_filter_response {
 
 typedef Tins::TCPIP::StreamIdentifier stream_id;
 
+// Executes the filter code in new globals, returns a new reference
+PyObject* execute_filter_code(PyObject * compiled_code){
+	PyObject* glob = PyDict_New();
+	PyObject* result = PyEval_EvalCode(compiled_code, glob, glob);
+	if (PyErr_Occurred()){
+		PyErr_Print();
+		Py_XDECREF(glob);
+		std::cerr << "[fatal] [main] Failed to compile the code" << endl;
+		throw invalid_argument("Failed to execute the code, maybe an invalid filter code has been provided");
+	}
+	Py_XDECREF(result);
+	return glob;
+}
+
+/*
+Globals of the filter code of a configuration, executed once by the worker (imports, module setup and
+firegex.nfproxy.internals.compile): the globals of every new stream are copied from the template with
+firegex.nfproxy.internals.clone, sharing the immutable state, so a new stream doesn't depend on the filter code weight.
+If the globals can't be copied (e.g. a value not supported by deepcopy) the code is executed again for every stream.
+*/
+struct filter_template {
+
+	shared_ptr<PyCodeConfig> config;
+	PyObject * code = nullptr;
+	PyObject * glob = nullptr; // nullptr if the config has no code or its execution failed
+	PyObject * clone_func = nullptr;
+
+	filter_template(shared_ptr<PyCodeConfig> conf): config(conf) {
+		code = conf->compiled_code();
+		if (code == nullptr) return;
+		try{
+			glob = execute_filter_code(code);
+		}catch(invalid_argument& e){
+			cerr << "[error] [filter_template] Failed to execute the filter code of the config " << conf->version << endl;
+			return;
+		}
+		PyObject* internals = PyImport_ImportModule("firegex.nfproxy.internals");
+		if (internals != nullptr){
+			clone_func = PyObject_GetAttrString(internals, "clone");
+			Py_DECREF(internals);
+		}
+		if (clone_func == nullptr){
+			PyErr_Print();
+			cerr << "[warning] [filter_template] Clone of the filter globals not available, the code is executed for every stream" << endl;
+		}
+	}
+
+	inline bool has_code() const {
+		return code != nullptr;
+	}
+
+	// Globals of a new stream (new reference), throws invalid_argument if they can't be created
+	PyObject* stream_glob(){
+		if (glob == nullptr){
+			throw invalid_argument("The filter code of the config can't be executed");
+		}
+		if (clone_func != nullptr){
+			PyObject* stream_glob = PyObject_CallOneArg(clone_func, glob);
+			if (stream_glob != nullptr && PyDict_Check(stream_glob)){
+				return stream_glob;
+			}
+			Py_XDECREF(stream_glob);
+			PyErr_Print();
+			cerr << "[warning] [filter_template] The filter globals can't be cloned, the code is executed for every stream" << endl;
+			Py_CLEAR(clone_func);
+		}
+		return execute_filter_code(code);
+	}
+
+	~filter_template(){
+		Py_XDECREF(clone_func);
+		Py_XDECREF(glob);
+		Py_XDECREF(code);
+	}
+};
+
 struct pyfilter_ctx {
 
 	PyObject * glob = nullptr;
 	PyObject * py_handle_packet = nullptr;
 	
-	pyfilter_ctx(PyObject * compiled_code, PyObject * handle_packet_code){
+	// stream_glob is a new reference (see filter_template::stream_glob), owned by the context
+	pyfilter_ctx(PyObject * stream_glob, PyObject * handle_packet_code){
 		py_handle_packet = handle_packet_code;
 		Py_INCREF(py_handle_packet);
-		glob = PyDict_New();
-		PyObject* result = PyEval_EvalCode(compiled_code, glob, glob);
-		Py_XDECREF(compiled_code);
-		if (PyErr_Occurred()){
-			PyErr_Print();
-			Py_XDECREF(glob);
-			std::cerr << "[fatal] [main] Failed to compile the code" << endl;
-			throw invalid_argument("Failed to execute the code, maybe an invalid filter code has been provided");
-		}
-		Py_XDECREF(result);
+		glob = stream_glob;
 	}
 
 	~pyfilter_ctx(){
 		Py_DECREF(glob);
 		Py_DECREF(py_handle_packet);
-		PyGC_Collect();
+		// The cycles of the stream globals are released by the worker GcPolicy
 	}
 
 	inline void set_item_to_glob(const char* key, PyObject* value){
@@ -105,23 +177,27 @@ struct pyfilter_ctx {
 
 	py_filter_response handle_packet(
 		NfQueue::PktRequest<PyProxyQueue>* pkt,
-		const string& data
+		string_view data,
+		PyTypeObject* packet_type
 	){
-		PyObject * packet_info = PyDict_New();
-		
-		pkt->reserialize();
-		set_item_to_dict(packet_info, "data", PyBytes_FromStringAndSize(data.c_str(), data.size()));
-		set_item_to_dict(packet_info, "l4_size", PyLong_FromLong(pkt->data_size()));
-		set_item_to_dict(packet_info, "raw_packet", PyBytes_FromStringAndSize(pkt->packet.c_str(), pkt->packet.size()));
-		set_item_to_dict(packet_info, "is_input", PyBool_FromLong(pkt->is_input));
-		set_item_to_dict(packet_info, "is_ipv6", PyBool_FromLong(pkt->is_ipv6));
-		set_item_to_dict(packet_info, "is_tcp", PyBool_FromLong(pkt->l4_proto == NfQueue::L4Proto::TCP));
+		// The buffers of the packet are copied only if read by the filters (see packet.cpp)
+		PyObject * packet_info = new_py_packet(packet_type, pkt, data);
 
 		// Set packet info to the global context
-		set_item_to_glob("__firegex_packet_info", packet_info);
+		set_item_to_glob("__firegex_packet_info", Py_NewRef(packet_info));
 		PyObject * result = PyEval_EvalCode(py_handle_packet, glob, glob);
-		PyGC_Collect();
-		del_item_from_glob("__firegex_packet_info");
+		PyObject * exc = PyErr_GetRaisedException();
+		// Removed before the release: the packet is copied only if still referenced by the filters
+		bool info_deleted = PyDict_DelItemString(glob, "__firegex_packet_info") == 0;
+		release_py_packet(packet_info); // Before the verdict, whatever the result of the delete
+		Py_DECREF(packet_info);
+		if (!info_deleted){
+			Py_XDECREF(exc);
+			Py_XDECREF(result);
+			PyErr_Print();
+			throw invalid_argument("Failed to delete item from dict");
+		}
+		PyErr_SetRaisedException(exc);
 
 		if (PyErr_Occurred()){
 			cerr << "[error] [handle_packet] Failed to execute the code " << result << endl;
@@ -237,7 +313,52 @@ struct pyfilter_ctx {
 
 };
 
-typedef map<stream_id, pyfilter_ctx*> matching_map;
+typedef NfQueue::StreamMap<pyfilter_ctx*> matching_map;
+
+/*
+tcp_ack contexts of the connections moved to a worker on resize, given by their old owners.
+The filter state of a connection can't leave the interpreter of its worker (the new owner picks the connection up
+as a partial stream), only the seq/ack offsets of the mangled connections are moved.
+The packets handled by the new owner before the offsets are given (while the old owner releases the streams) are
+not fixed.
+*/
+class tcp_ack_handoff {
+	private:
+	mutex handoff_lock;
+	vector<pair<stream_id, NfQueue::tcp_ack_seq_ctx*>> moved;
+	atomic<bool> pending{false}; // Checked without the lock on every packet
+
+	public:
+	// Called by the old owner
+	void give(vector<pair<stream_id, NfQueue::tcp_ack_seq_ctx*>>&& tcp_acks){
+		lock_guard<mutex> lk(handoff_lock);
+		moved.insert(moved.end(), tcp_acks.begin(), tcp_acks.end());
+		pending.store(true, memory_order_release);
+	}
+
+	// Called by the new owner: the given contexts replace the ones created for the partial streams
+	void take(NfQueue::tcp_ack_map& tcp_ack_ctx){
+		if (!pending.load(memory_order_acquire)){
+			return;
+		}
+		lock_guard<mutex> lk(handoff_lock);
+		for (auto& [sid, tcp_ack]: moved){
+			auto tcp_ack_search = tcp_ack_ctx.find(sid);
+			if (tcp_ack_search != nullptr){
+				delete *tcp_ack_search;
+			}
+			tcp_ack_ctx.insert_or_assign(sid, tcp_ack);
+		}
+		moved.clear();
+		pending.store(false, memory_order_relaxed);
+	}
+
+	~tcp_ack_handoff(){
+		for (auto& [sid, tcp_ack]: moved){
+			delete tcp_ack;
+		}
+	}
+};
 
 
 struct stream_ctx {
@@ -247,29 +368,50 @@ struct stream_ctx {
 
 	void clean_stream_by_id(stream_id sid){
 		auto stream_search = streams_ctx.find(sid);
-		if (stream_search != streams_ctx.end()){
-			auto stream_match = stream_search->second;
-			delete stream_match;
-			streams_ctx.erase(stream_search->first);
+		if (stream_search != nullptr){
+			delete *stream_search;
+			streams_ctx.erase(sid);
 		}
 	}
 
 	void clean_tcp_ack_by_id(stream_id sid){
 		auto tcp_ack_search = tcp_ack_ctx.find(sid);
-		if (tcp_ack_search != tcp_ack_ctx.end()){
-			auto tcp_ack = tcp_ack_search->second;
-			delete tcp_ack;
-			tcp_ack_ctx.erase(tcp_ack_search->first);
+		if (tcp_ack_search != nullptr){
+			delete *tcp_ack_search;
+			tcp_ack_ctx.erase(sid);
 		}
 	}
 
-	void clean(){
-		for (auto ele: streams_ctx){
-			delete ele.second;
+	/*
+	Releases the filter state of the streams matching the predicate (e.g. the streams moved to another worker).
+	Their tcp_ack contexts are removed from the worker and returned: the offsets of a mangled connection are still
+	needed to fix its next packets.
+	*/
+	vector<pair<stream_id, NfQueue::tcp_ack_seq_ctx*>> release_streams_if(const function<bool(const stream_id&)>& predicate){
+		vector<stream_id> to_clean;
+		streams_ctx.for_each([&](const stream_id& sid, pyfilter_ctx*){
+			if (predicate(sid)) to_clean.push_back(sid);
+		});
+		for (auto& sid: to_clean){
+			clean_stream_by_id(sid);
 		}
-		for (auto ele: tcp_ack_ctx){
-			delete ele.second;
+		vector<pair<stream_id, NfQueue::tcp_ack_seq_ctx*>> released;
+		tcp_ack_ctx.for_each([&](const stream_id& sid, NfQueue::tcp_ack_seq_ctx* tcp_ack){
+			if (predicate(sid)) released.emplace_back(sid, tcp_ack);
+		});
+		for (auto& [sid, tcp_ack]: released){
+			tcp_ack_ctx.erase(sid);
 		}
+		return released;
+	}
+
+	void clean(){
+		streams_ctx.for_each([](const stream_id&, pyfilter_ctx* ctx){
+			delete ctx;
+		});
+		tcp_ack_ctx.for_each([](const stream_id&, NfQueue::tcp_ack_seq_ctx* tcp_ack){
+			delete tcp_ack;
+		});
 		tcp_ack_ctx.clear();
 		streams_ctx.clear();
 	}
@@ -0,0 +1,169 @@
+#ifndef HS_CACHE_CPP
+#define HS_CACHE_CPP
+
+#include <iostream>
+#include <fstream>
+#include <sstream>
+#include <filesystem>
+#include <algorithm>
+#include <cstdlib>
+#include <cstdio>
+#include <string>
+#include <vector>
+#include <hs.h>
+#include <unistd.h>
+
+using namespace std;
+namespace fs = std::filesystem;
+
+namespace Firegex {
+namespace Regex {
+
+/*
+Cache of the compiled hyperscan databases, serialized with hs_serialize_database in FIREGEX_HS_CACHE_DIR
+(the cache is disabled if the variable is not set). The file name is the hash of the cache key, the key
+(hyperscan version, mode and the rules with their flags) is also saved in the file and checked on load.
+The oldest files are removed when there are more than FIREGEX_HS_CACHE_MAX databases (default 64).
+
+File format: | key size (u64, host order) | key | serialized database |
+*/
+
+const size_t DEFAULT_HS_CACHE_MAX = 64;
+const char* HS_CACHE_EXT = ".hsdb";
+
+class HsDatabaseCache {
+	private:
+	string cache_dir;
+	size_t max_entries = DEFAULT_HS_CACHE_MAX;
+
+	static uint64_t fnv1a(const string& data){
+		uint64_t hash = 0xcbf29ce484222325ULL;
+		for (unsigned char c: data){
+			hash ^= c;
+			hash *= 0x100000001b3ULL;
+		}
+		return hash;
+	}
+
+	fs::path entry_path(const string& key){
+		char name[17];
+		snprintf(name, sizeof(name), "%016llx", (unsigned long long)fnv1a(key));
+		return fs::path(cache_dir) / (string(name) + HS_CACHE_EXT);
+	}
+
+	void prune(){
+		vector<pair<fs::file_time_type, fs::path>> entries;
+		error_code ec;
+		for (auto& entry: fs::directory_iterator(cache_dir, ec)){
+			if (entry.path().extension() == HS_CACHE_EXT){
+				entries.push_back(make_pair(entry.last_write_time(ec), entry.path()));
+			}
+		}
+		if (entries.size() <= max_entries) return;
+		sort(entries.begin(), entries.end());
+		for (size_t i = 0; i < entries.size() - max_entries; i++){
+			fs::remove(entries[i].second, ec);
+		}
+	}
+
+	public:
+	HsDatabaseCache(){
+		char* dir = getenv("FIREGEX_HS_CACHE_DIR");
+		if (dir != nullptr && dir[0] != '\0'){
+			cache_dir = dir;
+			error_code ec;
+			fs::create_directories(cache_dir, ec);
+			if (ec){
+				cerr << "[warning] [HsDatabaseCache] can't create " << cache_dir << ": " << ec.message() << ", cache disabled" << endl;
+				cache_dir.clear();
+			}
+		}
+		char* max_str = getenv("FIREGEX_HS_CACHE_MAX");
+		if (max_str != nullptr && ::atoi(max_str) > 0){
+			max_entries = ::atoi(max_str);
+		}
+	}
+
+	bool enabled(){
+		return !cache_dir.empty();
+	}
+
+	// Builds the key of a ruleset: every rule is stored with its flags and id, in compilation order
+	static string make_key(
+		const vector<string>& rules, const vector<unsigned int>& flags, const vector<unsigned int>& ids,
+		unsigned int mode, bool literals
+	){
+		ostringstream key;
+		key << hs_version() << '\n' << mode << (literals ? " literals" : "") << '\n';
+		for (size_t i = 0; i < rules.size(); i++){
+			key << flags[i] << ':' << ids[i] << ':' << rules[i].size() << ':' << rules[i] << '\n';
+		}
+		return key.str();
+	}
+
+	// Returns nullptr if the database is not cached (or can't be loaded)
+	hs_database_t* load(const string& key){
+		if (!enabled()) return nullptr;
+		fs::path path = entry_path(key);
+		ifstream file(path, ios::binary);
+		if (!file) return nullptr;
+		uint64_t key_size = 0;
+		file.read((char*)&key_size, sizeof(key_size));
+		if (!file || key_size != key.size()) return nullptr;
+		string stored_key(key_size, '\0');
+		file.read(stored_key.data(), key_size);
+		if (!file || stored_key != key) return nullptr;
+		string serialized((istreambuf_iterator<char>(file)), istreambuf_iterator<char>());
+		hs_database_t* db = nullptr;
+		if (hs_deserialize_database(serialized.data(), serialized.size(), &db) != HS_SUCCESS){
+			cerr << "[warning] [HsDatabaseCache.load] invalid cached database " << path << ", removing it" << endl;
+			error_code ec;
+			fs::remove(path, ec);
+			return nullptr;
+		}
+		error_code ec;
+		fs::last_write_time(path, fs::file_time_type::clock::now(), ec); // Used as last access time by prune
+		return db;
+	}
+
+	void store(const string& key, const hs_database_t* db){
+		if (!enabled()) return;
+		char* serialized = nullptr;
+		size_t serialized_size = 0;
+		if (hs_serialize_database(db, &serialized, &serialized_size) != HS_SUCCESS){
+			cerr << "[warning] [HsDatabaseCache.store] failed to serialize the database" << endl;
+			return;
+		}
+		fs::path path = entry_path(key);
+		fs::path tmp_path = path;
+		tmp_path += ".tmp" + to_string(getpid());
+		bool written;
+		{
+			ofstream file(tmp_path, ios::binary | ios::trunc);
+			uint64_t key_size = key.size();
+			file.write((char*)&key_size, sizeof(key_size));
+			file.write(key.data(), key.size());
+			file.write(serialized, serialized_size);
+			file.close();
+			written = !file.fail();
+		}
+		free(serialized);
+		error_code ec;
+		if (!written){
+			cerr << "[warning] [HsDatabaseCache.store] failed to write " << tmp_path << endl;
+			fs::remove(tmp_path, ec);
+			return;
+		}
+		fs::rename(tmp_path, path, ec); // Atomic replace, a reader never see a partial file
+		if (ec){
+			fs::remove(tmp_path, ec);
+			return;
+		}
+		prune();
+	}
+};
+
+HsDatabaseCache hs_cache;
+
+}}
+#endif // HS_CACHE_CPP
@@ -3,11 +3,15 @@
 
 #include <iostream>
 #include <cstring>
+#include <cctype>
 #include <sstream>
 #include "../utils.cpp"
 #include <vector>
 #include <hs.h>
 #include <memory>
+#include <atomic>
+#include <algorithm>
+#include "hs_cache.cpp"
 
 using namespace std;
 
@@ -20,11 +24,60 @@ struct decoded_regex {
 	string regex;
 	FilterDirection direction;
 	bool is_case_sensitive;
+	uint32_t index = 0;
 };
 
 struct regex_ruleset {
-	hs_database_t* hs_db = nullptr;
+	hs_database_t* lit_db = nullptr; // literal rules (hs_compile_lit_multi), scanned first
+	hs_database_t* hs_db = nullptr; // all the other rules
 	vector<string> regexes;
+	vector<uint32_t> indexes; // position of the rule in the configuration sent by the backend
+
+	inline bool empty() const {
+		return lit_db == nullptr && hs_db == nullptr;
+	}
+};
+
+// Returns true if the regex matches only a fixed string (saved in literal): no metacharacters, only escapes of symbols
+bool regex_literal(const string& regex, string& literal){
+	literal.clear();
+	for (size_t i = 0; i < regex.size(); i++){
+		char c = regex[i];
+		if (c == '\\'){
+			if (++i == regex.size() || isalnum((unsigned char)regex[i])){
+				return false; // \d, \x41, \b... are not literals
+			}
+			c = regex[i];
+		}else if (strchr("^$.|?*+()[]{}", c) != nullptr){
+			return false;
+		}
+		if (c == '\0'){
+			return false; // hs_compile reads the regex until the first null byte
+		}
+		literal.push_back(c);
+	}
+	return !literal.empty();
+}
+
+// Allocates the scratch or grows it (only if too small) to be used also with the databases of the ruleset
+void inline scratch_grow(regex_ruleset &conf, hs_scratch_t* & scratch){
+	for (hs_database_t* db : {conf.lit_db, conf.hs_db}){
+		if (db != nullptr && hs_alloc_scratch(db, &scratch) != HS_SUCCESS) {
+			throw invalid_argument("Cannot alloc scratch");
+		}
+	}
+}
+
+void inline scratch_setup(regex_ruleset &conf, hs_scratch_t* & scratch){
+	if (scratch == nullptr){
+		scratch_grow(conf, scratch);
+	}
+}
+
+// Scratch spaces of a worker for the rulesets of a configuration
+struct worker_scratches {
+	hs_scratch_t* input = nullptr;
+	hs_scratch_t* output = nullptr;
 };
 
 decoded_regex decode_regex(string regex){
@@ -59,13 +112,13 @@ class RegexRules{
 	public:
 		regex_ruleset output_ruleset, input_ruleset;
 		
-	static void compile_regex(char* regex){
+	static void compile_regex(const char* regex, bool is_case_sensitive = true){
 		hs_database_t* db = nullptr;
 		hs_compile_error_t *compile_err = nullptr;
 		if (
 			hs_compile(
 				regex,
-				HS_FLAG_SINGLEMATCH | HS_FLAG_ALLOWEMPTY,
+				HS_FLAG_SINGLEMATCH | HS_FLAG_ALLOWEMPTY | (is_case_sensitive ? 0 : HS_FLAG_CASELESS),
 				HS_MODE_BLOCK,
 				nullptr, &db, &compile_err
 			) != HS_SUCCESS
@@ -79,21 +132,79 @@ class RegexRules{
 	}
 
 	private:
-		static inline uint16_t glob_seq = 0;
-		uint16_t version;
+		static inline uint64_t glob_seq = 0;
+		uint64_t seq; // unique id of the configuration, used by the workers to detect updates
+		uint16_t version; // version assigned by the backend, used in the stats records
+		size_t n_rules = 0;
 		vector<pair<string, decoded_regex>> decoded_input_rules;
 		vector<pair<string, decoded_regex>> decoded_output_rules;
 		bool is_stream = true;
+		vector<worker_scratches> scratches; // Prepared for the workers, every worker takes only its own
+
+		static void free_scratch(hs_scratch_t* & scratch){
+			if (scratch != nullptr){
+				hs_free_scratch(scratch);
+				scratch = nullptr;
+			}
+		}
+
+		static void clone_scratch(hs_scratch_t* proto, hs_scratch_t* & scratch){
+			if (proto != nullptr && hs_clone_scratch(proto, &scratch) != HS_SUCCESS){
+				throw invalid_argument("Cannot clone scratch");
+			}
+		}
+
+		void free_scratches(){
+			for (auto& worker : scratches){
+				free_scratch(worker.input);
+				free_scratch(worker.output);
+			}
+			scratches.clear();
+		}
+
+		static void free_db(hs_database_t* & db){
+			if (db != nullptr){
+				hs_free_database(db);
+				db = nullptr;
+			}
+		}
 
 		void free_dbs(){
-			if (output_ruleset.hs_db != nullptr){
-				hs_free_database(output_ruleset.hs_db);
-				output_ruleset.hs_db = nullptr;
+			free_db(output_ruleset.lit_db);
+			free_db(output_ruleset.hs_db);
+			free_db(input_ruleset.lit_db);
+			free_db(input_ruleset.hs_db);
+		}
+
+		// Compiles the rules (from the databases cache if already compiled), returns nullptr if there are no rules
+		hs_database_t* compile_db(const vector<string>& rules, const vector<unsigned int>& flags, const vector<unsigned int>& ids, bool literals){
+			if (rules.empty()){
+				return nullptr;
 			}
-			if (input_ruleset.hs_db != nullptr){
-				hs_free_database(input_ruleset.hs_db);
-				input_ruleset.hs_db = nullptr;
+			unsigned int mode = is_stream?HS_MODE_STREAM:HS_MODE_BLOCK;
+			string cache_key = HsDatabaseCache::make_key(rules, flags, ids, mode, literals);
+			hs_database_t* db = hs_cache.load(cache_key);
+			if (db != nullptr){
+				cerr << "[info] [RegexRules.compile_db] loaded " << rules.size() << (literals ? " literals" : " regexes") << " from the database cache" << endl;
+				return db;
 			}
+			vector<const char*> exprs(rules.size());
+			vector<size_t> lens(rules.size());
+			for (size_t i = 0; i < rules.size(); i++){
+				exprs[i] = rules[i].c_str();
+				lens[i] = rules[i].size();
+			}
+			hs_compile_error_t *compile_err = nullptr;
+			hs_error_t err = literals ?
+				hs_compile_lit_multi(exprs.data(), flags.data(), ids.data(), lens.data(), rules.size(), mode, nullptr, &db, &compile_err) :
+				hs_compile_multi(exprs.data(), flags.data(), ids.data(), rules.size(), mode, nullptr, &db, &compile_err);
+			if (err != HS_SUCCESS) {
+				cerr << "[warning] [RegexRules.compile_db] hs_db failed to compile: '" << compile_err->message << "' skipping..." << endl;
+				hs_free_compile_error(compile_err);
+				throw runtime_error( "Failed to compile hyperscan db" );
+			}
+			hs_cache.store(cache_key, db);
+			return db;
 		}
 		
 		void fill_ruleset(vector<pair<string, decoded_regex>> & decoded, regex_ruleset & ruleset){
@@ -101,55 +212,57 @@ class RegexRules{
 			if (n_of_regex == 0){
 				return;
 			}
-			vector<const char*> regex_match_rules(n_of_regex);
-			vector<unsigned int> regex_array_ids(n_of_regex);
-			vector<unsigned int> regex_flags(n_of_regex);
+			// The backend can send the same rules in a different order, sorting them keeps the cache key stable
+			sort(decoded.begin(), decoded.end(), [](const auto& a, const auto& b){ return a.first < b.first; });
+			// The literal rules are compiled in a separated database (faster to scan), the ids are shared between the databases
+			vector<string> literals, regexes;
+			vector<unsigned int> literal_ids, literal_flags, regex_ids, regex_flags;
+			string literal;
 			for(int i = 0; i < n_of_regex; i++){
-				regex_match_rules[i] = decoded[i].second.regex.c_str();
-				regex_array_ids[i] = i;
-				regex_flags[i] = HS_FLAG_SINGLEMATCH | HS_FLAG_ALLOWEMPTY;
+				unsigned int flags = HS_FLAG_SINGLEMATCH;
 				if (!decoded[i].second.is_case_sensitive){
-					regex_flags[i] |= HS_FLAG_CASELESS;
+					flags |= HS_FLAG_CASELESS;
+				}
+				if (regex_literal(decoded[i].second.regex, literal)){
+					literals.push_back(literal);
+					literal_ids.push_back(i);
+					literal_flags.push_back(flags);
+				}else{
+					regexes.push_back(decoded[i].second.regex);
+					regex_ids.push_back(i);
+					regex_flags.push_back(flags | HS_FLAG_ALLOWEMPTY);
 				}
 			}
 			#ifdef DEBUG
-			cerr << "[DEBUG] [RegexRules.fill_ruleset] compiling " << n_of_regex << " regexes..." << endl;
+			cerr << "[DEBUG] [RegexRules.fill_ruleset] compiling " << literals.size() << " literals and " << regexes.size() << " regexes..." << endl;
 			for (int i = 0; i < n_of_regex; i++){
 				cerr << "[DEBUG] [RegexRules.fill_ruleset] regex[" << i << "]: " << decoded[i].first << " " << decoded[i].second.regex << endl;
-				cerr << "[DEBUG] [RegexRules.fill_ruleset] regex_match_rules[" << i << "]: " << regex_match_rules[i] << endl;
-				cerr << "[DEBUG] [RegexRules.fill_ruleset] regex_flags[" << i << "]: " << regex_flags[i] << endl;
-				cerr << "[DEBUG] [RegexRules.fill_ruleset] regex_array_ids[" << i << "]: " << regex_array_ids[i] << endl;
 			}
 			#endif
-			hs_database_t* rebuilt_db = nullptr;
-			hs_compile_error_t *compile_err = nullptr;
-			if (
-				hs_compile_multi(
-					regex_match_rules.data(),
-					regex_flags.data(),
-					regex_array_ids.data(),
-					n_of_regex,
-					is_stream?HS_MODE_STREAM:HS_MODE_BLOCK,
-					nullptr, &rebuilt_db, &compile_err
-				) != HS_SUCCESS
-			) {
-				cerr << "[warning] [RegexRules.fill_ruleset] hs_db failed to compile: '" << compile_err->message << "' skipping..." << endl;
-				hs_free_compile_error(compile_err);
-				throw runtime_error( "Failed to compile hyperscan db" );
+			ruleset.lit_db = compile_db(literals, literal_flags, literal_ids, true);
+			try{
+				ruleset.hs_db = compile_db(regexes, regex_flags, regex_ids, false);
+			}catch(...){
+				free_db(ruleset.lit_db);
+				throw current_exception();
 			}
-			ruleset.hs_db = rebuilt_db;
 			ruleset.regexes = vector<string>(n_of_regex);
+			ruleset.indexes = vector<uint32_t>(n_of_regex);
 			for(int i = 0; i < n_of_regex; i++){
 				ruleset.regexes[i] = decoded[i].first;
+				ruleset.indexes[i] = decoded[i].second.index;
 			}
 		}
 
 	public:
-		RegexRules(vector<string> raw_rules, bool is_stream){
+		RegexRules(vector<string> raw_rules, bool is_stream, uint16_t version = 0){
 			this->is_stream = is_stream;
-			for(string ele : raw_rules){
+			this->n_rules = raw_rules.size();
+			for(uint32_t i = 0; i < raw_rules.size(); i++){
+				string& ele = raw_rules[i];
 				try{
 					decoded_regex rule = decode_regex(ele);
+					rule.index = i;
 					if (rule.direction == FilterDirection::CTOS){
 						decoded_input_rules.push_back(make_pair(ele, rule));
 					}else{
@@ -166,42 +279,75 @@ class RegexRules{
 				free_dbs();
 				throw current_exception();
 			}
-			this->version = ++glob_seq; // 0 version is the null version
+			this->seq = ++glob_seq; // 0 is the null configuration
+			this->version = version != 0 ? version : (uint16_t)this->seq;
 		}
 
 		u_int16_t ver(){
 			return version;
 		}
 
-		RegexRules(bool is_stream){
-			vector<string> no_rules;
-			RegexRules(no_rules, is_stream);
+		uint64_t id(){
+			return seq;
+		}
+
+		size_t rules_count(){
+			return n_rules;
 		}
 
+		RegexRules(bool is_stream): RegexRules(vector<string>(), is_stream) {}
+
 		bool stream_mode(){
 			return is_stream;
 		}
 
 
 
-		RegexRules(){
-			RegexRules(true);
+		RegexRules(): RegexRules(true) {}
+
+		/*
+		Allocates the scratches of the workers (a clone of a prototype for each worker), called before publishing
+		the configuration: the workers switching to it don't allocate on the packet path.
+		The scratches fit also the databases of the previous configuration, still used by its open streams.
+		*/
+		void prepare_scratches(size_t n_workers, RegexRules* previous = nullptr){
+			if (n_workers == 0){
+				return;
+			}
+			try{
+				scratches.resize(n_workers);
+				scratch_grow(input_ruleset, scratches[0].input);
+				scratch_grow(output_ruleset, scratches[0].output);
+				if (previous != nullptr){
+					scratch_grow(previous->input_ruleset, scratches[0].input);
+					scratch_grow(previous->output_ruleset, scratches[0].output);
+				}
+				for (size_t i = 1; i < n_workers; i++){
+					clone_scratch(scratches[0].input, scratches[i].input);
+					clone_scratch(scratches[0].output, scratches[i].output);
+				}
+			}catch(...){
+				free_scratches();
+				throw current_exception();
+			}
+		}
+
+		// Gives the scratches prepared for the worker to it (empty if not prepared, e.g. worker added later)
+		worker_scratches take_scratches(size_t worker_index){
+			worker_scratches taken;
+			if (worker_index < scratches.size()){
+				swap(taken, scratches[worker_index]);
+			}
+			return taken;
 		}
 		
 		~RegexRules(){
+			free_scratches();
 			free_dbs();
 		}
 };
 
-shared_ptr<RegexRules> regex_config;
-
-void inline scratch_setup(regex_ruleset &conf, hs_scratch_t* & scratch){
-	if (scratch == nullptr && conf.hs_db != nullptr){
-		if (hs_alloc_scratch(conf.hs_db, &scratch) != HS_SUCCESS) {
-			throw invalid_argument("Cannot alloc scratch");
-		}
-	}
-}
+atomic<shared_ptr<RegexRules>> regex_config; // Published by the updater thread, loaded by the workers for every packet
 
 }}
 #endif // REGEX_FILTER_CPP
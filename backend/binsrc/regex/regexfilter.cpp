@@ -17,7 +17,9 @@
 #include <syncstream>
 #include <functional>
 #include <iostream>
+#include <chrono>
 #include "../classes/netfilter.cpp"
+#include "../classes/stats.cpp"
 #include "stream_ctx.cpp"
 #include "regex_rules.cpp"
 #include "../utils.cpp"
@@ -31,26 +33,112 @@ namespace Regex {
 using Tins::TCPIP::Stream;
 using Tins::TCPIP::StreamFollower;
 
+Stats::OutputChannel control_out;
+Stats::StatsReporter stats_reporter(control_out);
+
 class RegexNfQueue : public NfQueue::ThreadNfQueue<RegexNfQueue> {
 public:
 	stream_ctx sctx;
-	u_int16_t latest_config_ver = 0;
+	uint64_t latest_config_id = 0;
+	shared_ptr<RegexRules> config; // Configuration of the new streams
+	// Replaced configurations (by id) with their counters, each one kept until its last stream is closed
+	map<uint64_t, pair<shared_ptr<RegexRules>, shared_ptr<Stats::counters_table>>> older_configs;
 	StreamFollower follower;
 	NfQueue::PktRequest<RegexNfQueue>* pkt;
+	Stats::WorkerCounters counters;
+	chrono::steady_clock::time_point now; // Arrival of the packet handled
+	chrono::steady_clock::time_point last_expire;
+	bool direct_scan = false; // FIREGEX_TCP_DIRECT_SCAN: TCP payloads scanned without the StreamFollower reassembly
+	bool udp_flow = false; // FIREGEX_UDP_FLOW: the datagrams with the same addresses and ports are matched as a stream
+
+	/*
+	Takes the current configuration. The open streams continue on the configuration they started with,
+	whatever the number of updates received before they are closed.
+	*/
+	shared_ptr<RegexRules> sync_config(){
+		shared_ptr<RegexRules> conf = regex_config.load(memory_order_acquire);
+
+		auto current_config_id = conf->id();
+		if (current_config_id != latest_config_id){
+			sctx.switch_config(current_config_id);
+			auto replaced_counters = counters.switch_config(conf->ver(), conf->rules_count(), true);
+			if (config){
+				older_configs[config->id()] = {std::move(config), replaced_counters};
+			}
+			config = conf;
+			sctx.clean_scratches();
+			worker_scratches prepared = conf->take_scratches(worker_index);
+			sctx.in_scratch = prepared.input;
+			sctx.out_scratch = prepared.output;
+			// Already big enough if prepared by the updater, allocated here for the workers added after the update
+			// and for the configurations older than the previous one
+			scratch_grow(conf->input_ruleset, sctx.in_scratch);
+			scratch_grow(conf->output_ruleset, sctx.out_scratch);
+			for (auto& [id, older]: older_configs){
+				scratch_grow(older.first->input_ruleset, sctx.in_scratch);
+				scratch_grow(older.first->output_ruleset, sctx.out_scratch);
+			}
+			latest_config_id = current_config_id;
+			release_older_configs();
+		}
+		return conf;
+	}
+
+	// The databases of a replaced configuration are released with its last stream
+	void release_older_configs(){
+		for (auto it = older_configs.begin(); it != older_configs.end();){
+			if (sctx.streams_on(it->first) == 0){
+				if (it->second.second){
+					counters.release_table(it->second.second);
+				}
+				it = older_configs.erase(it);
+			}else{
+				it++;
+			}
+		}
+	}
+
+	void report_streams(){
+		counters.streams_open(sctx.size(), sctx.streams_on(sctx.config_id));
+		for (auto& [id, older]: older_configs){
+			if (older.second){
+				older.second->streams.store(sctx.streams_on(id), memory_order_relaxed);
+			}
+		}
+	}
 
-	bool filter_action(NfQueue::PktRequest<RegexNfQueue>* pkt, const string& data){
-		shared_ptr<RegexRules> conf = regex_config;
+	bool filter_action(NfQueue::PktRequest<RegexNfQueue>* pkt, string_view data){
+		return scan_data(pkt, data, sync_config());
+	}
 
-		auto current_version = conf->ver();
-		if (current_version != latest_config_ver){
-			sctx.clean();
-			latest_config_ver = current_version;
+	static direction_streams open_streams(const regex_ruleset& ruleset, hs_scratch_t* scratch){
+		direction_streams streams;
+		if (
+			(ruleset.lit_db != nullptr && hs_open_stream(ruleset.lit_db, 0, &streams.literals) != HS_SUCCESS) ||
+			(ruleset.hs_db != nullptr && hs_open_stream(ruleset.hs_db, 0, &streams.regexes) != HS_SUCCESS)
+		) {
+			stream_ctx::close_streams(streams, scratch);
+			cerr << "[error] [filter_callback] Error opening the stream matcher (hs)" << endl;
+			throw invalid_argument("Cannot open stream match on hyperscan");
 		}
-		scratch_setup(conf->input_ruleset, sctx.in_scratch);
-		scratch_setup(conf->output_ruleset, sctx.out_scratch);
-	
-		hs_database_t* regex_matcher = pkt->is_input ? conf->input_ruleset.hs_db : conf->output_ruleset.hs_db;
-		if (regex_matcher == nullptr){
+		return streams;
+	}
+
+	bool scan_data(NfQueue::PktRequest<RegexNfQueue>* pkt, string_view data, const shared_ptr<RegexRules>& conf){
+		// The hyperscan stream is kept between the packets for TCP and for the UDP flows
+		bool keep_stream = pkt->l4_proto == NfQueue::L4Proto::TCP || (udp_flow && pkt->l4_proto == NfQueue::L4Proto::UDP);
+		stream_entry* entry = conf->stream_mode() && keep_stream ? sctx.get_entry(pkt->sid, now) : nullptr;
+		RegexRules* rules = conf.get();
+		Stats::counters_table* rules_counters = nullptr; // The current version
+		if (entry != nullptr && entry->config_id != sctx.config_id){
+			auto older = older_configs.find(entry->config_id);
+			if (older != older_configs.end()){
+				rules = older->second.first.get();
+				rules_counters = older->second.second.get();
+			}
+		}
+		regex_ruleset& ruleset = pkt->is_input ? rules->input_ruleset : rules->output_ruleset;
+		if (ruleset.empty()){
 			return true;
 		}
 		
@@ -59,7 +147,8 @@ public:
 			bool has_matched = false;
 		} match_res;
 
-		hs_error_t err;
+		counters.bytes_scanned(data.size());
+		hs_error_t err = HS_SUCCESS;
 		hs_scratch_t* scratch_space = pkt->is_input ? sctx.in_scratch: sctx.out_scratch;
 		auto match_func = [](unsigned int id, auto from, auto to, auto flags, auto ctx){
 			auto res = (matched_data*)ctx;
@@ -67,46 +156,53 @@ public:
 			res->matched = id;
 			return -1; // Stop matching
 		};
-		hs_stream_t* stream_match;
-		if (conf->stream_mode()){
-			matching_map* match_map = pkt->is_input ? &sctx.in_hs_streams : &sctx.out_hs_streams;
-			auto stream_search = match_map->find(pkt->sid);
-			
-			if (stream_search == match_map->end()){
-				if (hs_open_stream(regex_matcher, 0, &stream_match) != HS_SUCCESS) {
-					cerr << "[error] [filter_callback] Error opening the stream matcher (hs)" << endl;
-					throw invalid_argument("Cannot open stream match on hyperscan");
-				}
-				if (pkt->l4_proto == NfQueue::L4Proto::TCP){
-					match_map->insert_or_assign(pkt->sid, stream_match);
-				}
+		// The literals database is scanned first, the regexes one only if no literal has matched
+		auto scan_db = [&](hs_database_t* db, hs_stream_t* stream){
+			if (db == nullptr || err != HS_SUCCESS){
+				return;
+			}
+			if (conf->stream_mode()){
+				err = hs_scan_stream(
+					stream, data.data(), data.size(),
+					0, scratch_space, match_func, &match_res
+				);
 			}else{
-				stream_match = stream_search->second;
+				err = hs_scan(
+					db, data.data(), data.size(),
+					0, scratch_space, match_func, &match_res
+				);
+			}
+		};
+		if (conf->stream_mode()){
+			if (keep_stream && entry == nullptr){
+				auto [added, evicted] = sctx.entry_for(pkt->sid, now);
+				counters.streams_evicted(evicted);
+				entry = added;
+			}
+			direction_streams* kept = entry == nullptr ? nullptr : pkt->is_input ? &entry->in_streams : &entry->out_streams;
+			direction_streams streams = kept != nullptr && !kept->empty() ? *kept : open_streams(ruleset, scratch_space);
+			if (kept != nullptr){
+				*kept = streams;
+			}
+			scan_db(ruleset.lit_db, streams.literals);
+			scan_db(ruleset.hs_db, streams.regexes);
+			if (!keep_stream){
+				stream_ctx::close_streams(streams, scratch_space);
 			}
-			err = hs_scan_stream(
-				stream_match, data.c_str(), data.size(),
-				0, scratch_space, match_func, &match_res
-			);
 		}else{
-			err = hs_scan(
-				regex_matcher, data.c_str(), data.size(),
-				0, scratch_space, match_func, &match_res
-			);
-		}
-		if (
-			pkt->l4_proto != NfQueue::L4Proto::TCP && conf->stream_mode() && 
-			hs_close_stream(stream_match, scratch_space, nullptr, nullptr) != HS_SUCCESS
-		){
-			cerr << "[error] [filter_callback] Error closing the stream matcher (hs)" << endl;
-			throw invalid_argument("Cannot close stream match on hyperscan");
+			scan_db(ruleset.lit_db, nullptr);
+			scan_db(ruleset.hs_db, nullptr);
 		}
 		if (err != HS_SUCCESS && err != HS_SCAN_TERMINATED) {
 			cerr << "[error] [filter_callback] Error while matching the stream (hs) " << err << endl;
 			throw invalid_argument("Error while matching the stream with hyperscan");
 		}
 		if (match_res.has_matched){
-			auto& rules_vector = pkt->is_input ? conf->input_ruleset.regexes : conf->output_ruleset.regexes;
-			osyncstream(cout) << "BLOCKED " << rules_vector[match_res.matched] << endl;
+			if (stats_reporter.binary()){
+				counters.blocked(ruleset.indexes[match_res.matched], rules_counters);
+			}else{
+				control_out.line("BLOCKED " + ruleset.regexes[match_res.matched]);
+			}
 			return false;
 		}
 		return true;
@@ -117,7 +213,7 @@ public:
         nfq->pkt->reject(); // This is needed because the callback has to take the updated pkt pointer!
 	}
 
-	static void on_data_recv(Stream& stream, RegexNfQueue* nfq, const string& data) {
+	static void on_data_recv(Stream& stream, RegexNfQueue* nfq, string_view data) {
 		if (!nfq->filter_action(nfq->pkt, data)){
 			nfq->sctx.clean_stream_by_id(nfq->pkt->sid);
 			stream.client_data_callback(bind(keep_fin_packet, nfq));
@@ -128,14 +224,14 @@ public:
 
 	//Input data filtering
 	static void on_client_data(Stream& stream, RegexNfQueue* nfq) {
-		auto data = stream.client_payload();
-		on_data_recv(stream, nfq, string((char*)data.data(), data.size()));
+		const auto& data = stream.client_payload();
+		on_data_recv(stream, nfq, string_view((const char*)data.data(), data.size()));
 	}
 
 	//Server data filtering
 	static void on_server_data(Stream& stream, RegexNfQueue* nfq) {
-		auto data = stream.server_payload();
-		on_data_recv(stream, nfq, string((char*)data.data(), data.size()));
+		const auto& data = stream.server_payload();
+		on_data_recv(stream, nfq, string_view((const char*)data.data(), data.size()));
 	}
 
 	// A stream was terminated. The second argument is the reason why it was terminated
@@ -154,8 +250,117 @@ public:
 		stream.stream_closed_callback(bind(on_stream_close, placeholders::_1, nfq));
 	}
 
+	// The idle streams are searched at most once every STREAM_EXPIRE_INTERVAL
+	static constexpr chrono::seconds STREAM_EXPIRE_INTERVAL{1};
+
+	void expire_streams(){
+		if (now - last_expire < STREAM_EXPIRE_INTERVAL){
+			return;
+		}
+		last_expire = now;
+		counters.streams_evicted(sctx.expire(now));
+	}
+
 	void handle_next_packet(NfQueue::PktRequest<RegexNfQueue>* _pkt) override{
         pkt = _pkt; // Setting packet context
+		counters.packet_seen();
+		now = chrono::steady_clock::now();
+		expire_streams();
+		handle_packet();
+		release_older_configs();
+		report_streams();
+	}
+
+	/*
+	Direct scan mode: the payloads in order are scanned straight from the packet (hyperscan streaming mode handles the
+	matches across the segments), only the segments received after a hole are copied until the hole is filled.
+	As with the StreamFollower, a segment after a hole is accepted and scanned when the missing data arrives.
+	*/
+	void handle_tcp_direct(){
+		auto conf = sync_config();
+		auto flags = pkt->tcp->flags();
+		if (flags & Tins::TCP::RST){
+			sctx.clean_stream_by_id(pkt->sid);
+			return pkt->accept();
+		}
+		auto [entry, evicted] = sctx.entry_for(pkt->sid, now);
+		counters.streams_evicted(evicted);
+		if (entry->blocked){
+			// As keep_fin_packet: the connection is closed rejecting its next packets with data
+			if (pkt->data_size() > 0 || (flags & Tins::TCP::FIN)){
+				return pkt->reject();
+			}
+			return pkt->accept();
+		}
+		tcp_direction& dir = pkt->is_input ? entry->in_seq : entry->out_seq;
+		uint32_t seq = pkt->tcp->seq();
+		if (flags & Tins::TCP::SYN){
+			dir = tcp_direction{};
+			dir.synced = true;
+			dir.next_seq = ++seq;
+		}else if (!dir.synced){
+			// Stream already open when first seen: the scan starts from this segment
+			dir.synced = true;
+			dir.next_seq = seq;
+		}
+		if (!scan_segment(dir, seq, string_view(pkt->data(), pkt->data_size()), conf)){
+			sctx.block_stream(pkt->sid);
+			return pkt->reject();
+		}
+		if (flags & Tins::TCP::FIN){
+			dir.fin = true;
+			if (entry->in_seq.fin && entry->out_seq.fin){
+				sctx.clean_stream_by_id(pkt->sid);
+			}
+		}
+		return pkt->accept();
+	}
+
+	// Scans the new data of the segment and the buffered segments that follow it, false if a regex matched
+	bool scan_segment(tcp_direction& dir, uint32_t seq, string_view data, const shared_ptr<RegexRules>& conf){
+		int32_t offset = (int32_t)(seq - dir.next_seq);
+		if (offset > 0){
+			if (!data.empty() && dir.out_of_order.find(seq) == dir.out_of_order.end()){
+				dir.out_of_order.emplace(seq, string(data));
+				dir.buffered += data.size();
+			}
+			if (dir.buffered <= MAX_OUT_OF_ORDER_BYTES){
+				return true;
+			}
+			// Too much data after the hole: the scan restarts from the first buffered segment
+			dir.next_seq = dir.out_of_order.begin()->first;
+		}else if ((size_t)-offset < data.size()){
+			// Retransmitted data already scanned is skipped
+			data.remove_prefix(-offset);
+			if (!scan_data(pkt, data, conf)){
+				return false;
+			}
+			dir.next_seq += data.size();
+		}
+		while (!dir.out_of_order.empty()){
+			auto segment = dir.out_of_order.begin();
+			offset = (int32_t)(segment->first - dir.next_seq);
+			if (offset > 0){
+				break;
+			}
+			string buffered = std::move(segment->second);
+			dir.out_of_order.erase(segment);
+			dir.buffered -= buffered.size();
+			if ((size_t)-offset < buffered.size()){
+				string_view new_data = string_view(buffered).substr(-offset);
+				if (!scan_data(pkt, new_data, conf)){
+					return false;
+				}
+				dir.next_seq += new_data.size();
+			}
+		}
+		return true;
+	}
+
+	void handle_packet(){
+		if (pkt->tcp && direct_scan && regex_config.load(memory_order_acquire)->stream_mode()){
+			return handle_tcp_direct();
+		}
 		if (pkt->tcp){
 			if (pkt->ipv4){
 				follower.process_packet(*pkt->ipv4);
@@ -172,19 +377,44 @@ public:
 			}
 			if(pkt->data_size() == 0){
 				return pkt->accept();
-			}else if (filter_action(pkt, string(pkt->data(), pkt->data_size()))){
+			}else if (filter_action(pkt, string_view(pkt->data(), pkt->data_size()))){
 				return pkt->accept();
 			}else{
+				if (udp_flow){
+					// Only the matching datagram is dropped, the next ones of the flow are matched from scratch
+					sctx.clean_stream_by_id(pkt->sid);
+				}
 				return pkt->drop();
 			}
 		}
 	}
 
 	void before_loop() override{
+		counters.queue_probe = [this]() {
+			return Stats::queue_gauges{queue.size(), queue.full_waits.exchange(0, memory_order_relaxed)};
+		};
+		stats_reporter.register_worker(&counters);
+		sctx.set_workers(n_workers->load());
+		char* direct_scan_str = getenv("FIREGEX_TCP_DIRECT_SCAN");
+		direct_scan = direct_scan_str != nullptr && strcmp(direct_scan_str, "1") == 0;
+		char* udp_flow_str = getenv("FIREGEX_UDP_FLOW");
+		udp_flow = udp_flow_str != nullptr && strcmp(udp_flow_str, "1") == 0;
+		// The connections moved to this worker on resize (or already open) are matched from their next packet
+		follower.follow_partial_streams(true);
 		follower.new_stream_callback(bind(on_new_stream, placeholders::_1, this));
 		follower.stream_termination_callback(bind(on_stream_close, placeholders::_1, this));
 	}
 
+	void on_resize(size_t index, size_t n_active) override{
+		sctx.clean_streams_if([&](const stream_id& sid){
+			return NfQueue::stream_worker_index(sid, n_active) != index;
+		});
+		sctx.set_workers(n_active);
+		counters.streams_evicted(sctx.evict_over_limit());
+		release_older_configs();
+		report_streams();
+	}
+
 	~RegexNfQueue(){
 		sctx.clean();
 	}
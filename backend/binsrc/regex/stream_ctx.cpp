@@ -6,7 +6,14 @@
 #include <hs.h>
 #include <tins/tcp_ip/stream_identifier.h>
 #include <functional>
+#include <list>
 #include <map>
+#include <string>
+#include <chrono>
+#include <algorithm>
+#include <cstdlib>
+#include <vector>
+#include "../classes/stream_map.cpp"
 #include "regexfilter.cpp"
 
 using namespace std;
@@ -15,7 +22,6 @@ namespace Firegex {
 namespace Regex {
 
 typedef Tins::TCPIP::StreamIdentifier stream_id;
-typedef map<stream_id, hs_stream_t*> matching_map;
 
 ostream& operator<<(ostream& os, const Tins::TCPIP::StreamIdentifier::address_type &sid){
 	bool first_print = false;
@@ -33,11 +39,74 @@ ostream& operator<<(ostream& os, const stream_id &sid){
 	return os;
 }
 
+const size_t DEFAULT_MAX_STREAMS = 65536;
+const int DEFAULT_STREAM_TIMEOUT_S = 300;
+
+struct stream_table_settings {
+	size_t max_streams = DEFAULT_MAX_STREAMS; // Of the whole service, 0 = unlimited
+	chrono::seconds idle_timeout{DEFAULT_STREAM_TIMEOUT_S}; // 0 = never expire
+
+	static stream_table_settings from_env(){
+		stream_table_settings settings;
+		char* max_str = getenv("FIREGEX_MAX_STREAMS");
+		if (max_str != nullptr && ::atoll(max_str) >= 0){
+			settings.max_streams = ::atoll(max_str);
+		}
+		char* timeout_str = getenv("FIREGEX_STREAM_TIMEOUT_S");
+		if (timeout_str != nullptr && ::atoi(timeout_str) >= 0){
+			settings.idle_timeout = chrono::seconds(::atoi(timeout_str));
+		}
+		return settings;
+	}
+};
+
+const size_t MAX_OUT_OF_ORDER_BYTES = 256*1024;
+
+// Sequence tracking of a direction of a TCP stream, used only in direct scan mode
+struct tcp_direction {
+	uint32_t next_seq = 0; // First byte not yet scanned
+	bool synced = false;
+	bool fin = false;
+	map<uint32_t, string> out_of_order; // Segments received after a hole, by sequence number
+	size_t buffered = 0;
+};
+
+// Hyperscan streams of a direction, one for each database of the ruleset
+struct direction_streams {
+	hs_stream_t* literals = nullptr;
+	hs_stream_t* regexes = nullptr;
+
+	inline bool empty() const {
+		return literals == nullptr && regexes == nullptr;
+	}
+};
+
+struct stream_entry {
+	direction_streams in_streams;
+	direction_streams out_streams;
+	uint64_t config_id = 0; // Configuration of the hyperscan streams: a connection is matched with a single configuration (0 when blocked)
+	chrono::steady_clock::time_point last_seen;
+	list<stream_id>::iterator lru_pos;
+	tcp_direction in_seq;
+	tcp_direction out_seq;
+	bool blocked = false; // A regex matched: the data of the stream is rejected (direct scan mode)
+};
+
+/*
+Hyperscan streams of the connections handled by a worker.
+The table is bounded: when max_entries is reached the least recently used stream is evicted, and the streams
+idle for more than the timeout are evicted by expire(). A connection evicted (e.g. abandoned without FIN)
+that sends data again restarts the matching on a new hyperscan stream.
+*/
 struct stream_ctx {
-	matching_map in_hs_streams;
-	matching_map out_hs_streams;
+	NfQueue::StreamMap<stream_entry> hs_streams;
+	list<stream_id> lru; // Most recently used first
+	stream_table_settings settings = stream_table_settings::from_env();
+	size_t max_entries = 0; // Share of settings.max_streams of this worker, 0 = unlimited
 	hs_scratch_t* in_scratch = nullptr;
 	hs_scratch_t* out_scratch = nullptr;
+	uint64_t config_id = 0; // Configuration of the new streams
+	map<uint64_t, size_t> config_streams; // Streams on each configuration, a replaced configuration is used until its last stream is closed
 
 	void clean_scratches(){
 		if (out_scratch != nullptr){
@@ -50,49 +119,146 @@ struct stream_ctx {
 		}
 	}
 
-	void clean_stream_by_id(stream_id sid){
-		auto stream_search = in_hs_streams.find(sid);
-		hs_stream_t* stream_match;
-		if (stream_search != in_hs_streams.end()){
-			stream_match = stream_search->second;
-			if (hs_close_stream(stream_match, in_scratch, nullptr, nullptr) != HS_SUCCESS) {
-                cerr << "[error] [NetfilterQueue.clean_stream_by_id] Error closing the stream matcher (hs)" << endl;
-                throw invalid_argument("Cannot close stream match on hyperscan");
-            }
-			in_hs_streams.erase(stream_search);
+	static void close_hs_stream(hs_stream_t* stream, hs_scratch_t* scratch){
+		// The scratch can be null: no callback is called on close
+		if (stream != nullptr && hs_close_stream(stream, scratch, nullptr, nullptr) != HS_SUCCESS) {
+			cerr << "[error] [stream_ctx.close_hs_stream] Error closing the stream matcher (hs)" << endl;
+			throw invalid_argument("Cannot close stream match on hyperscan");
 		}
+	}
+
+	static void close_streams(direction_streams& streams, hs_scratch_t* scratch){
+		close_hs_stream(streams.literals, scratch);
+		close_hs_stream(streams.regexes, scratch);
+		streams = direction_streams{};
+	}
 
-		stream_search = out_hs_streams.find(sid);
-		if (stream_search != out_hs_streams.end()){
-			stream_match = stream_search->second;
-			if (hs_close_stream(stream_match, out_scratch, nullptr, nullptr) != HS_SUCCESS) {
-                cerr << "[error] [NetfilterQueue.clean_stream_by_id] Error closing the stream matcher (hs)" << endl;
-                throw invalid_argument("Cannot close stream match on hyperscan");
-            }
-			out_hs_streams.erase(stream_search);
+	// The limit of the service is split between the workers
+	void set_workers(size_t n_workers){
+		max_entries = settings.max_streams == 0 ? 0 : max(size_t(1), settings.max_streams / max(size_t(1), n_workers));
+	}
+
+	inline size_t size() const {
+		return hs_streams.size();
+	}
+
+	// Returns nullptr if the stream is not tracked
+	stream_entry* get_entry(const stream_id& sid, chrono::steady_clock::time_point now){
+		stream_entry* entry = hs_streams.find(sid);
+		if (entry == nullptr){
+			return nullptr;
 		}
+		entry->last_seen = now;
+		lru.splice(lru.begin(), lru, entry->lru_pos);
+		return entry;
 	}
 
-	void clean(){
-		if (in_scratch){
-			for(auto ele: in_hs_streams){
-				if (hs_close_stream(ele.second, in_scratch, nullptr, nullptr) != HS_SUCCESS) {
-					cerr << "[error] [NetfilterQueue.clean_stream_by_id] Error closing the stream matcher (hs)" << endl;
-					throw invalid_argument("Cannot close stream match on hyperscan");
-				}
-			}
-			in_hs_streams.clear();
+	/*
+	Returns the entry of the stream (added if missing) and the number of streams evicted to make space for it.
+	The eviction is done before the insertion: the entry pointer is valid until the next change of the table.
+	*/
+	pair<stream_entry*, size_t> entry_for(const stream_id& sid, chrono::steady_clock::time_point now){
+		size_t evicted = 0;
+		stream_entry* entry = hs_streams.find(sid);
+		if (entry == nullptr){
+			evicted = evict_over_limit(1);
+			entry = hs_streams.try_emplace(sid).first;
+			entry->config_id = config_id;
+			config_streams[config_id]++;
+			lru.push_front(sid);
+			entry->lru_pos = lru.begin();
+		}else{
+			lru.splice(lru.begin(), lru, entry->lru_pos);
 		}
-		
-		if (out_scratch){
-			for(auto ele: out_hs_streams){
-				if (hs_close_stream(ele.second, out_scratch, nullptr, nullptr) != HS_SUCCESS) {
-					cerr << "[error] [NetfilterQueue.clean_stream_by_id] Error closing the stream matcher (hs)" << endl;
-					throw invalid_argument("Cannot close stream match on hyperscan");
-				}
-			}
-			out_hs_streams.clear();
+		entry->last_seen = now;
+		return {entry, evicted};
+	}
+
+	// Evicts the least recently used streams until there is space for new_entries
+	size_t evict_over_limit(size_t new_entries = 0){
+		size_t evicted = 0;
+		while (max_entries != 0 && !lru.empty() && hs_streams.size() + new_entries > max_entries){
+			clean_stream_by_id(lru.back());
+			evicted++;
+		}
+		return evicted;
+	}
+
+	// The hyperscan streams are released, the entry is kept to reject the next data of the stream
+	void block_stream(const stream_id& sid){
+		stream_entry* entry = hs_streams.find(sid);
+		if (entry == nullptr){
+			return;
+		}
+		close_streams(entry->in_streams, in_scratch);
+		close_streams(entry->out_streams, out_scratch);
+		entry->in_seq = entry->out_seq = tcp_direction{};
+		entry->blocked = true;
+		detach_config(*entry); // Not matched anymore, the entry doesn't keep its configuration alive
+	}
+
+	inline size_t streams_on(uint64_t id) const {
+		auto it = config_streams.find(id);
+		return it == config_streams.end() ? 0 : it->second;
+	}
+
+	void detach_config(stream_entry& entry){
+		auto it = config_streams.find(entry.config_id);
+		if (it != config_streams.end() && --it->second == 0){
+			config_streams.erase(it);
+		}
+		entry.config_id = 0;
+	}
+
+	// Evicts the streams idle from more than the timeout, returns the number of evicted streams
+	size_t expire(chrono::steady_clock::time_point now){
+		size_t evicted = 0;
+		if (settings.idle_timeout.count() == 0){
+			return evicted;
+		}
+		while (!lru.empty() && now - hs_streams.find(lru.back())->last_seen > settings.idle_timeout){
+			clean_stream_by_id(lru.back());
+			evicted++;
 		}
+		return evicted;
+	}
+
+	void clean_stream_by_id(stream_id sid){
+		stream_entry* entry = hs_streams.find(sid);
+		if (entry == nullptr){
+			return;
+		}
+		close_streams(entry->in_streams, in_scratch);
+		close_streams(entry->out_streams, out_scratch);
+		detach_config(*entry);
+		lru.erase(entry->lru_pos);
+		hs_streams.erase(sid);
+	}
+
+	// Switches the new streams to another configuration, the open streams (and the blocked ones) are kept as they are
+	void switch_config(uint64_t new_config_id){
+		config_id = new_config_id;
+	}
+
+	// Releases the streams matching the predicate (e.g. the streams moved to another worker)
+	void clean_streams_if(const function<bool(const stream_id&)>& predicate){
+		vector<stream_id> to_clean;
+		hs_streams.for_each([&](const stream_id& sid, stream_entry&){
+			if (predicate(sid)) to_clean.push_back(sid);
+		});
+		for (auto& sid: to_clean){
+			clean_stream_by_id(sid);
+		}
+	}
+
+	void clean(){
+		hs_streams.for_each([&](const stream_id&, stream_entry& entry){
+			close_streams(entry.in_streams, in_scratch);
+			close_streams(entry.out_streams, out_scratch);
+		});
+		hs_streams.clear();
+		lru.clear();
+		config_streams.clear();
 		clean_scratches();
 	}
 };
@@ -3,15 +3,24 @@
 
 #include <string>
 #include <unistd.h>
+#include <atomic>
+#include <memory>
+#include <thread>
 #include <queue>
+#include <mutex>
 #include <condition_variable>
+#include <sys/ioctl.h>
 #include <sys/socket.h>
 #include <sys/un.h>
+#include <poll.h>
 #include <stdexcept>
 #include <cstring>
 #include <iostream>
 #include <cerrno>
 #include <sstream>
+#include <vector>
+#include <pthread.h>
+#include <sched.h>
 
 bool unhexlify(std::string const &hex, std::string &newString) {
    try{
@@ -29,6 +38,32 @@ bool unhexlify(std::string const &hex, std::string &newString) {
    }
 }
 
+// Parses a cpu list in the kernel format (e.g. 0-3,6), invalid items are skipped
+std::vector<int> parse_cpu_list(const char* cpu_list) {
+   std::vector<int> cpus;
+   if (cpu_list == nullptr) return cpus;
+   std::stringstream ss(cpu_list);
+   std::string item;
+   while (std::getline(ss, item, ',')) {
+      int start, end;
+      char sep;
+      std::stringstream item_ss(item);
+      if (!(item_ss >> start) || start < 0) continue;
+      end = start;
+      if (item_ss >> sep && (sep != '-' || !(item_ss >> end) || end < start)) continue;
+      for (int cpu = start; cpu <= end; cpu++) cpus.push_back(cpu);
+   }
+   return cpus;
+}
+
+// Pins the thread to a single cpu, returns false if the cpu can't be used
+bool set_thread_affinity(pthread_t thread, int cpu) {
+   cpu_set_t cpuset;
+   CPU_ZERO(&cpuset);
+   CPU_SET(cpu, &cpuset);
+   return pthread_setaffinity_np(thread, sizeof(cpu_set_t), &cpuset) == 0;
+}
+
 class UnixClientConnection {
 public:
     int sockfd = -1;
@@ -136,31 +171,226 @@ public:
 };
 
 
+/*
+Bounded single producer single consumer ring: only the producer writes tail and only the consumer writes head,
+each side keeps a cached copy of the other index so the shared cache line is read only when the ring
+looks full (producer) or empty (consumer).
+*/
+template<typename T, size_t CAPACITY = 1024> //same of kernel nfqueue max
+class SpscRing
+{
+    static_assert((CAPACITY & (CAPACITY - 1)) == 0, "CAPACITY must be a power of 2");
+private:
+    alignas(64) std::atomic<size_t> head{0};
+    alignas(64) std::atomic<size_t> tail{0};
+    alignas(64) size_t cached_head = 0; // Producer side
+    alignas(64) size_t cached_tail = 0; // Consumer side
+    T buffer[CAPACITY];
+public:
+
+    bool try_push(const T& value)
+    {
+        size_t t = tail.load(std::memory_order_relaxed);
+        if (t - cached_head == CAPACITY) {
+            cached_head = head.load(std::memory_order_acquire);
+            if (t - cached_head == CAPACITY) {
+                return false;
+            }
+        }
+        buffer[t & (CAPACITY - 1)] = value;
+        // seq_cst: ordered with the load of RingQueue::sleeping made by the producer after the push
+        tail.store(t + 1, std::memory_order_seq_cst);
+        return true;
+    }
+    bool try_pop(T& value)
+    {
+        size_t h = head.load(std::memory_order_relaxed);
+        if (h == cached_tail) {
+            cached_tail = tail.load(std::memory_order_seq_cst);
+            if (h == cached_tail) {
+                return false;
+            }
+        }
+        value = buffer[h & (CAPACITY - 1)];
+        head.store(h + 1, std::memory_order_release);
+        return true;
+    }
+    // Approximated if called while the ring is in use (only for gauges)
+    size_t size() const
+    {
+        size_t h = head.load(std::memory_order_relaxed);
+        return tail.load(std::memory_order_relaxed) - h;
+    }
+};
+
+/*
+Queue with many producers and a single consumer built with a SpscRing for each producer
+(the producers are identified by index, set_producers has to be called before using the queue).
+The consumer is woken up only if it's sleeping waiting for data, so a burst of items costs a single wakeup.
+When the ring of a producer is full the producer waits for the consumer (counted in full_waits).
+*/
+template<typename T, size_t RING_CAPACITY = 1024>
+class RingQueue
+{
+private:
+    std::vector<std::unique_ptr<SpscRing<T, RING_CAPACITY>>> rings;
+    size_t next_ring = 0; // Consumer side, the rings are consumed round robin
+    alignas(64) std::atomic<bool> sleeping{false};
+    std::atomic<uint32_t> wakeups{0};
+    std::atomic<bool> woken{false}; // Set by wake(), a wake issued before take waits is not lost
+
+    void notify()
+    {
+        wakeups.fetch_add(1, std::memory_order_seq_cst);
+        wakeups.notify_one();
+    }
+public:
+    std::atomic<uint64_t> full_waits{0};
+
+    void set_producers(size_t n_producers)
+    {
+        rings.clear();
+        for (size_t i = 0; i < n_producers; i++) {
+            rings.push_back(std::make_unique<SpscRing<T, RING_CAPACITY>>());
+        }
+    }
+    void put(size_t producer, const T& value)
+    {
+        auto& ring = *rings[producer];
+        if (!ring.try_push(value)) {
+            full_waits.fetch_add(1, std::memory_order_relaxed);
+            do {
+                notify();
+                std::this_thread::yield();
+            } while (!ring.try_push(value));
+        }
+        if (sleeping.load(std::memory_order_seq_cst)) {
+            notify();
+        }
+    }
+    // Wakes up the consumer if it's waiting in take (also without new items), or makes the next take return
+    void wake()
+    {
+        woken.store(true, std::memory_order_seq_cst);
+        notify();
+    }
+    bool try_take(T& value)
+    {
+        for (size_t i = 0; i < rings.size(); i++) {
+            auto& ring = *rings[next_ring];
+            next_ring = next_ring + 1 == rings.size() ? 0 : next_ring + 1;
+            if (ring.try_pop(value)) {
+                return true;
+            }
+        }
+        return false;
+    }
+    // Waits for an item, returns false if woken up by wake() (the items are left to the next calls)
+    bool take(T& value)
+    {
+        if (try_take(value)) {
+            return true;
+        }
+        uint32_t seen = wakeups.load(std::memory_order_seq_cst);
+        sleeping.store(true, std::memory_order_seq_cst);
+        // A wake() counted in seen is seen in woken, the next ones change wakeups
+        if (woken.exchange(false, std::memory_order_seq_cst)) {
+            sleeping.store(false, std::memory_order_relaxed);
+            return false;
+        }
+        // A producer that pushed before sleeping was set is seen here, the next ones will wake us up
+        if (!try_take(value)) {
+            wakeups.wait(seen, std::memory_order_seq_cst);
+            sleeping.store(false, std::memory_order_relaxed);
+            // Cleared before checking the ring: a wake() issued during the wait is returned, the next ones stay set
+            if (woken.exchange(false, std::memory_order_seq_cst)) {
+                return false;
+            }
+            return try_take(value);
+        }
+        sleeping.store(false, std::memory_order_relaxed);
+        return true;
+    }
+    size_t size() const
+    {
+        size_t total = 0;
+        for (auto& ring : rings) {
+            total += ring->size();
+        }
+        return total;
+    }
+};
+
+/*
+BlockingQueue - the previous transport between the readers and the workers, kept as fallback and for
+A/B benchmarks of the rings (same interface of RingQueue, the producer index is ignored).
+Compile options:
+USE_BLOCKING_QUEUE - use the BlockingQueue (conditional variable, queue and mutex) instead of the SPSC rings
+USE_PIPES_FOR_BLOKING_QUEUE - use the BlockingQueue built with pipes
+*/
+
 #ifdef USE_PIPES_FOR_BLOKING_QUEUE
 
 template<typename T>
 class BlockingQueue
 {
 private:
-      int pipefd[2];
+    int pipefd[2];
+    bool woken = false; // Consumer side, a wake item has been read by try_take
 public:
-   BlockingQueue(){
-      if (pipe(pipefd) == -1) {
-         throw std::runtime_error("pipe");
-      }
-   }
+    std::atomic<uint64_t> full_waits{0}; // Not measured by the pipes
+
+    BlockingQueue(){
+        if (pipe(pipefd) == -1) {
+            throw std::runtime_error("pipe");
+        }
+    }
+
+    void set_producers(size_t) {}
 
-    void put(T new_value)
+    void put(size_t, T new_value)
     {
         if (write(pipefd[1], &new_value, sizeof(T)) == -1) {
             throw std::runtime_error("write");
         }
     }
-    void take(T& value)
+    // Wakes up the consumer if it's waiting in take, written as an empty item
+    void wake()
+    {
+        put(0, T{});
+    }
+    bool try_take(T& value)
+    {
+        pollfd pfd = { pipefd[0], POLLIN, 0 };
+        if (poll(&pfd, 1, 0) <= 0) {
+            return false;
+        }
+        if (read(pipefd[0], &value, sizeof(T)) == -1) {
+            throw std::runtime_error("read");
+        }
+        if (value == T{}) {
+            woken = true;
+            return false;
+        }
+        return true;
+    }
+    // Waits for an item, returns false if woken up by wake() without new items
+    bool take(T& value)
     {
+        if (woken) {
+            woken = false;
+            return false;
+        }
         if (read(pipefd[0], &value, sizeof(T)) == -1) {
             throw std::runtime_error("read");
         }
+        return value != T{};
+    }
+    size_t size() const
+    {
+        int bytes = 0;
+        ioctl(pipefd[0], FIONREAD, &bytes);
+        return bytes / sizeof(T);
     }
 };
 
@@ -170,42 +400,80 @@ template<typename T, int MAX = 1024> //same of kernel nfqueue max
 class BlockingQueue
 {
 private:
-    std::mutex mut;
+    mutable std::mutex mut;
     std::queue<T> private_std_queue;
     std::condition_variable condNotEmpty;
     std::condition_variable condNotFull;
-    size_t count; // Guard with Mutex
+    size_t count = 0; // Guard with Mutex
+    bool woken = false; // Guard with Mutex
 public:
+    std::atomic<uint64_t> full_waits{0};
+
+    void set_producers(size_t) {}
 
-    void put(T new_value)
+    void put(size_t, T new_value)
     {
-      
         std::unique_lock<std::mutex> lk(mut);
+        if (count == MAX) {
+            full_waits.fetch_add(1, std::memory_order_relaxed);
+        }
         //Condition takes a unique_lock and waits given the false condition
-        condNotFull.wait(lk,[this]{
-            if (count == MAX) {
-               return false;
-            }else{
-               return true;
-            }
-            
-        });
+        condNotFull.wait(lk,[this]{ return count != MAX; });
         private_std_queue.push(new_value);
         count++;
         condNotEmpty.notify_one();
     }
-    void take(T& value)
+    // Wakes up the consumer if it's waiting in take (also without new items)
+    void wake()
+    {
+        std::unique_lock<std::mutex> lk(mut);
+        woken = true;
+        condNotEmpty.notify_one();
+    }
+    bool try_take(T& value)
+    {
+        std::unique_lock<std::mutex> lk(mut);
+        if (private_std_queue.empty()) {
+            return false;
+        }
+        value=private_std_queue.front();
+        private_std_queue.pop();
+        count--;
+        condNotFull.notify_one();
+        return true;
+    }
+    // Waits for an item, returns false if woken up by wake() without new items
+    bool take(T& value)
     {
         std::unique_lock<std::mutex> lk(mut);
-         //Condition takes a unique_lock and waits given the false condition
-        condNotEmpty.wait(lk,[this]{return !private_std_queue.empty();});
+        //Condition takes a unique_lock and waits given the false condition
+        condNotEmpty.wait(lk,[this]{return !private_std_queue.empty() || woken;});
+        woken = false;
+        if (private_std_queue.empty()) {
+            return false;
+        }
         value=private_std_queue.front();
         private_std_queue.pop();
         count--;
         condNotFull.notify_one();
+        return true;
+    }
+    size_t size() const
+    {
+        std::unique_lock<std::mutex> lk(mut);
+        return count;
     }
 };
 
 #endif
 
+// Queue of the packets sent by the readers to a worker
+#if defined(USE_BLOCKING_QUEUE) || defined(USE_PIPES_FOR_BLOKING_QUEUE)
+template<typename T>
+using WorkerQueue = BlockingQueue<T>;
+#else
+template<typename T>
+using WorkerQueue = RingQueue<T>;
+#endif
+
 #endif // UTILS_CPP
\ No newline at end of file
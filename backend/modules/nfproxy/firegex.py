@@ -6,8 +6,10 @@ import traceback
 from fastapi import HTTPException
 import time
 from utils import run_func
-from utils import DEBUG
+from utils import DEBUG, STATS_PROTO, STATS_BATCH_MS
 from utils import nicenessify
+from utils.affinity import CPU_AFFINITY_AUTO, cpu_allocator, parse_cpu_list, format_cpu_list
+from utils.stats import STATS_FRAME_MAGIC, FrameType, WorkerStats, read_stats_frame, prune_config_versions
 
 nft = FiregexTables()
 
@@ -37,6 +39,9 @@ class FiregexInterceptor:
         self.expection_function = None
         self.outstrem_task: asyncio.Task
         self.outstrem_buffer = ""
+        self.config_ver = 0
+        self.config_versions: dict[int, list[PyFilter]] = {}
+        self.worker_stats = WorkerStats()
     
     @classmethod
     async def start(cls, srv: Service, outstream_func=None, exception_func=None):
@@ -84,6 +89,16 @@ class FiregexInterceptor:
             if self.outstrem_function:
                 await run_func(self.outstrem_function, self.srv.id, out_data)
     
+    def _threads(self) -> int:
+        """Workers of the binary: the service setting or the global NTHREADS"""
+        return self.srv.threads or int(os.getenv("NTHREADS","1"))
+
+    def _cpu_affinity(self) -> str:
+        """Cpus where the binary threads are pinned (empty for no pinning)"""
+        if self.srv.cpu_affinity == CPU_AFFINITY_AUTO:
+            return format_cpu_list(cpu_allocator.acquire(f"nfproxy:{self.srv.id}", self._threads()))
+        return format_cpu_list(parse_cpu_list(self.srv.cpu_affinity))
+
     async def _start_binary(self):
         proxy_binary_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../cpproxy"))
         self.process = await asyncio.create_subprocess_exec(
@@ -91,9 +106,19 @@ class FiregexInterceptor:
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.STDOUT,
             env={
-                "NTHREADS": os.getenv("NTHREADS","1"),
+                "NTHREADS": str(self._threads()),
+                "NQUEUES": os.getenv("NQUEUES", str(self._threads())),
                 "FIREGEX_NFQUEUE_FAIL_OPEN": "1" if self.srv.fail_open else "0",
-                "FIREGEX_NFPROXY_SOCK": self.sock_path
+                "FIREGEX_CPU_AFFINITY": self._cpu_affinity(),
+                "FIREGEX_NFQUEUE_BATCH_SIZE": str(self.srv.batch_size),
+                "FIREGEX_NFQUEUE_BATCH_LATENCY_US": str(self.srv.batch_latency),
+                "FIREGEX_NFPROXY_SOCK": self.sock_path,
+                "FIREGEX_PY_GC_THRESHOLDS": self.srv.gc_thresholds,
+                "FIREGEX_PY_GC_EVERY_PACKETS": str(self.srv.gc_every_packets),
+                "FIREGEX_PY_GC_INTERVAL_MS": str(self.srv.gc_interval_ms),
+                "FIREGEX_PY_GC_ON_IDLE": "1" if self.srv.gc_on_idle else "0",
+                "FIREGEX_STATS_PROTO": STATS_PROTO,
+                "FIREGEX_STATS_BATCH_MS": str(STATS_BATCH_MS),
             },
         )
         nicenessify(-10, self.process.pid)
@@ -108,7 +133,7 @@ class FiregexInterceptor:
         line = line_fut.decode()
         if line.startswith("QUEUE "):
             params = line.split()
-            return (int(params[1]), int(params[1]))
+            return (int(params[1]), int(params[-1]))
         else:
             self.process.kill()
             raise Exception("Invalid binary output")
@@ -123,11 +148,45 @@ class FiregexInterceptor:
         self.sock_writer = writer
         self.sock_conn_lock.release()
 
+    async def _exception_raised(self):
+        self.last_time_exception = int(time.time()*1000) #ms timestamp
+        if self.expection_function:
+            await run_func(self.expection_function, self.srv.id, self.last_time_exception)
+
+    async def _read_stats_frame(self):
+        frame_type, ver, records = await read_stats_frame(self.sock_reader)
+        if frame_type == FrameType.WORKER_GAUGES:
+            self.worker_stats.update_gauges(records)
+            return
+        if frame_type == FrameType.STREAM_VERSIONS:
+            self.worker_stats.update_stream_versions(records)
+            # The counters of the released versions are sent before this frame
+            prune_config_versions(self.config_versions, self.config_ver, self.worker_stats.version_streams)
+            return
+        if frame_type == FrameType.WORKER_GC:
+            self.worker_stats.update_gc(records)
+            return
+        if frame_type == FrameType.WORKER_COUNTERS:
+            self.worker_stats.update(records)
+            if any(exceptions for _, _, exceptions in records):
+                await self._exception_raised()
+            return
+        filters = self.config_versions.get(ver, [])
+        for filter_index, blocked, mangled in records:
+            if filter_index < len(filters):
+                filters[filter_index].blocked_packets += blocked
+                filters[filter_index].edited_packets += mangled
+                await filters[filter_index].update()
+
     async def update_stats(self):
         try:
             while True:
                 try:
-                    line = (await self.sock_reader.readuntil()).decode()
+                    first_byte = await self.sock_reader.readexactly(1)
+                    if first_byte == STATS_FRAME_MAGIC:
+                        await self._read_stats_frame()
+                        continue
+                    line = (first_byte + await self.sock_reader.readuntil()).decode()
                 except Exception as e:
                     self.ack_arrived = False
                     self.ack_status = False
@@ -149,9 +208,7 @@ class FiregexInterceptor:
                             self.filter_map[filter_name].edited_packets+=1
                             await self.filter_map[filter_name].update()
                 if line.startswith("EXCEPTION"):
-                    self.last_time_exception = int(time.time()*1000) #ms timestamp
-                    if self.expection_function:
-                        await run_func(self.expection_function, self.srv.id, self.last_time_exception)
+                    await self._exception_raised()
                 if line.startswith("ACK "):
                     self.ack_arrived = True
                     self.ack_status = line.split()[1].upper() == "OK"
@@ -174,23 +231,49 @@ class FiregexInterceptor:
             os.remove(self.sock_path)
         if self.process and self.process.returncode is None:
             self.process.kill()
+        cpu_allocator.release(f"nfproxy:{self.srv.id}")
     
+    async def _send_config(self, code) -> bool:
+        """Sends a message to the binary, returns if it was applied (the caller handles the failure)"""
+        self.sock_writer.write(len(code).to_bytes(4, byteorder='big')+code.encode())
+        await self.sock_writer.drain()
+        try:
+            async with asyncio.timeout(3):
+                await self.ack_lock.acquire()
+        except TimeoutError:
+            self.ack_fail_what = "Queue response timed-out"
+            return False
+        return self.ack_arrived and self.ack_status
+
     async def _update_config(self, code):
         async with self.update_config_lock:
             if self.sock_writer:
-                self.sock_writer.write(len(code).to_bytes(4, byteorder='big')+code.encode())
-                await self.sock_writer.drain()
-                try:
-                    async with asyncio.timeout(3):
-                        await self.ack_lock.acquire()
-                except TimeoutError:
-                    self.ack_fail_what = "Queue response timed-out"
-                if not self.ack_arrived or not self.ack_status:
+                if not await self._send_config(code):
                     await self.stop()
                     raise HTTPException(status_code=500, detail=f"NFQ error: {self.ack_fail_what}")
             else:
                 raise HTTPException(status_code=400, detail="Socket not ready")
 
+    async def resize(self, threads:int) -> bool:
+        """
+        Apply a new number of threads to the running binary, only the streams of the added/removed workers are moved.
+        Returns False if the binary didn't apply it: the previous threads setting is kept and the binary keeps running
+        """
+        async with self.update_config_lock:
+            if not self.sock_writer:
+                return False
+            old_threads, self.srv.threads = self.srv.threads, threads
+            # Messages starting with ! are control commands for cpproxy (they can't be valid python code)
+            # In auto mode the cpus are allocated again for the new number of threads, the binary pins its threads on them
+            try:
+                applied = await self._send_config(f"!THREADS {self._threads()} {self._cpu_affinity()}".rstrip())
+            except OSError:
+                traceback.print_exc()
+                applied = False
+            if not applied:
+                self.srv.threads = old_threads
+            return applied
+
     async def reload(self, filters:list[PyFilter]):
         async with self.filter_map_lock:
             if os.path.exists(f"db/nfproxy_filters/{self.srv.id}.py"):
@@ -198,11 +281,19 @@ class FiregexInterceptor:
                     filter_file = f.read()
             else:
                 filter_file = ""
+            filters = list(filters)
             self.filter_map = {ele.name: ele for ele in filters}
+            self.config_ver = self.config_ver % 0xffff + 1 # 0 is the null version
+            self.config_versions.pop(self.config_ver, None) # Kept in send order
+            self.config_versions[self.config_ver] = filters
+            # The old versions are dropped when the workers stop reporting them (their streams can still be handled)
+            if STATS_PROTO != "binary":
+                prune_config_versions(self.config_versions, self.config_ver)
             await self._update_config(
                 filter_file + "\n\n" +
                 "__firegex_pyfilter_enabled = [" + ", ".join([repr(f.name) for f in filters]) + "]\n" +
                 "__firegex_proto = " + repr(self.srv.proto) + "\n" +
+                "__firegex_config_ver = " + str(self.config_ver) + "\n" +
                 "import firegex.nfproxy.internals\n" + 
                 "firegex.nfproxy.internals.compile(globals())\n"
             )
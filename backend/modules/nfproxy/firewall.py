@@ -84,6 +84,19 @@ class ServiceManager:
         await self.stop()
         await self.start()
 
+    async def resize(self, threads:int):
+        """Apply a new number of threads, the service is restarted if the running binary can't resize its workers"""
+        async with self.lock:
+            if self.interceptor and await self.interceptor.resize(threads):
+                return
+            old_threads, self.srv.threads = self.srv.threads, threads
+            if self.interceptor:
+                try:
+                    await self.restart()
+                except Exception:
+                    self.srv.threads = old_threads # Not saved: the service is left stopped with the previous setting
+                    raise
+
     async def update_filters(self):
         async with self.lock:
             await self._update_filters_from_db()
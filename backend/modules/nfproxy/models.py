@@ -8,6 +8,14 @@ class Service:
         proto: str,
         ip_int: str,
         fail_open: bool,
+        batch_size: int = 1,
+        batch_latency: int = 500,
+        cpu_affinity: str = "",
+        threads: int = 0,
+        gc_thresholds: str = "",
+        gc_every_packets: int = 0,
+        gc_interval_ms: int = 0,
+        gc_on_idle: bool = True,
         **other,
     ):
         self.id = service_id
@@ -17,6 +25,14 @@ class Service:
         self.proto = proto
         self.ip_int = ip_int
         self.fail_open = fail_open
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.cpu_affinity = cpu_affinity
+        self.threads = threads
+        self.gc_thresholds = gc_thresholds
+        self.gc_every_packets = gc_every_packets
+        self.gc_interval_ms = gc_interval_ms
+        self.gc_on_idle = gc_on_idle
 
     @classmethod
     def from_dict(cls, var: dict):
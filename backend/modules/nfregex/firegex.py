@@ -4,25 +4,66 @@ from modules.nfregex.models import Service, Regex
 import os
 import asyncio
 import traceback
-from utils import DEBUG
+from utils import DEBUG, STATS_PROTO, STATS_BATCH_MS
+from utils.stats import STATS_FRAME_MAGIC, FrameType, WorkerStats, read_stats_frame, prune_config_versions
 from fastapi import HTTPException
 from utils import nicenessify
+from utils.affinity import CPU_AFFINITY_AUTO, cpu_allocator, parse_cpu_list, format_cpu_list
 
 nft = FiregexTables()
 
-async def test_regex_validity(regex: str) -> bool:
-    proxy_binary_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),"../cppregex")
-    process = await asyncio.create_subprocess_exec(
-        proxy_binary_path,
-        stdout=asyncio.subprocess.PIPE,
-        stdin=asyncio.subprocess.DEVNULL,
-        env={"FIREGEX_TEST_REGEX": regex},
-    )
-    await process.wait()
-    if process.returncode != 0:
-        message = (await process.stdout.read()).decode()
-        return False, message
-    return True, "ok"
+HS_CACHE_DIR = "db/nfregex_hs_cache" # Compiled hyperscan databases, reused by cppregex for already seen rulesets
+
+class RegexValidator:
+    """Long-lived cppregex process used to check the regexes compilation, a batch is checked in a single round trip"""
+
+    def __init__(self):
+        self.process: asyncio.subprocess.Process|None = None
+        self.lock = asyncio.Lock()
+
+    async def _start(self):
+        if self.process and self.process.returncode is None:
+            return
+        proxy_binary_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),"../cppregex")
+        self.process = await asyncio.create_subprocess_exec(
+            proxy_binary_path,
+            stdout=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.PIPE,
+            env={"FIREGEX_REGEX_VALIDATOR": "1"},
+        )
+
+    async def validate(self, regexes:list[tuple[bytes, bool]]) -> list[tuple[bool, str]]:
+        """Check a list of (regex, is_case_sensitive), returns a (valid, message) for each regex"""
+        if not regexes:
+            return []
+        async with self.lock:
+            await self._start()
+            try:
+                rules = [("1" if is_case_sensitive else "0") + "C" + regex.hex() for regex, is_case_sensitive in regexes]
+                self.process.stdin.write((" ".join(rules)+"\n").encode())
+                await self.process.stdin.drain()
+                results = []
+                for _ in rules:
+                    line = (await self.process.stdout.readuntil()).decode().rstrip("\n")
+                    if line == "OK":
+                        results.append((True, "ok"))
+                    else:
+                        results.append((False, line.removeprefix("FAIL ")))
+                return results
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                await self.stop()
+                raise Exception("Regex validator process terminated unexpectedly") from e
+
+    async def stop(self):
+        if self.process and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        self.process = None
+
+regex_validator = RegexValidator()
+
+async def test_regex_validity(regex: bytes, is_case_sensitive: bool = True) -> tuple[bool, str]:
+    return (await regex_validator.validate([(regex, is_case_sensitive)]))[0]
 
 class RegexFilter:
     def __init__(
@@ -64,9 +105,9 @@ class RegexFilter:
         if self.output_mode:
             yield case_sensitive + "S" + self.regex.hex()
     
-    async def update(self):
+    async def update(self, delta:int = 1):
         if self.update_func:
-            await run_func(self.update_func, self)
+            await run_func(self.update_func, self, delta)
 
 class FiregexInterceptor:
     
@@ -82,29 +123,55 @@ class FiregexInterceptor:
         self.ack_status = None
         self.ack_fail_what = "Queue response timed-out"
         self.ack_lock = asyncio.Lock()
+        self.config_ver = 0
+        self.config_versions: dict[int, list[RegexFilter]] = {}
+        self.worker_stats = WorkerStats()
     
     @classmethod
-    async def start(cls, srv: Service):
+    async def start(cls, srv: Service, filters:list[RegexFilter] = ()):
         self = cls()
         self.srv = srv
         self.filter_map_lock = asyncio.Lock()
         self.update_config_lock = asyncio.Lock()
         queue_range = await self._start_binary()
         self.update_task = asyncio.create_task(self.update_blocked())
-        nft.add(self.srv, queue_range)
         if not self.ack_lock.locked():
             await self.ack_lock.acquire()
+        # The rules are loaded (from the databases cache if already compiled) before sending traffic to the queue
+        await self.reload(filters)
+        nft.add(self.srv, queue_range)
         return self
     
+    def _threads(self) -> int:
+        """Workers of the binary: the service setting or the global NTHREADS"""
+        return self.srv.threads or int(os.getenv("NTHREADS","1"))
+
+    def _cpu_affinity(self) -> str:
+        """Cpus where the binary threads are pinned (empty for no pinning)"""
+        if self.srv.cpu_affinity == CPU_AFFINITY_AUTO:
+            return format_cpu_list(cpu_allocator.acquire(f"nfregex:{self.srv.id}", self._threads()))
+        return format_cpu_list(parse_cpu_list(self.srv.cpu_affinity))
+
     async def _start_binary(self):
         proxy_binary_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),"../cppregex")
         self.process = await asyncio.create_subprocess_exec(
             proxy_binary_path,
             stdout=asyncio.subprocess.PIPE, stdin=asyncio.subprocess.PIPE,
             env={
-                "MATCH_MODE": "stream" if self.srv.proto == "tcp" else "block",
-                "NTHREADS": os.getenv("NTHREADS","1"),
+                "MATCH_MODE": "stream" if self.srv.proto == "tcp" or self.srv.udp_flow else "block",
+                "NTHREADS": str(self._threads()),
+                "NQUEUES": os.getenv("NQUEUES", str(self._threads())),
                 "FIREGEX_NFQUEUE_FAIL_OPEN": "1" if self.srv.fail_open else "0",
+                "FIREGEX_CPU_AFFINITY": self._cpu_affinity(),
+                "FIREGEX_NFQUEUE_BATCH_SIZE": str(self.srv.batch_size),
+                "FIREGEX_NFQUEUE_BATCH_LATENCY_US": str(self.srv.batch_latency),
+                "FIREGEX_MAX_STREAMS": str(self.srv.max_streams),
+                "FIREGEX_STREAM_TIMEOUT_S": str(self.srv.stream_timeout),
+                "FIREGEX_TCP_DIRECT_SCAN": "1" if self.srv.tcp_direct_scan else "0",
+                "FIREGEX_UDP_FLOW": "1" if self.srv.udp_flow else "0",
+                "FIREGEX_STATS_PROTO": STATS_PROTO,
+                "FIREGEX_STATS_BATCH_MS": str(STATS_BATCH_MS),
+                "FIREGEX_HS_CACHE_DIR": os.path.abspath(HS_CACHE_DIR),
             },
         )
         nicenessify(-10, self.process.pid)
@@ -117,15 +184,41 @@ class FiregexInterceptor:
         line = line_fut.decode()
         if line.startswith("QUEUE "):
             params = line.split()
-            return (int(params[1]), int(params[1]))
+            return (int(params[1]), int(params[-1]))
         else:
             self.process.kill()
             raise Exception("Invalid binary output")
 
+    async def _read_stats_frame(self):
+        frame_type, ver, records = await read_stats_frame(self.process.stdout)
+        if frame_type == FrameType.WORKER_GAUGES:
+            self.worker_stats.update_gauges(records)
+            return
+        if frame_type == FrameType.STREAM_VERSIONS:
+            self.worker_stats.update_stream_versions(records)
+            # The counters of the released versions are sent before this frame
+            prune_config_versions(self.config_versions, self.config_ver, self.worker_stats.version_streams)
+            return
+        if frame_type == FrameType.WORKER_GC:
+            self.worker_stats.update_gc(records)
+            return
+        if frame_type == FrameType.WORKER_COUNTERS:
+            self.worker_stats.update(records)
+            return
+        filters = self.config_versions.get(ver, [])
+        for rule_index, blocked, _ in records:
+            if blocked and rule_index < len(filters):
+                filters[rule_index].blocked += blocked
+                await filters[rule_index].update(blocked)
+
     async def update_blocked(self):
         try:
             while True:
-                line = (await self.process.stdout.readuntil()).decode()
+                first_byte = await self.process.stdout.readexactly(1)
+                if first_byte == STATS_FRAME_MAGIC:
+                    await self._read_stats_frame()
+                    continue
+                line = (first_byte + await self.process.stdout.readuntil()).decode()
                 if DEBUG:
                     print(line)
                 if line.startswith("BLOCKED "):
@@ -151,20 +244,52 @@ class FiregexInterceptor:
         self.update_task.cancel()
         if self.process and self.process.returncode is None:
             self.process.kill()
+        cpu_allocator.release(f"nfregex:{self.srv.id}")
     
     async def _update_config(self, filters_codes):
         async with self.update_config_lock:
-            self.process.stdin.write((" ".join(filters_codes)+"\n").encode())
+            self.config_ver = self.config_ver % 0xffff + 1 # 0 is the null version
+            self.config_versions.pop(self.config_ver, None) # Kept in send order
+            self.config_versions[self.config_ver] = [self.filter_map[code] for code in filters_codes]
+            # The old versions are dropped when the workers stop reporting them (their streams can still be matched)
+            if STATS_PROTO != "binary":
+                prune_config_versions(self.config_versions, self.config_ver)
+            self.process.stdin.write((" ".join([f"#{self.config_ver}"]+filters_codes)+"\n").encode())
             await self.process.stdin.drain()
+            await self._wait_ack()
+
+    async def _ack_received(self) -> bool:
+        try:
+            async with asyncio.timeout(3):
+                await self.ack_lock.acquire()
+        except TimeoutError:
+            self.ack_fail_what = "Queue response timed-out"
+            return False
+        return self.ack_arrived and self.ack_status
+
+    async def _wait_ack(self):
+        if not await self._ack_received():
+            await self.stop()
+            raise HTTPException(status_code=500, detail=f"NFQ error: {self.ack_fail_what}")
+
+    async def resize(self, threads:int) -> bool:
+        """
+        Apply a new number of threads to the running binary, only the streams of the added/removed workers are moved.
+        Returns False if the binary didn't apply it: the previous threads setting is kept and the binary keeps running
+        """
+        async with self.update_config_lock:
+            old_threads, self.srv.threads = self.srv.threads, threads
+            # In auto mode the cpus are allocated again for the new number of threads, the binary pins its threads on them
             try:
-                async with asyncio.timeout(3):
-                    await self.ack_lock.acquire()
-            except TimeoutError:
-                self.ack_fail_what = "Queue response timed-out"
-            if not self.ack_arrived or not self.ack_status:
-                await self.stop()
-                raise HTTPException(status_code=500, detail=f"NFQ error: {self.ack_fail_what}")
-            
+                self.process.stdin.write(f"!THREADS {self._threads()} {self._cpu_affinity()}".rstrip().encode()+b"\n")
+                await self.process.stdin.drain()
+                applied = await self._ack_received()
+            except OSError:
+                traceback.print_exc()
+                applied = False
+            if not applied:
+                self.srv.threads = old_threads
+            return applied
 
     async def reload(self, filters:list[RegexFilter]):
         async with self.filter_map_lock:
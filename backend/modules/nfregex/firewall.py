@@ -1,8 +1,10 @@
 import asyncio
+import traceback
 from modules.nfregex.firegex import FiregexInterceptor, RegexFilter
 from modules.nfregex.nftables import FiregexTables, FiregexFilter
 from modules.nfregex.models import Regex, Service
 from utils.sqlite import SQLite
+from utils import STATS_FLUSH_INTERVAL
 
 class STATUS:
     STOP = "stop"
@@ -10,17 +12,93 @@ class STATUS:
 
 nft = FiregexTables()
 
+class StatsAggregator:
+    """Coalesce blocked packets counters in memory and write them on the db in batches"""
+    def __init__(self, db:SQLite, interval:float = STATS_FLUSH_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self.pending: dict[int, int] = {}
+        self.pending_srv: dict[str, int] = {}
+        self.regex_srv: dict[int, str] = {}
+        self.flush_task: asyncio.Task|None = None
+
+    def add(self, srv_id:str, regex_id:int, delta:int = 1):
+        self.pending[regex_id] = self.pending.get(regex_id, 0) + delta
+        self.pending_srv[srv_id] = self.pending_srv.get(srv_id, 0) + delta
+        self.regex_srv[regex_id] = srv_id
+
+    def regex_pending(self, regex_id:int) -> int:
+        return self.pending.get(regex_id, 0)
+
+    def service_pending(self, srv_id:str) -> int:
+        return self.pending_srv.get(srv_id, 0)
+
+    def discard_regex(self, regex_id:int):
+        delta = self.pending.pop(regex_id, 0)
+        srv_id = self.regex_srv.pop(regex_id, None)
+        if srv_id in self.pending_srv:
+            self.pending_srv[srv_id] -= delta
+
+    def discard_service(self, srv_id:str):
+        for regex_id in [k for k, v in self.regex_srv.items() if v == srv_id]:
+            self.pending.pop(regex_id, None)
+            del self.regex_srv[regex_id]
+        self.pending_srv.pop(srv_id, None)
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, regex_srv = self.pending, self.regex_srv
+        self.pending, self.pending_srv, self.regex_srv = {}, {}, {}
+        try:
+            self.db.query_many(
+                "UPDATE regexes SET blocked_packets = blocked_packets + ? WHERE regex_id = ?;",
+                [(delta, regex_id) for regex_id, delta in pending.items()]
+            )
+        except Exception:
+            # The deltas are written by the next flush (with the ones added in the meantime)
+            for regex_id, delta in pending.items():
+                self.add(regex_srv[regex_id], regex_id, delta)
+            raise
+
+    async def _flush_loop(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                self.safe_flush()
+        except asyncio.CancelledError:
+            pass
+
+    def start(self):
+        if not self.flush_task:
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+            self.flush_task = None
+        self.safe_flush()
+
+    def safe_flush(self):
+        """Flush logging a db error: the deltas are kept pending for the next flush"""
+        try:
+            self.flush()
+        except Exception:
+            traceback.print_exc()
+
 
 class ServiceManager:
-    def __init__(self, srv: Service, db):
+    def __init__(self, srv: Service, db, stats: StatsAggregator):
         self.srv = srv
         self.db = db
+        self.stats = stats
         self.status = STATUS.STOP
         self.filters: dict[int, FiregexFilter] = {}
         self.lock = asyncio.Lock()
         self.interceptor = None
     
-    async def _update_filters_from_db(self):
+    def _load_filters_from_db(self):
         regexes = [
             Regex.from_dict(ele) for ele in
                 self.db.query("SELECT * FROM regexes WHERE service_id = ? AND active=1;", self.srv.id)
@@ -37,6 +115,9 @@ class ServiceManager:
             if f not in old_filters:
                 filter = [ele for ele in regexes if ele.id == f][0]
                 self.filters[f] = RegexFilter.from_regex(filter, self._stats_updater)
+
+    async def _update_filters_from_db(self):
+        self._load_filters_from_db()
         if self.interceptor:
             await self.interceptor.reload(self.filters.values())
     
@@ -50,8 +131,8 @@ class ServiceManager:
             if to == STATUS.ACTIVE:
                 await self.restart()
 
-    def _stats_updater(self,filter:RegexFilter):
-        self.db.query("UPDATE regexes SET blocked_packets = ? WHERE regex_id = ?;", filter.blocked, filter.id)
+    def _stats_updater(self, filter:RegexFilter, delta:int):
+        self.stats.add(self.srv.id, filter.id, delta)
 
     def _set_status(self,status):
         self.status = status
@@ -60,8 +141,8 @@ class ServiceManager:
     async def start(self):
         if not self.interceptor:
             nft.delete(self.srv)
-            self.interceptor = await FiregexInterceptor.start(self.srv)
-            await self._update_filters_from_db()
+            self._load_filters_from_db()
+            self.interceptor = await FiregexInterceptor.start(self.srv, self.filters.values())
             self._set_status(STATUS.ACTIVE)
 
     async def stop(self):
@@ -69,12 +150,26 @@ class ServiceManager:
         if self.interceptor:
             await self.interceptor.stop()
             self.interceptor = None
+        self.stats.safe_flush() # A db error doesn't leave the service active without the binary
         self._set_status(STATUS.STOP)
     
     async def restart(self):
         await self.stop()
         await self.start()
 
+    async def resize(self, threads:int):
+        """Apply a new number of threads, the service is restarted if the running binary can't resize its workers"""
+        async with self.lock:
+            if self.interceptor and await self.interceptor.resize(threads):
+                return
+            old_threads, self.srv.threads = self.srv.threads, threads
+            if self.interceptor:
+                try:
+                    await self.restart()
+                except Exception:
+                    self.srv.threads = old_threads # Not saved: the service is left stopped with the previous setting
+                    raise
+
     async def update_filters(self):
         async with self.lock:
             await self._update_filters_from_db()
@@ -84,10 +179,12 @@ class FirewallManager:
         self.db = db
         self.service_table: dict[str, ServiceManager] = {}
         self.lock = asyncio.Lock()
+        self.stats = StatsAggregator(db)
 
     async def close(self):
         for key in list(self.service_table.keys()):
             await self.remove(key)
+        await self.stats.stop()
 
     async def remove(self,srv_id):
         async with self.lock: 
@@ -97,16 +194,25 @@ class FirewallManager:
     
     async def init(self):
         nft.init()
+        self.stats.start()
         await self.reload()
 
     async def reload(self):
         async with self.lock: 
+            starting = {} # service id -> start coroutine
             for srv in self.db.query('SELECT * FROM services;'):
                 srv = Service.from_dict(srv)
                 if srv.id in self.service_table:
                     continue
-                self.service_table[srv.id] = ServiceManager(srv, self.db)
-                await self.service_table[srv.id].next(srv.status)
+                self.service_table[srv.id] = ServiceManager(srv, self.db, self.stats)
+                starting[srv.id] = self.service_table[srv.id].next(srv.status)
+            # Services are started concurrently: with the compiled databases cached the boot is bound by the disk
+            results = await asyncio.gather(*starting.values(), return_exceptions=True)
+            for srv_id, result in zip(starting.keys(), results):
+                if isinstance(result, Exception):
+                    # A failed service doesn't stop the others, it's left stopped (restart sets the stop status first)
+                    print(f"[nfregex] Failed to start the service {srv_id}:")
+                    traceback.print_exception(result)
 
     def get(self,srv_id) -> ServiceManager:
         if srv_id in self.service_table:
@@ -1,7 +1,7 @@
 import base64
 
 class Service:
-    def __init__(self, service_id: str, status: str, port: int, name: str, proto: str, ip_int: str, fail_open: bool, **other):
+    def __init__(self, service_id: str, status: str, port: int, name: str, proto: str, ip_int: str, fail_open: bool, batch_size: int = 1, batch_latency: int = 500, cpu_affinity: str = "", threads: int = 0, max_streams: int = 65536, stream_timeout: int = 300, tcp_direct_scan: bool = False, udp_flow: bool = False, **other):
         self.id = service_id
         self.status = status
         self.port = port
@@ -9,6 +9,14 @@ class Service:
         self.proto = proto
         self.ip_int = ip_int
         self.fail_open = fail_open
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.cpu_affinity = cpu_affinity
+        self.threads = threads
+        self.max_streams = max_streams
+        self.stream_timeout = stream_timeout
+        self.tcp_direct_scan = tcp_direct_scan
+        self.udp_flow = udp_flow
     
     @classmethod
     def from_dict(cls, var: dict):
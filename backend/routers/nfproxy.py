@@ -1,12 +1,13 @@
 import secrets
 import sqlite3
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Response, HTTPException
 from pydantic import BaseModel
 from modules.nfproxy.nftables import FiregexTables
 from modules.nfproxy.firewall import STATUS, FirewallManager
 from utils.sqlite import SQLite
 from utils import ip_parse, refactor_name, socketio_emit, PortType
 from utils.models import ResetRequest, StatusMessageModel
+from utils.affinity import validate_cpu_affinity
 import os
 from firegex.nfproxy.internals import get_filter_names
 from fastapi.responses import PlainTextResponse
@@ -27,6 +28,14 @@ class ServiceModel(BaseModel):
     edited_packets: int
     blocked_packets: int
     fail_open: bool
+    batch_size: int
+    batch_latency: int
+    cpu_affinity: str
+    threads: int
+    gc_thresholds: str
+    gc_every_packets: int
+    gc_interval_ms: int
+    gc_on_idle: bool
 
 class RenameForm(BaseModel):
     name:str
@@ -35,6 +44,14 @@ class SettingsForm(BaseModel):
     port: PortType|None = None
     ip_int: str|None = None
     fail_open: bool|None = None
+    batch_size: int|None = None
+    batch_latency: int|None = None
+    cpu_affinity: str|None = None
+    threads: int|None = None
+    gc_thresholds: str|None = None
+    gc_every_packets: int|None = None
+    gc_interval_ms: int|None = None
+    gc_on_idle: bool|None = None
 
 class PyFilterModel(BaseModel):
     name: str
@@ -49,6 +66,14 @@ class ServiceAddForm(BaseModel):
     proto: str
     ip_int: str
     fail_open: bool = True
+    batch_size: int = 1
+    batch_latency: int = 500
+    cpu_affinity: str = ""
+    threads: int = 0
+    gc_thresholds: str = ""
+    gc_every_packets: int = 0
+    gc_interval_ms: int = 0
+    gc_on_idle: bool = True
 
 class ServiceAddResponse(BaseModel):
     status:str
@@ -69,6 +94,14 @@ db = SQLite('db/nft-pyfilters.db', {
         'l4_proto': 'VARCHAR(3) NOT NULL CHECK (l4_proto IN ("tcp", "udp"))',
         'ip_int': 'VARCHAR(100) NOT NULL',
         'fail_open': 'BOOLEAN NOT NULL CHECK (fail_open IN (0, 1)) DEFAULT 1',
+        'batch_size': 'INT NOT NULL CHECK(batch_size > 0 and batch_size <= 1024) DEFAULT 1',
+        'batch_latency': 'INT NOT NULL CHECK(batch_latency >= 0 and batch_latency <= 1000000) DEFAULT 500',
+        'cpu_affinity': 'VARCHAR(100) NOT NULL DEFAULT ""', # empty = no pinning, auto or a cpu list (e.g. 0-3,6)
+        'threads': 'INT NOT NULL CHECK(threads >= 0 and threads <= 256) DEFAULT 0', # 0 = global NTHREADS
+        'gc_thresholds': 'VARCHAR(100) NOT NULL DEFAULT ""', # empty = python defaults, or gen0,gen1,gen2 as gc.set_threshold
+        'gc_every_packets': 'INT NOT NULL CHECK(gc_every_packets >= 0) DEFAULT 0', # 0 = disabled
+        'gc_interval_ms': 'INT NOT NULL CHECK(gc_interval_ms >= 0) DEFAULT 0', # 0 = disabled
+        'gc_on_idle': 'BOOLEAN NOT NULL CHECK (gc_on_idle IN (0, 1)) DEFAULT 1',
     },
     'pyfilter': {
         'name': 'VARCHAR(100) NOT NULL',
@@ -120,6 +153,20 @@ async def shutdown():
     db.disconnect()
     db.restore()
 
+def validate_gc_thresholds(value: str) -> str:
+    """Normalize the gc_thresholds setting of a service: empty (python defaults) or up to 3 thresholds as gc.set_threshold"""
+    value = value.replace(" ", "")
+    if value == "":
+        return value
+    thresholds = value.split(",")
+    if len(thresholds) > 3 or not all(t.isdigit() and int(t) <= 1000000 for t in thresholds):
+        raise ValueError("Invalid gc thresholds")
+    return ",".join(str(int(t)) for t in thresholds)
+
+def gc_never_runs(gc_thresholds: str, gc_every_packets: int, gc_interval_ms: int, gc_on_idle: bool) -> bool:
+    """The automatic collection is disabled (first threshold 0) and no collection is forced: the filters memory is never released"""
+    return gc_thresholds.split(",")[0] == "0" and not gc_every_packets and not gc_interval_ms and not gc_on_idle
+
 def gen_service_id():
     while True:
         res = secrets.token_hex(8)
@@ -147,6 +194,14 @@ async def get_service_list():
             s.proto proto,
             s.ip_int ip_int,
             s.fail_open fail_open,
+            s.batch_size batch_size,
+            s.batch_latency batch_latency,
+            s.cpu_affinity cpu_affinity,
+            s.threads threads,
+            s.gc_thresholds gc_thresholds,
+            s.gc_every_packets gc_every_packets,
+            s.gc_interval_ms gc_interval_ms,
+            s.gc_on_idle gc_on_idle,
             COUNT(f.name) n_filters,
             COALESCE(SUM(f.blocked_packets),0) blocked_packets,
             COALESCE(SUM(f.edited_packets),0) edited_packets
@@ -166,6 +221,14 @@ async def get_service_by_id(service_id: str):
             s.proto proto,
             s.ip_int ip_int,
             s.fail_open fail_open,
+            s.batch_size batch_size,
+            s.batch_latency batch_latency,
+            s.cpu_affinity cpu_affinity,
+            s.threads threads,
+            s.gc_thresholds gc_thresholds,
+            s.gc_every_packets gc_every_packets,
+            s.gc_interval_ms gc_interval_ms,
+            s.gc_on_idle gc_on_idle,
             COUNT(f.name) n_filters,
             COALESCE(SUM(f.blocked_packets),0) blocked_packets,
             COALESCE(SUM(f.edited_packets),0) edited_packets
@@ -216,7 +279,7 @@ async def service_rename(service_id: str, form: RenameForm):
 
 @app.put('/services/{service_id}/settings', response_model=StatusMessageModel)
 async def service_settings(service_id: str, form: SettingsForm):
-    """Request to change the settings of a specific service (will cause a restart)"""
+    """Request to change the settings of a specific service (will cause a restart, except for a threads only change)"""
     
     if form.port is not None and (form.port < 1 or form.port > 65535):
         raise HTTPException(status_code=400, detail="Invalid port")
@@ -227,6 +290,33 @@ async def service_settings(service_id: str, form: SettingsForm):
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid address")
     
+    if form.batch_size is not None and (form.batch_size < 1 or form.batch_size > 1024):
+        raise HTTPException(status_code=400, detail="Invalid batch size")
+    
+    if form.batch_latency is not None and (form.batch_latency < 0 or form.batch_latency > 1000000):
+        raise HTTPException(status_code=400, detail="Invalid batch latency")
+    
+    if form.threads is not None and (form.threads < 0 or form.threads > 256):
+        raise HTTPException(status_code=400, detail="Invalid number of threads")
+    
+    if form.cpu_affinity is not None:
+        try:
+            form.cpu_affinity = validate_cpu_affinity(form.cpu_affinity)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cpu affinity")
+    
+    if form.gc_thresholds is not None:
+        try:
+            form.gc_thresholds = validate_gc_thresholds(form.gc_thresholds)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid gc thresholds")
+    
+    if form.gc_every_packets is not None and form.gc_every_packets < 0:
+        raise HTTPException(status_code=400, detail="Invalid gc packets interval")
+    
+    if form.gc_interval_ms is not None and form.gc_interval_ms < 0:
+        raise HTTPException(status_code=400, detail="Invalid gc time interval")
+    
     keys = []
     values = []
     
@@ -237,15 +327,29 @@ async def service_settings(service_id: str, form: SettingsForm):
     if len(keys) == 0:
         raise HTTPException(status_code=400, detail="No settings to change provided")
     
-    try:
-        db.query(f'UPDATE services SET {", ".join([f"{key}=?" for key in keys])} WHERE service_id = ?;', *values, service_id)
-    except sqlite3.IntegrityError:
-        raise HTTPException(status_code=400, detail="A service with these settings already exists")
+    current = db.query('SELECT * FROM services WHERE service_id = ?;', service_id)
+    if len(current) == 0:
+        raise HTTPException(status_code=400, detail="This service does not exists!")
+    changed = [key for key, value in zip(keys, values) if current[0][key] != value]
     
-    old_status = firewall.get(service_id).status
-    await firewall.remove(service_id)
-    await firewall.reload()
-    await firewall.get(service_id).next(old_status)
+    gc_policy = {key: current[0][key] for key in ("gc_thresholds", "gc_every_packets", "gc_interval_ms", "gc_on_idle")}
+    gc_policy.update({key: value for key, value in zip(keys, values) if key in gc_policy})
+    if gc_never_runs(**gc_policy):
+        raise HTTPException(status_code=400, detail="The garbage collector would never run")
+    
+    if changed == ["threads"]:
+        # The running binary resizes its workers keeping the streams state, the setting is saved once applied
+        await firewall.get(service_id).resize(form.threads)
+        db.query('UPDATE services SET threads = ? WHERE service_id = ?;', form.threads, service_id)
+    else:
+        try:
+            db.query(f'UPDATE services SET {", ".join([f"{key}=?" for key in keys])} WHERE service_id = ?;', *values, service_id)
+        except sqlite3.IntegrityError:
+            raise HTTPException(status_code=400, detail="A service with these settings already exists")
+        old_status = firewall.get(service_id).status
+        await firewall.remove(service_id)
+        await firewall.reload()
+        await firewall.get(service_id).next(old_status)
     
     await refresh_frontend()
     return {'status': 'ok'}
@@ -302,11 +406,32 @@ async def add_new_service(form: ServiceAddForm):
         raise HTTPException(status_code=400, detail="Invalid address")
     if form.proto not in ["tcp", "http"]:
         raise HTTPException(status_code=400, detail="Invalid protocol")
+    if form.batch_size < 1 or form.batch_size > 1024:
+        raise HTTPException(status_code=400, detail="Invalid batch size")
+    if form.batch_latency < 0 or form.batch_latency > 1000000:
+        raise HTTPException(status_code=400, detail="Invalid batch latency")
+    if form.threads < 0 or form.threads > 256:
+        raise HTTPException(status_code=400, detail="Invalid number of threads")
+    try:
+        form.cpu_affinity = validate_cpu_affinity(form.cpu_affinity)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cpu affinity")
+    try:
+        form.gc_thresholds = validate_gc_thresholds(form.gc_thresholds)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid gc thresholds")
+    if form.gc_every_packets < 0:
+        raise HTTPException(status_code=400, detail="Invalid gc packets interval")
+    if form.gc_interval_ms < 0:
+        raise HTTPException(status_code=400, detail="Invalid gc time interval")
+    if gc_never_runs(form.gc_thresholds, form.gc_every_packets, form.gc_interval_ms, form.gc_on_idle):
+        raise HTTPException(status_code=400, detail="The garbage collector would never run")
     srv_id = None
     try:
         srv_id = gen_service_id()
-        db.query("INSERT INTO services (service_id ,name, port, status, proto, ip_int, fail_open, l4_proto) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                    srv_id, refactor_name(form.name), form.port, STATUS.STOP, form.proto, form.ip_int, form.fail_open, convert_protocol_to_l4(form.proto))
+        db.query("INSERT INTO services (service_id ,name, port, status, proto, ip_int, fail_open, l4_proto, batch_size, batch_latency, cpu_affinity, threads, gc_thresholds, gc_every_packets, gc_interval_ms, gc_on_idle) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    srv_id, refactor_name(form.name), form.port, STATUS.STOP, form.proto, form.ip_int, form.fail_open, convert_protocol_to_l4(form.proto), form.batch_size, form.batch_latency, form.cpu_affinity, form.threads,
+                    form.gc_thresholds, form.gc_every_packets, form.gc_interval_ms, form.gc_on_idle)
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="This type of service already exists")
     await firewall.reload()
@@ -368,6 +493,41 @@ async def get_pyfilters_code(service_id: str):
     except FileNotFoundError:
         return ""
 
+@app.get('/metrics', response_class = Response)
+async def metrics():
+    """Aggregate metrics"""
+    stats = db.query("""
+        SELECT
+            s.name service_name,
+            s.status,
+            f.name,
+            f.blocked_packets,
+            f.edited_packets,
+            f.active
+        FROM pyfilter f LEFT JOIN services s ON s.service_id = f.service_id;
+    """)
+    metrics = []
+    def sanitize(s):
+        return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    for stat in stats:
+        props = f'service_name="{sanitize(stat["service_name"])}",filter="{sanitize(stat["name"])}"'
+        metrics.append(f'firegex_blocked_packets{{{props}}} {stat["blocked_packets"]}')
+        metrics.append(f'firegex_edited_packets{{{props}}} {stat["edited_packets"]}')
+        metrics.append(f'firegex_active{{{props}}} {int(stat["active"] and stat["status"] == "active")}')
+    for srv in firewall.service_table.values():
+        if not srv.interceptor:
+            continue
+        for worker, counters in enumerate(srv.interceptor.worker_stats.workers()):
+            props = f'service_name="{sanitize(srv.srv.name)}",worker="{worker}"'
+            metrics.append(f'firegex_packets_total{{{props}}} {counters["packets"]}')
+            metrics.append(f'firegex_bytes_scanned_total{{{props}}} {counters["bytes"]}')
+            metrics.append(f'firegex_exceptions_total{{{props}}} {counters["exceptions"]}')
+            metrics.append(f'firegex_queue_depth{{{props}}} {counters["queue_depth"]}')
+            metrics.append(f'firegex_queue_full_total{{{props}}} {counters["queue_full"]}')
+            metrics.append(f'firegex_gc_collections_total{{{props}}} {counters["gc_collections"]}')
+            metrics.append(f'firegex_gc_seconds_total{{{props}}} {counters["gc_time_us"]/1e6}')
+    return "\n".join(metrics)
+
 #Socket io events
 async def join_outstream(sid, data):
     """Client joins a room."""
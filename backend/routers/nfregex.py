@@ -1,5 +1,6 @@
 from base64 import b64decode
 import secrets
+import shutil
 import sqlite3
 from fastapi import APIRouter, Response, HTTPException
 from pydantic import BaseModel
@@ -8,7 +9,8 @@ from modules.nfregex.firewall import STATUS, FirewallManager
 from utils.sqlite import SQLite
 from utils import ip_parse, refactor_name, socketio_emit, PortType
 from utils.models import ResetRequest, StatusMessageModel
-from modules.nfregex.firegex import test_regex_validity
+from utils.affinity import validate_cpu_affinity
+from modules.nfregex.firegex import test_regex_validity, regex_validator, HS_CACHE_DIR
 
 class ServiceModel(BaseModel):
     status: str
@@ -20,6 +22,14 @@ class ServiceModel(BaseModel):
     n_regex: int
     n_packets: int
     fail_open: bool
+    batch_size: int
+    batch_latency: int
+    cpu_affinity: str
+    threads: int
+    max_streams: int
+    stream_timeout: int
+    tcp_direct_scan: bool
+    udp_flow: bool
 
 class RenameForm(BaseModel):
     name:str
@@ -29,6 +39,14 @@ class SettingsForm(BaseModel):
     proto: str|None = None
     ip_int: str|None = None
     fail_open: bool|None = None
+    batch_size: int|None = None
+    batch_latency: int|None = None
+    cpu_affinity: str|None = None
+    threads: int|None = None
+    max_streams: int|None = None
+    stream_timeout: int|None = None
+    tcp_direct_scan: bool|None = None
+    udp_flow: bool|None = None
 
 class RegexModel(BaseModel):
     regex:str
@@ -46,12 +64,26 @@ class RegexAddForm(BaseModel):
     active: bool|None = None
     is_case_sensitive: bool
 
+class RegexBulkItem(BaseModel):
+    regex: str
+    mode: str
+    active: bool|None = None
+    is_case_sensitive: bool
+
 class ServiceAddForm(BaseModel):
     name: str
     port: PortType
     proto: str
     ip_int: str
     fail_open: bool = False
+    batch_size: int = 1
+    batch_latency: int = 500
+    cpu_affinity: str = ""
+    threads: int = 0
+    max_streams: int = 65536
+    stream_timeout: int = 300
+    tcp_direct_scan: bool = False
+    udp_flow: bool = False
 
 class ServiceAddResponse(BaseModel):
     status:str
@@ -67,7 +99,15 @@ db = SQLite('db/nft-regex.db', {
         'name': 'VARCHAR(100) NOT NULL UNIQUE',
         'proto': 'VARCHAR(3) NOT NULL CHECK (proto IN ("tcp", "udp"))',
         'ip_int': 'VARCHAR(100) NOT NULL',
-        'fail_open': 'BOOLEAN NOT NULL CHECK (fail_open IN (0, 1)) DEFAULT 1'
+        'fail_open': 'BOOLEAN NOT NULL CHECK (fail_open IN (0, 1)) DEFAULT 1',
+        'batch_size': 'INT NOT NULL CHECK(batch_size > 0 and batch_size <= 1024) DEFAULT 1',
+        'batch_latency': 'INT NOT NULL CHECK(batch_latency >= 0 and batch_latency <= 1000000) DEFAULT 500',
+        'cpu_affinity': 'VARCHAR(100) NOT NULL DEFAULT ""', # empty = no pinning, auto or a cpu list (e.g. 0-3,6)
+        'threads': 'INT NOT NULL CHECK(threads >= 0 and threads <= 256) DEFAULT 0', # 0 = global NTHREADS
+        'max_streams': 'INT NOT NULL CHECK(max_streams >= 0 and max_streams <= 10000000) DEFAULT 65536', # 0 = unlimited
+        'stream_timeout': 'INT NOT NULL CHECK(stream_timeout >= 0 and stream_timeout <= 86400) DEFAULT 300', # seconds, 0 = never
+        'tcp_direct_scan': 'BOOLEAN NOT NULL CHECK (tcp_direct_scan IN (0, 1)) DEFAULT 0', # scan the tcp segments without reassembly
+        'udp_flow': 'BOOLEAN NOT NULL CHECK (udp_flow IN (0, 1)) DEFAULT 0', # match the datagrams of a udp flow as a stream
     },
     'regexes': {
         'regex': 'TEXT NOT NULL',
@@ -88,7 +128,18 @@ db = SQLite('db/nft-regex.db', {
 async def refresh_frontend(additional:list[str]=[]):
     await socketio_emit(["nfregex"]+additional)
 
+def live_service_stats(services:list[dict]) -> list[dict]:
+    for srv in services:
+        srv["n_packets"] += firewall.stats.service_pending(srv["service_id"])
+    return services
+
+def live_regex_stats(regexes:list[dict], key:str = "n_packets", id_key:str = "id") -> list[dict]:
+    for regex in regexes:
+        regex[key] += firewall.stats.regex_pending(regex[id_key])
+    return regexes
+
 async def reset(params: ResetRequest):
+    firewall.stats.safe_flush()
     if not params.delete: 
         db.backup()
     await firewall.close()
@@ -96,6 +147,7 @@ async def reset(params: ResetRequest):
     if params.delete:
         db.delete()
         db.init()
+        shutil.rmtree(HS_CACHE_DIR, ignore_errors=True)
     else:
         db.restore()
     try:
@@ -112,8 +164,10 @@ async def startup():
         print("WARNING cannot start firewall:", e)
 
 async def shutdown():
+    firewall.stats.safe_flush()
     db.backup()
     await firewall.close()
+    await regex_validator.stop()
     db.disconnect()
     db.restore()
 
@@ -129,7 +183,7 @@ firewall = FirewallManager(db)
 @app.get('/services', response_model=list[ServiceModel])
 async def get_service_list():
     """Get the list of existent firegex services"""
-    return db.query("""
+    return live_service_stats(db.query("""
         SELECT
             s.service_id service_id,
             s.status status,
@@ -138,11 +192,19 @@ async def get_service_list():
             s.proto proto,
             s.ip_int ip_int,
             s.fail_open fail_open,
+            s.batch_size batch_size,
+            s.batch_latency batch_latency,
+            s.cpu_affinity cpu_affinity,
+            s.threads threads,
+            s.max_streams max_streams,
+            s.stream_timeout stream_timeout,
+            s.tcp_direct_scan tcp_direct_scan,
+            s.udp_flow udp_flow,
             COUNT(r.regex_id) n_regex,
             COALESCE(SUM(r.blocked_packets),0) n_packets
         FROM services s LEFT JOIN regexes r ON s.service_id = r.service_id
         GROUP BY s.service_id;
-    """)
+    """))
 
 @app.get('/services/{service_id}', response_model=ServiceModel)
 async def get_service_by_id(service_id: str):
@@ -156,6 +218,14 @@ async def get_service_by_id(service_id: str):
             s.proto proto,
             s.ip_int ip_int,
             s.fail_open fail_open,
+            s.batch_size batch_size,
+            s.batch_latency batch_latency,
+            s.cpu_affinity cpu_affinity,
+            s.threads threads,
+            s.max_streams max_streams,
+            s.stream_timeout stream_timeout,
+            s.tcp_direct_scan tcp_direct_scan,
+            s.udp_flow udp_flow,
             COUNT(r.regex_id) n_regex,
             COALESCE(SUM(r.blocked_packets),0) n_packets
         FROM services s LEFT JOIN regexes r ON s.service_id = r.service_id
@@ -163,7 +233,7 @@ async def get_service_by_id(service_id: str):
     """, service_id)
     if len(res) == 0:
         raise HTTPException(status_code=400, detail="This service does not exists!")
-    return res[0]
+    return live_service_stats(res)[0]
 
 @app.post('/services/{service_id}/stop', response_model=StatusMessageModel)
 async def service_stop(service_id: str):
@@ -185,6 +255,7 @@ async def service_delete(service_id: str):
     db.query('DELETE FROM services WHERE service_id = ?;', service_id)
     db.query('DELETE FROM regexes WHERE service_id = ?;', service_id)
     await firewall.remove(service_id)
+    firewall.stats.discard_service(service_id)
     await refresh_frontend()
     return {'status': 'ok'}
 
@@ -203,7 +274,7 @@ async def service_rename(service_id: str, form: RenameForm):
 
 @app.put('/services/{service_id}/settings', response_model=StatusMessageModel)
 async def service_settings(service_id: str, form: SettingsForm):
-    """Request to change the settings of a specific service (will cause a restart)"""
+    """Request to change the settings of a specific service (will cause a restart, except for a threads only change)"""
         
     if form.proto is not None and form.proto not in ["tcp", "udp"]:
         raise HTTPException(status_code=400, detail="Invalid protocol")
@@ -217,6 +288,27 @@ async def service_settings(service_id: str, form: SettingsForm):
         except ValueError:
             raise HTTPException(status_code=400, detail="Invalid address")
     
+    if form.batch_size is not None and (form.batch_size < 1 or form.batch_size > 1024):
+        raise HTTPException(status_code=400, detail="Invalid batch size")
+    
+    if form.batch_latency is not None and (form.batch_latency < 0 or form.batch_latency > 1000000):
+        raise HTTPException(status_code=400, detail="Invalid batch latency")
+    
+    if form.threads is not None and (form.threads < 0 or form.threads > 256):
+        raise HTTPException(status_code=400, detail="Invalid number of threads")
+    
+    if form.max_streams is not None and (form.max_streams < 0 or form.max_streams > 10000000):
+        raise HTTPException(status_code=400, detail="Invalid max streams")
+    
+    if form.stream_timeout is not None and (form.stream_timeout < 0 or form.stream_timeout > 86400):
+        raise HTTPException(status_code=400, detail="Invalid stream timeout")
+    
+    if form.cpu_affinity is not None:
+        try:
+            form.cpu_affinity = validate_cpu_affinity(form.cpu_affinity)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cpu affinity")
+    
     keys = []
     values = []
     
@@ -227,15 +319,24 @@ async def service_settings(service_id: str, form: SettingsForm):
     if len(keys) == 0:
         raise HTTPException(status_code=400, detail="No settings to change provided")
     
-    try:
-        db.query(f'UPDATE services SET {", ".join([f"{key}=?" for key in keys])} WHERE service_id = ?;', *values, service_id)
-    except sqlite3.IntegrityError:
-        raise HTTPException(status_code=400, detail="A service with these settings already exists")
+    current = db.query('SELECT * FROM services WHERE service_id = ?;', service_id)
+    if len(current) == 0:
+        raise HTTPException(status_code=400, detail="This service does not exists!")
+    changed = [key for key, value in zip(keys, values) if current[0][key] != value]
     
-    old_status = firewall.get(service_id).status
-    await firewall.remove(service_id)
-    await firewall.reload()
-    await firewall.get(service_id).next(old_status)
+    if changed == ["threads"]:
+        # The running binary resizes its workers keeping the streams state, the setting is saved once applied
+        await firewall.get(service_id).resize(form.threads)
+        db.query('UPDATE services SET threads = ? WHERE service_id = ?;', form.threads, service_id)
+    else:
+        try:
+            db.query(f'UPDATE services SET {", ".join([f"{key}=?" for key in keys])} WHERE service_id = ?;', *values, service_id)
+        except sqlite3.IntegrityError:
+            raise HTTPException(status_code=400, detail="A service with these settings already exists")
+        old_status = firewall.get(service_id).status
+        await firewall.remove(service_id)
+        await firewall.reload()
+        await firewall.get(service_id).next(old_status)
     
     await refresh_frontend()
     return {'status': 'ok'}
@@ -245,12 +346,12 @@ async def get_service_regexe_list(service_id: str):
     """Get the list of the regexes of a service"""
     if not db.query("SELECT 1 FROM services s WHERE s.service_id = ?;", service_id):
         raise HTTPException(status_code=400, detail="This service does not exists!")
-    return db.query("""
+    return live_regex_stats(db.query("""
         SELECT 
             regex, mode, regex_id `id`, service_id,
             blocked_packets n_packets, is_case_sensitive, active
         FROM regexes WHERE service_id = ?;
-    """, service_id)
+    """, service_id))
 
 @app.get('/regexes/{regex_id}', response_model=RegexModel)
 async def get_regex_by_id(regex_id: int):
@@ -263,7 +364,7 @@ async def get_regex_by_id(regex_id: int):
     """, regex_id)
     if len(res) == 0:
         raise HTTPException(status_code=400, detail="This regex does not exists!")
-    return res[0]
+    return live_regex_stats(res)[0]
 
 @app.delete('/regexes/{regex_id}', response_model=StatusMessageModel)
 async def regex_delete(regex_id: int):
@@ -271,6 +372,7 @@ async def regex_delete(regex_id: int):
     res = db.query('SELECT * FROM regexes WHERE regex_id = ?;', regex_id)
     if len(res) != 0:
         db.query('DELETE FROM regexes WHERE regex_id = ?;', regex_id)
+        firewall.stats.discard_regex(regex_id)
         await firewall.get(res[0]["service_id"]).update_filters()
         await refresh_frontend()
     
@@ -299,7 +401,7 @@ async def regex_disable(regex_id: int):
 @app.post('/regexes', response_model=StatusMessageModel)
 async def add_new_regex(form: RegexAddForm):
     """Add a new regex"""
-    regex_correct, message = await test_regex_validity(b64decode(form.regex))
+    regex_correct, message = await test_regex_validity(b64decode(form.regex), form.is_case_sensitive)
     if not regex_correct:
         raise HTTPException(status_code=400, detail=f"Invalid regex: {message}")
     try:
@@ -312,6 +414,57 @@ async def add_new_regex(form: RegexAddForm):
     await refresh_frontend()
     return {'status': 'ok'}
 
+async def insert_regexes(service_id: str, items: list[RegexBulkItem]) -> list[str]:
+    """Validates and inserts the regexes of a service in a single transaction, the service is reloaded once.
+    Returns "ok" or the error for each regex"""
+    results = ["ok"]*len(items)
+    to_validate = []
+    for i, item in enumerate(items):
+        try:
+            to_validate.append((i, b64decode(item.regex, validate=True)))
+        except ValueError:
+            results[i] = "Invalid regex: not base64 encoded"
+    validity = await regex_validator.validate([(regex, items[i].is_case_sensitive) for i, regex in to_validate])
+    to_insert = []
+    for (i, _), (regex_correct, message) in zip(to_validate, validity):
+        if regex_correct:
+            to_insert.append(i)
+        else:
+            results[i] = f"Invalid regex: {message}"
+    errors = db.query_rows("INSERT INTO regexes (service_id, regex, mode, is_case_sensitive, active ) VALUES (?, ?, ?, ?, ?);", [
+        (service_id, items[i].regex, items[i].mode, items[i].is_case_sensitive, True if items[i].active is None else items[i].active)
+        for i in to_insert
+    ])
+    inserted = False
+    for i, error in zip(to_insert, errors):
+        if error is None:
+            inserted = True
+        elif isinstance(error, sqlite3.IntegrityError) and "UNIQUE" in str(error):
+            results[i] = "An identical regex already exists"
+        else:
+            results[i] = f"Invalid regex: {error}"
+    if inserted:
+        await firewall.get(service_id).update_filters()
+        await refresh_frontend()
+    return results
+
+@app.post('/services/{service_id}/regexes/bulk', response_model=list[StatusMessageModel])
+async def import_service_regexes(service_id: str, items: list[RegexBulkItem]):
+    """Add a list of regexes to a service (also the format of the export), the result of each regex is returned in the same order ("ok" or the error)"""
+    if not db.query("SELECT 1 FROM services s WHERE s.service_id = ?;", service_id):
+        raise HTTPException(status_code=400, detail="This service does not exists!")
+    return [{'status': status} for status in await insert_regexes(service_id, items)]
+
+@app.get('/services/{service_id}/regexes/export', response_model=list[RegexBulkItem])
+async def export_service_regexes(service_id: str):
+    """Export the regexes of a service, the result can be imported with the bulk endpoint"""
+    if not db.query("SELECT 1 FROM services s WHERE s.service_id = ?;", service_id):
+        raise HTTPException(status_code=400, detail="This service does not exists!")
+    return db.query("""
+        SELECT regex, mode, is_case_sensitive, active
+        FROM regexes WHERE service_id = ? ORDER BY regex_id;
+    """, service_id)
+
 @app.post('/services', response_model=ServiceAddResponse)
 async def add_new_service(form: ServiceAddForm):
     """Add a new service"""
@@ -321,11 +474,25 @@ async def add_new_service(form: ServiceAddForm):
         raise HTTPException(status_code=400, detail="Invalid address")
     if form.proto not in ["tcp", "udp"]:
         raise HTTPException(status_code=400, detail="Invalid protocol")
+    if form.batch_size < 1 or form.batch_size > 1024:
+        raise HTTPException(status_code=400, detail="Invalid batch size")
+    if form.batch_latency < 0 or form.batch_latency > 1000000:
+        raise HTTPException(status_code=400, detail="Invalid batch latency")
+    if form.threads < 0 or form.threads > 256:
+        raise HTTPException(status_code=400, detail="Invalid number of threads")
+    if form.max_streams < 0 or form.max_streams > 10000000:
+        raise HTTPException(status_code=400, detail="Invalid max streams")
+    if form.stream_timeout < 0 or form.stream_timeout > 86400:
+        raise HTTPException(status_code=400, detail="Invalid stream timeout")
+    try:
+        form.cpu_affinity = validate_cpu_affinity(form.cpu_affinity)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cpu affinity")
     srv_id = None
     try:
         srv_id = gen_service_id()
-        db.query("INSERT INTO services (service_id ,name, port, status, proto, ip_int, fail_open) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                    srv_id, refactor_name(form.name), form.port, STATUS.STOP, form.proto, form.ip_int, form.fail_open)
+        db.query("INSERT INTO services (service_id ,name, port, status, proto, ip_int, fail_open, batch_size, batch_latency, cpu_affinity, threads, max_streams, stream_timeout, tcp_direct_scan, udp_flow) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    srv_id, refactor_name(form.name), form.port, STATUS.STOP, form.proto, form.ip_int, form.fail_open, form.batch_size, form.batch_latency, form.cpu_affinity, form.threads, form.max_streams, form.stream_timeout, form.tcp_direct_scan, form.udp_flow)
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="This type of service already exists")
     await firewall.reload()
@@ -339,6 +506,7 @@ async def metrics():
         SELECT
             s.name,
             s.status,
+            r.regex_id,
             r.regex,
             r.mode,
             r.is_case_sensitive,
@@ -346,6 +514,7 @@ async def metrics():
             r.active
         FROM regexes r LEFT JOIN services s ON s.service_id = r.service_id;
     """)
+    live_regex_stats(stats, key="blocked_packets", id_key="regex_id")
     metrics = []
     def sanitize(s):
         return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -353,4 +522,19 @@ async def metrics():
         props = f'service_name="{sanitize(stat["name"])}",regex="{sanitize(b64decode(stat["regex"]).decode())}",mode="{stat["mode"]}",is_case_sensitive="{stat["is_case_sensitive"]}"'
         metrics.append(f'firegex_blocked_packets{{{props}}} {stat["blocked_packets"]}')
         metrics.append(f'firegex_active{{{props}}} {int(stat["active"] and stat["status"] == "active")}')
+    for srv in firewall.service_table.values():
+        if not srv.interceptor:
+            continue
+        for worker, counters in enumerate(srv.interceptor.worker_stats.workers()):
+            props = f'service_name="{sanitize(srv.srv.name)}",worker="{worker}"'
+            metrics.append(f'firegex_packets_total{{{props}}} {counters["packets"]}')
+            metrics.append(f'firegex_bytes_scanned_total{{{props}}} {counters["bytes"]}')
+            metrics.append(f'firegex_exceptions_total{{{props}}} {counters["exceptions"]}')
+            metrics.append(f'firegex_queue_depth{{{props}}} {counters["queue_depth"]}')
+            metrics.append(f'firegex_queue_full_total{{{props}}} {counters["queue_full"]}')
+            metrics.append(f'firegex_streams{{{props}}} {counters["streams"]}')
+            metrics.append(f'firegex_stream_evictions_total{{{props}}} {counters["evictions"]}')
+        for config_ver, streams in srv.interceptor.worker_stats.version_streams.items():
+            props = f'service_name="{sanitize(srv.srv.name)}",config_version="{config_ver}"'
+            metrics.append(f'firegex_streams_by_config{{{props}}} {streams}')
     return "\n".join(metrics)
@@ -26,6 +26,9 @@ DEBUG = "DEBUG" in sys.argv
 NORELOAD = "NORELOAD" in sys.argv
 FIREGEX_PORT = int(os.getenv("PORT","4444"))
 FIREGEX_HOST = os.getenv("HOST","0.0.0.0")
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL","2")) # seconds between counters writes on the db
+STATS_PROTO = os.getenv("STATS_PROTO","binary") # binary or text, protocol used by the filter binaries to send stats
+STATS_BATCH_MS = int(os.getenv("STATS_BATCH_MS","50")) # aggregation time of the stats in the filter binaries (binary protocol)
 JWT_ALGORITHM: str = "HS256"
 API_VERSION = "{{VERSION_PLACEHOLDER}}" if "{" not in "{{VERSION_PLACEHOLDER}}" else "0.0.0"
 
@@ -0,0 +1,90 @@
+import os
+import glob
+
+# CPU affinity of the filter binaries, sent to them with FIREGEX_CPU_AFFINITY (see binsrc/utils.cpp)
+CPU_AFFINITY_AUTO = "auto"
+
+def parse_cpu_list(value: str) -> list[int]:
+    """Parse a cpu list in the kernel format (e.g. 0-3,6), an empty string means no cpus"""
+    cpus = []
+    for part in value.replace(" ", "").split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            start, end = int(start), int(end)
+            if start < 0 or end < start:
+                raise ValueError(f"Invalid cpu range {part}")
+            cpus.extend(range(start, end+1))
+        else:
+            cpu = int(part)
+            if cpu < 0:
+                raise ValueError(f"Invalid cpu {part}")
+            cpus.append(cpu)
+    return sorted(set(cpus))
+
+def format_cpu_list(cpus: list[int]) -> str:
+    return ",".join(str(cpu) for cpu in cpus)
+
+def validate_cpu_affinity(value: str) -> str:
+    """Normalize the cpu_affinity setting of a service: empty (no pinning), auto or a cpu list"""
+    value = value.strip().lower()
+    if value in ("", CPU_AFFINITY_AUTO):
+        return value
+    cpus = parse_cpu_list(value)
+    available = available_cpus()
+    if not cpus or any(cpu not in available for cpu in cpus):
+        raise ValueError("Cpu not available")
+    return format_cpu_list(cpus)
+
+def available_cpus() -> list[int]:
+    return sorted(os.sched_getaffinity(0))
+
+def numa_nodes() -> list[list[int]]:
+    """Cpus usable by firegex grouped by NUMA node (a single node if the topology is not available)"""
+    available = set(available_cpus())
+    nodes = []
+    for cpulist in sorted(glob.glob("/sys/devices/system/node/node*/cpulist")):
+        try:
+            with open(cpulist) as f:
+                cpus = [cpu for cpu in parse_cpu_list(f.read().strip()) if cpu in available]
+        except (OSError, ValueError):
+            continue
+        if cpus:
+            nodes.append(cpus)
+    return nodes if nodes else [sorted(available)]
+
+class CpuAllocator:
+    """Assign the cpus to the services in auto mode, without overlaps until there are free cpus.
+    The cpus of a service are taken from a single NUMA node when possible."""
+    def __init__(self):
+        self.assigned: dict[str, list[int]] = {}
+
+    def _load(self) -> dict[int, int]:
+        load = {}
+        for cpus in self.assigned.values():
+            for cpu in cpus:
+                load[cpu] = load.get(cpu, 0) + 1
+        return load
+
+    def acquire(self, key: str, count: int) -> list[int]:
+        self.release(key)
+        count = max(count, 1)
+        load = self._load()
+        nodes = numa_nodes()
+        free_nodes = [[cpu for cpu in node if cpu not in load] for node in nodes]
+        # The node with less free cpus that can host the service, to leave space to the next ones
+        fitting = [node for node in free_nodes if len(node) >= count]
+        if fitting:
+            cpus = min(fitting, key=len)[:count]
+        else:
+            # Not enough free cpus: the less loaded cpus of the node with more free cpus
+            node = nodes[max(range(len(nodes)), key=lambda i: len(free_nodes[i]))]
+            cpus = sorted(node, key=lambda cpu: (load.get(cpu, 0), cpu))[:count]
+        self.assigned[key] = sorted(cpus)
+        return self.assigned[key]
+
+    def release(self, key: str):
+        self.assigned.pop(key, None)
+
+cpu_allocator = CpuAllocator()
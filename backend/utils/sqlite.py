@@ -69,6 +69,49 @@ class SQLite():
     def queries(self, queries: list[tuple[str, ...]]):
         return list(self.queries_iter(queries))
 
+    def query_many(self, query: str, values: list[tuple]):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("BEGIN")
+            cur.executemany(query, values)
+            cur.execute("COMMIT")
+        except Exception as e:
+            cur.execute("ROLLBACK")
+            raise e
+        finally:
+            cur.close()
+            try:
+                self.conn.commit()
+            except Exception:
+                pass
+
+    def query_rows(self, query: str, values: list[tuple]) -> list[Exception|None]:
+        """Executes the query for each row in a single transaction: a failing row is rolled back alone and its error returned"""
+        cur = self.conn.cursor()
+        errors = []
+        try:
+            cur.execute("BEGIN")
+            for row in values:
+                cur.execute("SAVEPOINT query_row")
+                try:
+                    cur.execute(query, row)
+                    errors.append(None)
+                except sqlite3.Error as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT query_row")
+                    errors.append(e)
+                cur.execute("RELEASE SAVEPOINT query_row")
+            cur.execute("COMMIT")
+        except Exception as e:
+            cur.execute("ROLLBACK")
+            raise e
+        finally:
+            cur.close()
+            try:
+                self.conn.commit()
+            except Exception:
+                pass
+        return errors
+
     def queries_iter(self, queries: list[tuple[str, ...]]):
         cur = self.conn.cursor()
         try:
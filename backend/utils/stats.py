@@ -0,0 +1,103 @@
+import asyncio
+import struct
+
+# Binary stats frames sent by the filter binaries (see binsrc/classes/stats.cpp)
+STATS_FRAME_MAGIC = b"\x00"
+STATS_FRAME_HEADER = struct.Struct("!BHH") # type, config version, n of records
+
+class FrameType:
+    RULE_COUNTERS = 0x01
+    WORKER_COUNTERS = 0x02
+    WORKER_GAUGES = 0x03
+    STREAM_VERSIONS = 0x04
+    WORKER_GC = 0x05
+
+FRAME_RECORDS = {
+    FrameType.RULE_COUNTERS: struct.Struct("!III"), # rule index, blocked, mangled
+    FrameType.WORKER_COUNTERS: struct.Struct("!QQQ"), # packets, bytes, exceptions
+    FrameType.WORKER_GAUGES: struct.Struct("!QQQQ"), # queue depth, queue full waits, streams, stream evictions
+    FrameType.STREAM_VERSIONS: struct.Struct("!IQ"), # config version, streams
+    FrameType.WORKER_GC: struct.Struct("!QQ"), # collections, gc time in us
+}
+
+async def read_stats_frame(reader: asyncio.StreamReader) -> tuple[int, int, list[tuple[int, ...]]]:
+    """Read a stats frame from the reader, the magic byte has to be already consumed"""
+    frame_type, ver, n_records = STATS_FRAME_HEADER.unpack(await reader.readexactly(STATS_FRAME_HEADER.size))
+    record = FRAME_RECORDS.get(frame_type)
+    if record is None:
+        raise ValueError(f"Unknown stats frame type {frame_type}")
+    records = await reader.readexactly(n_records*record.size)
+    return frame_type, ver, list(record.iter_unpack(records))
+
+class WorkerStats:
+    """Totals of the counters sent by the workers of a filter binary"""
+    def __init__(self):
+        self.packets: list[int] = []
+        self.bytes: list[int] = []
+        self.exceptions: list[int] = []
+        self.queue_depth: list[int] = []
+        self.queue_full: list[int] = []
+        self.streams: list[int] = []
+        self.evictions: list[int] = []
+        self.gc_collections: list[int] = []
+        self.gc_time_us: list[int] = []
+        self.version_streams: dict[int, int] = {} # config version -> streams matched with it
+
+    def _grow(self, n_workers: int):
+        while len(self.packets) < n_workers:
+            self.packets.append(0)
+            self.bytes.append(0)
+            self.exceptions.append(0)
+            self.queue_depth.append(0)
+            self.queue_full.append(0)
+            self.streams.append(0)
+            self.evictions.append(0)
+            self.gc_collections.append(0)
+            self.gc_time_us.append(0)
+
+    def update(self, records: list[tuple[int, int, int]]):
+        self._grow(len(records))
+        for i, (packets, n_bytes, exceptions) in enumerate(records):
+            self.packets[i] += packets
+            self.bytes[i] += n_bytes
+            self.exceptions[i] += exceptions
+
+    def update_gauges(self, records: list[tuple[int, int, int, int]]):
+        self._grow(len(records))
+        for i, (depth, full_waits, streams, evictions) in enumerate(records):
+            self.queue_depth[i] = depth
+            self.queue_full[i] += full_waits
+            self.streams[i] = streams
+            self.evictions[i] += evictions
+
+    def update_gc(self, records: list[tuple[int, int]]):
+        self._grow(len(records))
+        for i, (collections, time_us) in enumerate(records):
+            self.gc_collections[i] += collections
+            self.gc_time_us[i] += time_us
+
+    def update_stream_versions(self, records: list[tuple[int, int]]):
+        self.version_streams = dict(records)
+
+    def workers(self):
+        return [
+            {
+                "packets": self.packets[i], "bytes": self.bytes[i], "exceptions": self.exceptions[i],
+                "queue_depth": self.queue_depth[i], "queue_full": self.queue_full[i],
+                "streams": self.streams[i], "evictions": self.evictions[i],
+                "gc_collections": self.gc_collections[i], "gc_time_us": self.gc_time_us[i],
+            }
+            for i in range(len(self.packets))
+        ]
+
+def prune_config_versions(config_versions: dict[int, list], current: int, alive = ()):
+    """
+    Drop the configuration versions no more used by the workers: the ones sent before the oldest version
+    still in use (the current one or one listed in the last STREAM_VERSIONS frame).
+    config_versions has to be in send order (a reused version is moved at the end), the versions sent after
+    the oldest one in use are kept even if not listed yet (the workers can still take them).
+    """
+    for ver in list(config_versions.keys()):
+        if ver == current or ver in alive:
+            break
+        del config_versions[ver]
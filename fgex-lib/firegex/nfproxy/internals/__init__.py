@@ -1,24 +1,15 @@
 from inspect import signature
 from firegex.nfproxy.internals.models import Action, FullStreamAction
-from firegex.nfproxy.internals.models import FilterHandler, PacketHandlerResult
+from firegex.nfproxy.internals.models import FilterHandler, PacketHandlerResult, FilterCall, DispatchPlan
+from itertools import product
 import functools
+import builtins
+import copy
+import types
 from firegex.nfproxy.internals.data import DataStreamCtx
 from firegex.nfproxy.internals.exceptions import NotReadyToRun, StreamFullReject, DropPacket, RejectConnection, StreamFullDrop
 from firegex.nfproxy.internals.data import RawPacket
 
-def context_call(glob, func, *args, **kargs):
-    glob["__firegex_tmp_args"] = args
-    glob["__firegex_tmp_kargs"] = kargs
-    glob["__firege_tmp_call"] = func
-    res = eval("__firege_tmp_call(*__firegex_tmp_args, **__firegex_tmp_kargs)", glob, glob)
-    if "__firegex_tmp_args" in glob.keys():
-        del glob["__firegex_tmp_args"]
-    if "__firegex_tmp_kargs" in glob.keys():
-        del glob["__firegex_tmp_kargs"]
-    if "__firege_tmp_call" in glob.keys():
-        del glob["__firege_tmp_call"]
-    return res
-
 def generate_filter_structure(filters: list[str], proto:str, glob:dict) -> list[FilterHandler]:
     from firegex.nfproxy.models import type_annotations_associations
     if proto not in type_annotations_associations.keys():
@@ -70,79 +61,93 @@ def get_filters_info(code:str, proto:str) -> list[FilterHandler]:
 def get_filter_names(code:str, proto:str) -> list[str]:
     return [ele.name for ele in get_filters_info(code, proto)]    
 
+def build_dispatch_plan(filters: list[FilterHandler], ctx: DataStreamCtx) -> DispatchPlan:
+    """Assigns a slot to every data model used by the filters (in order of first use), slot 0 is the RawPacket"""
+    slots = {RawPacket: 0}
+    fetchers = [None]
+    calls = []
+    for filter in filters:
+        for data_type, data_func in filter.params.items():
+            if data_type not in slots:
+                slots[data_type] = len(fetchers)
+                fetchers.append(data_func)
+        calls.append(FilterCall(
+            func=filter.func,
+            name=filter.name,
+            slots=tuple(slots[data_type] for data_type in filter.params.keys()),
+            fan_out=any(getattr(data_type, "_fetch_fan_out", False) for data_type in filter.params.keys()),
+        ))
+    return DispatchPlan(ctx=ctx, fetchers=fetchers, calls=calls)
+
+_NOT_FETCHED = object()
+
+def _set_result(glob: dict, action: Action, matched_by: str = None, mangled_packet: bytes = None) -> None:
+    glob["__firegex_pyfilter_result"] = {
+        "action": action.value,
+        "matched_by": matched_by,
+        "mangled_packet": mangled_packet
+    }
+
 def handle_packet(glob: dict) -> None:
-    internal_data = DataStreamCtx(glob)
-    
-    cache_call = {} # Cache of the data handler calls
-    cache_call[RawPacket] = internal_data.current_pkt
+    plan: DispatchPlan = glob["__firegex_pyfilter_ctx"]["dispatch_plan"]
+    internal_data = plan.ctx
+    internal_data.current_pkt = RawPacket._from_packet_info(glob["__firegex_packet_info"])
+    internal_data.call_mem.clear()
+    try:
+        return _dispatch_packet(glob, plan, internal_data)
+    finally:
+        # The context is kept by the stream: the packet has to be released with the handling (else the c++ core
+        # copies it as kept by the filters, see binsrc/pyproxy/packet.cpp)
+        internal_data.current_pkt = None
+        internal_data.call_mem.clear()
 
-    result = PacketHandlerResult(glob)
-    
-    for filter in internal_data.filter_call_info:
-        final_params = []
-        skip_call = False
-        for data_type, data_func in filter.params.items():
-            if data_type not in cache_call.keys():
+def _dispatch_packet(glob: dict, plan: DispatchPlan, internal_data: DataStreamCtx) -> None:
+    fetchers = plan.fetchers
+    # The data models are fetched once per packet, only when a filter needs them (None if not ready)
+    values = [_NOT_FETCHED] * len(fetchers)
+    values[0] = internal_data.current_pkt
+
+    action, matched_by, mangled_packet = Action.ACCEPT, None, None
+    for func, name, slots, fan_out in plan.calls:
+        for slot in slots:
+            value = values[slot]
+            if value is _NOT_FETCHED:
                 try:
-                    cache_call[data_type] = data_func(internal_data)
+                    value = fetchers[slot](internal_data)
                 except NotReadyToRun:
-                    cache_call[data_type] = None
-                    skip_call = True
-                    break
+                    value = None
                 except StreamFullDrop:
-                    result.action = Action.DROP
-                    result.matched_by = "@MAX_STREAM_SIZE_REACHED"
-                    return result.set_result()
+                    return _set_result(glob, Action.DROP, "@MAX_STREAM_SIZE_REACHED")
                 except StreamFullReject:
-                    result.action = Action.REJECT
-                    result.matched_by = "@MAX_STREAM_SIZE_REACHED"
-                    return result.set_result()
+                    return _set_result(glob, Action.REJECT, "@MAX_STREAM_SIZE_REACHED")
                 except DropPacket:
-                    result.action = Action.DROP
-                    result.matched_by = filter.name
-                    return result.set_result()
+                    return _set_result(glob, Action.DROP, name)
                 except RejectConnection:
-                    result.action = Action.REJECT
-                    result.matched_by = filter.name
-                    return result.set_result()
-            if cache_call[data_type] is None:
-                skip_call = True
+                    return _set_result(glob, Action.REJECT, name)
+                values[slot] = value
+            if value is None:
                 break
-            final_params.append(cache_call[data_type])
-            
-        if skip_call:
-            continue
-        
-        # Create an iterator with all the calls to be done
-        def try_to_call(params:list):
-            is_base_call = True
-            for i in range(len(params)):
-                if isinstance(params[i], list):
-                    new_params = params.copy()
-                    for ele in params[i]:
-                        new_params[i] = ele
-                        yield from try_to_call(new_params)
-                    is_base_call = False
-                    break
-            if is_base_call:
-                yield context_call(glob, filter.func, *params)
-                    
-        for res in try_to_call(final_params):
-            if res is None:
-                continue #ACCEPTED
-            if not isinstance(res, Action):
-                raise Exception(f"Invalid return type {type(res)} for function {filter.name}")
-            if res == Action.MANGLE:
-                result.matched_by = filter.name
-                result.mangled_packet = internal_data.current_pkt.raw_packet
-                result.action = Action.MANGLE
-            elif res != Action.ACCEPT:
-                result.matched_by = filter.name
-                result.action = res
-                result.mangled_packet = None
-                return result.set_result()
-    
-    return result.set_result() # Will be MANGLE or ACCEPT
+        else:
+            args = [values[slot] for slot in slots]
+            if fan_out and any(isinstance(arg, list) for arg in args):
+                # A call for each combination of the data models (the first argument changes slowest)
+                calls_args = product(*(arg if isinstance(arg, list) else (arg,) for arg in args))
+            else:
+                calls_args = (args,)
+            for call_args in calls_args:
+                # The filters are defined executing the filter code in glob: they already read and write its globals
+                res = func(*call_args)
+                if res is None:
+                    continue #ACCEPTED
+                if not isinstance(res, Action):
+                    raise Exception(f"Invalid return type {type(res)} for function {name}")
+                if res == Action.MANGLE:
+                    action, matched_by = Action.MANGLE, name
+                    mangled_packet = internal_data.current_pkt.raw_packet
+                elif res != Action.ACCEPT:
+                    return _set_result(glob, res, name)
+
+    return _set_result(glob, action, matched_by, mangled_packet) # Will be MANGLE or ACCEPT
 
 
 def compile(glob:dict) -> None:
@@ -154,6 +159,7 @@ def compile(glob:dict) -> None:
     proto = glob["__firegex_proto"]
     
     internal_data.filter_call_info = generate_filter_structure(filters, proto, glob)
+    internal_data.dispatch_plan = build_dispatch_plan(internal_data.filter_call_info, internal_data)
 
     if "FGEX_STREAM_MAX_SIZE" in glob and int(glob["FGEX_STREAM_MAX_SIZE"]) > 0:
         internal_data.stream_max_size = int(glob["FGEX_STREAM_MAX_SIZE"])
@@ -171,3 +177,148 @@ def compile(glob:dict) -> None:
     
     glob["exit"] = fake_exit
 
+
+def _uses_template(func: types.FunctionType, template: dict, seen: set) -> bool:
+    """The function (or a function in its closure, as the pyfilter wrappers) reads the globals of the template"""
+    if id(func) in seen:
+        return False
+    seen.add(id(func))
+    if func.__globals__ is template:
+        return True
+    for cell in func.__closure__ or ():
+        try:
+            value = cell.cell_contents
+        except ValueError: # empty cell
+            continue
+        if isinstance(value, types.FunctionType) and _uses_template(value, template, seen):
+            return True
+    return False
+
+def _is_template_class(value, template: dict) -> bool:
+    """A class defined by the filter code: its __module__ is the __name__ of the globals it was executed in"""
+    return (
+        isinstance(value, type) and value.__module__ == template.get("__name__", builtins.__name__)
+        and getattr(builtins, value.__name__, None) is not value
+    )
+
+def _clone_value(value, template: dict, memo: dict):
+    if id(value) in memo:
+        return memo[id(value)]
+    if isinstance(value, types.FunctionType):
+        return _clone_function(value, template, memo)
+    if _is_template_class(value, template):
+        return _clone_class(value, template, memo)
+    if isinstance(value, types.ModuleType):
+        return value
+    return copy.deepcopy(value, memo)
+
+def _clone_function(func: types.FunctionType, template: dict, memo: dict) -> types.FunctionType:
+    """Same code of the function bound to the stream globals (memo[id(template)]), the closure and the defaults are cloned too"""
+    if id(func) in memo:
+        return memo[id(func)]
+    # A cell already cloned is shared with a cloned function (e.g. the __class__ cell of a rebuilt class)
+    if not _uses_template(func, template, set()) and not any(id(cell) in memo for cell in func.__closure__ or ()):
+        memo[id(func)] = func
+        return func
+    # The cells are shared by the functions of the same scope, so each one is cloned once
+    cells, to_fill = [], []
+    for cell in func.__closure__ or ():
+        if id(cell) not in memo:
+            memo[id(cell)] = types.CellType()
+            to_fill.append((cell, memo[id(cell)]))
+        cells.append(memo[id(cell)])
+    clone = types.FunctionType(
+        func.__code__,
+        memo[id(template)] if func.__globals__ is template else func.__globals__,
+        func.__name__, None, tuple(cells) or None
+    )
+    memo[id(func)] = clone # Before the closure: a function can be in its own closure
+    for cell, new_cell in to_fill:
+        try:
+            new_cell.cell_contents = _clone_value(cell.cell_contents, template, memo)
+        except ValueError: # empty cell
+            continue
+    # The default values are of the stream: a mutable default can be used to keep a state
+    if func.__defaults__ is not None:
+        clone.__defaults__ = tuple(_clone_value(value, template, memo) for value in func.__defaults__)
+    if func.__kwdefaults__ is not None:
+        clone.__kwdefaults__ = {k: _clone_value(v, template, memo) for k, v in func.__kwdefaults__.items()}
+    clone.__qualname__ = func.__qualname__
+    clone.__module__ = func.__module__
+    clone.__annotations__ = func.__annotations__
+    clone.__dict__.update({k: _clone_value(v, template, memo) for k, v in func.__dict__.items()})
+    return clone
+
+def _clone_member(key: str, value, template: dict, memo: dict):
+    if isinstance(value, (staticmethod, classmethod)):
+        return type(value)(_clone_value(value.__func__, template, memo))
+    if type(value) is property:
+        return property(*(_clone_value(f, template, memo) for f in (value.fget, value.fset, value.fdel)), value.__doc__)
+    if not isinstance(value, types.FunctionType) and (key.startswith("__") and key.endswith("__") or key == "_abc_impl"):
+        return value # Class metadata (e.g. the dataclass fields), not state of the filter
+    return _clone_value(value, template, memo)
+
+def _member_functions(value) -> list:
+    if isinstance(value, (staticmethod, classmethod)):
+        return [value.__func__]
+    if type(value) is property:
+        return [value.fget, value.fset, value.fdel]
+    return [value]
+
+def _clone_class(cls: type, template: dict, memo: dict) -> type:
+    """
+    New class with the same members of a class of the filter code: its methods are bound to the stream globals
+    and its attributes are copied, the instances copied after it are of the new class (copy.deepcopy looks up
+    the class in the memo). Raises an exception if the class can't be created again (e.g. an Enum)
+    """
+    classcell = None # Of the methods using super() or __class__, set by type.__new__ to the new class
+    for value in cls.__dict__.values():
+        for func in _member_functions(value):
+            if isinstance(func, types.FunctionType) and "__class__" in func.__code__.co_freevars:
+                cell = func.__closure__[func.__code__.co_freevars.index("__class__")]
+                classcell = memo[id(cell)] = memo.get(id(cell), types.CellType())
+    slots = cls.__dict__.get("__slots__", ())
+    slots = (slots,) if isinstance(slots, str) else slots
+    namespace = {
+        key: _clone_member(key, value, template, memo) for key, value in cls.__dict__.items()
+        if key not in ("__dict__", "__weakref__") and key not in slots
+    }
+    if classcell is not None:
+        namespace["__classcell__"] = classcell
+    bases = tuple(_clone_value(base, template, memo) for base in cls.__bases__)
+    metaclass = _clone_value(type(cls), template, memo)
+    memo[id(cls)] = metaclass(cls.__name__, bases, namespace)
+    return memo[id(cls)]
+
+def clone(template: dict) -> dict:
+    """
+    Globals of a new stream, copied from the globals of the filter code already executed (and compiled) once.
+    The immutable state (modules, imported classes, code objects) is shared, the functions and the classes of the
+    filter code are created again bound to the new globals and the other values are deep copied, so every stream
+    starts from the state left by the filter code as if it was executed for the stream.
+    Raises an exception if a value can't be copied
+    """
+    glob = {}
+    memo = {id(template): glob}
+    # The functions and the classes first: the values copied after them refer to their clones
+    for value in template.values():
+        if isinstance(value, types.FunctionType) or _is_template_class(value, template):
+            _clone_value(value, template, memo)
+    for key, value in template.items():
+        if key == "__firegex_pyfilter_ctx":
+            continue
+        glob[key] = value if key == "__builtins__" else _clone_value(value, template, memo)
+
+    # The settings set by compile are shared, the filters and the data handlers are of the stream
+    glob["__firegex_pyfilter_ctx"] = {
+        key: value for key, value in template["__firegex_pyfilter_ctx"].items()
+        if key not in ("filter_call_info", "dispatch_plan", "data_handler_context")
+    }
+    internal_data = DataStreamCtx(glob, init_pkt=False)
+    internal_data.filter_call_info = [
+        FilterHandler(func=glob[filter.name], name=filter.name, params=filter.params, proto=filter.proto)
+        for filter in template["__firegex_pyfilter_ctx"]["filter_call_info"]
+    ]
+    internal_data.dispatch_plan = build_dispatch_plan(internal_data.filter_call_info, internal_data)
+    PacketHandlerResult(glob).reset_result()
+    return glob
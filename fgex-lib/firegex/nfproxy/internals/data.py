@@ -1,8 +1,14 @@
-from firegex.nfproxy.internals.models import FilterHandler
+from firegex.nfproxy.internals.models import FilterHandler, DispatchPlan
 from firegex.nfproxy.internals.models import FullStreamAction, ExceptionAction
 
 class RawPacket:
     "class rapresentation of the nfqueue packet sent in python context by the c++ core"
+    # data and raw_packet are requested to the c++ core only when a filter reads them (the packet object copies
+    # them on the first access, or when released if still referenced, so a kept RawPacket is always readable)
+    __slots__ = (
+        "__data", "__raw_packet", "__native", "__is_input", "__is_ipv6", "__is_tcp",
+        "__l4_size", "__raw_packet_header_size",
+    )
     
     def __init__(self,
         data: bytes,
@@ -12,13 +18,46 @@ class RawPacket:
         is_tcp: bool,
         l4_size: int,
     ):
-        self.__data = bytes(data)
-        self.__raw_packet = bytes(raw_packet)
+        self.__data = data
+        self.__raw_packet = raw_packet
+        self.__native = None
         self.__is_input = bool(is_input)
         self.__is_ipv6 = bool(is_ipv6)
         self.__is_tcp = bool(is_tcp)
         self.__l4_size = int(l4_size)
-        self.__raw_packet_header_size = len(self.__raw_packet)-self.__l4_size
+        self.__raw_packet_header_size = len(raw_packet)-self.__l4_size
+    
+    @classmethod
+    def _from_native(cls, native) -> "RawPacket":
+        "RawPacket of a packet object of the c++ core (see binsrc/pyproxy/packet.cpp), its bytes are requested only when read"
+        pkt = cls.__new__(cls)
+        pkt.__data = None
+        pkt.__raw_packet = None
+        pkt.__native = native
+        pkt.__is_input = native.is_input
+        pkt.__is_ipv6 = native.is_ipv6
+        pkt.__is_tcp = native.is_tcp
+        pkt.__l4_size = native.l4_size
+        pkt.__raw_packet_header_size = native.header_size
+        return pkt
+    
+    @classmethod
+    def _from_packet_info(cls, packet_info) -> "RawPacket":
+        "RawPacket of __firegex_packet_info: the packet object of the c++ core or a dict of the RawPacket arguments"
+        if isinstance(packet_info, dict):
+            return cls(**packet_info)
+        return cls._from_native(packet_info)
+    
+    def _data_buffer(self):
+        "The data of the packet as given (bytes or a buffer of the packet info dict), without copying it"
+        if self.__data is None:
+            return self.__native.data
+        return self.__data
+    
+    def _raw_packet_buffer(self):
+        if self.__raw_packet is None:
+            return self.__native.raw_packet
+        return self.__raw_packet
     
     @property
     def is_input(self) -> bool:
@@ -38,7 +77,10 @@ class RawPacket:
     @property
     def data(self) -> bytes:
         "The data of the packet assembled and sorted from TCP"
-        return self.__data
+        data = self.__data
+        if data.__class__ is not bytes:
+            self.__data = data = bytes(self._data_buffer())
+        return data
     
     @property
     def l4_size(self) -> int:
@@ -53,7 +95,7 @@ class RawPacket:
     @property
     def l4_data(self) -> bytes:
         "The layer 4 payload of the packet"
-        return self.__raw_packet[self.raw_packet_header_len:]
+        return bytes(memoryview(self._raw_packet_buffer())[self.raw_packet_header_len:])
     
     @l4_data.setter
     def l4_data(self, v:bytes):
@@ -61,12 +103,15 @@ class RawPacket:
             raise Exception("Invalid data type, data MUST be of type bytes")
         #if len(v) != self.__l4_size:
         #    raise Exception("Invalid data size, must be equal to the original packet header size (due to a technical limitation)")
-        self.raw_packet = self.__raw_packet[:self.raw_packet_header_len]+v
+        self.raw_packet = bytes(memoryview(self._raw_packet_buffer())[:self.raw_packet_header_len])+v
     
     @property
     def raw_packet(self) -> bytes:
         "The raw packet with IP and TCP headers"
-        return self.__raw_packet
+        raw_packet = self.__raw_packet
+        if raw_packet.__class__ is not bytes:
+            self.__raw_packet = raw_packet = bytes(self._raw_packet_buffer())
+        return raw_packet
 
     @raw_packet.setter
     def raw_packet(self, v:bytes):
@@ -91,7 +136,7 @@ class RawPacket:
         
         if "__firegex_packet_info" not in internal_data.filter_glob.keys():
             raise Exception("Packet info not found")
-        return cls(**internal_data.filter_glob["__firegex_packet_info"])
+        return cls._from_packet_info(internal_data.filter_glob["__firegex_packet_info"])
     
     def __repr__(self):
         return f"RawPacket(data={self.data}, raw_packet={self.raw_packet}, is_input={self.is_input}, is_ipv6={self.is_ipv6}, is_tcp={self.is_tcp}, l4_size={self.l4_size})"
@@ -154,6 +199,14 @@ class DataStreamCtx:
             raise Exception("Invalid data type, data MUST be of type ExceptionAction")
         self.__data["invalid_encoding_action"] = v
     
+    @property
+    def dispatch_plan(self) -> "DispatchPlan":
+        return self.__data.get("dispatch_plan")
+
+    @dispatch_plan.setter
+    def dispatch_plan(self, v: "DispatchPlan"):
+        self.__data["dispatch_plan"] = v
+
     @property
     def data_handler_context(self) -> dict:
         if "data_handler_context" not in self.__data.keys():
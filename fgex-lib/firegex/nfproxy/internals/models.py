@@ -1,5 +1,6 @@
 from dataclasses import dataclass, field
 from enum import Enum
+from typing import NamedTuple
 
 class Action(Enum):
     """Action to be taken by the filter"""
@@ -30,6 +31,20 @@ class FilterHandler:
     params: dict[type, callable]
     proto: str
 
+class FilterCall(NamedTuple):
+    """Filter call of a dispatch plan"""
+    func: callable
+    name: str
+    slots: tuple[int, ...] # slots of the arguments in DispatchPlan.fetchers
+    fan_out: bool # an argument can be a list of data models: the filter is called for each combination
+
+@dataclass
+class DispatchPlan:
+    """Filters calls precompiled by compile(), used by handle_packet for every packet"""
+    ctx: object # DataStreamCtx of the stream, reused for all its packets
+    fetchers: list[callable] # fetcher of the data model of each slot, slot 0 is the RawPacket
+    calls: list[FilterCall]
+
 @dataclass
 class PacketHandlerResult:
     """Packet handler result"""
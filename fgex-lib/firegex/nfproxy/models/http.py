@@ -396,6 +396,8 @@ class InternalHttpResponse(InternalCallbackHandler, pyllhttp.Response):
 class InternalBasicHttpMetaClass:
     """Internal class to handle HTTP requests and responses"""
 
+    _fetch_fan_out = True # _fetch_packet can return a list of messages: the filter is called for each one
+
     def __init__(
         self,
         parser: InternalHttpRequest | InternalHttpResponse,
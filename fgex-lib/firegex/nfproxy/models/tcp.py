@@ -36,15 +36,16 @@ class InternalTCPStream:
             raise NotReadyToRun()
         if internal_data.current_pkt.is_input != is_input:
             raise NotReadyToRun()
+        data = internal_data.current_pkt._data_buffer() # Copied only into the stream buffer
         datahandler: TCPInputStream = internal_data.data_handler_context.get(cls, None)
         if datahandler is None:
-            datahandler = cls(internal_data.current_pkt.data, internal_data.current_pkt.is_ipv6)
+            datahandler = cls(data, internal_data.current_pkt.is_ipv6)
             internal_data.data_handler_context[cls] = datahandler
         else:
-            if datahandler.total_stream_size+len(internal_data.current_pkt.data) > internal_data.stream_max_size:
+            if datahandler.total_stream_size+len(data) > internal_data.stream_max_size:
                 match internal_data.full_stream_action:
                     case FullStreamAction.FLUSH:
-                        datahandler = cls(internal_data.current_pkt.data, internal_data.current_pkt.is_ipv6)
+                        datahandler = cls(data, internal_data.current_pkt.is_ipv6)
                         internal_data.data_handler_context[cls] = datahandler
                     case FullStreamAction.REJECT:
                         raise StreamFullReject()
@@ -53,7 +54,7 @@ class InternalTCPStream:
                     case FullStreamAction.ACCEPT:
                         raise NotReadyToRun()
             else:
-                datahandler._push_new_data(internal_data.current_pkt.data)
+                datahandler._push_new_data(data)
         return datahandler
 
 class TCPInputStream(InternalTCPStream):
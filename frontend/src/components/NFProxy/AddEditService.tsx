@@ -1,4 +1,4 @@
-import { Button, Group, Space, TextInput, Notification, Modal, Switch, SegmentedControl, Box, Tooltip } from '@mantine/core';
+import { Button, Group, Space, TextInput, Notification, Modal, Switch, SegmentedControl, Box, Tooltip, NumberInput } from '@mantine/core';
 import { useForm } from '@mantine/form';
 import { useEffect, useState } from 'react';
 import { okNotify, regex_ipv4, regex_ipv6 } from '../../js/utils';
@@ -18,6 +18,14 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
         ip_int:edit?.ip_int??"",
         proto:edit?.proto??"tcp",
         fail_open: edit?.fail_open??false,
+        batch_size: edit?.batch_size??1,
+        batch_latency: edit?.batch_latency??500,
+        cpu_affinity: edit?.cpu_affinity??"",
+        threads: edit?.threads??0,
+        gc_thresholds: edit?.gc_thresholds??"",
+        gc_every_packets: edit?.gc_every_packets??0,
+        gc_interval_ms: edit?.gc_interval_ms??0,
+        gc_on_idle: edit?.gc_on_idle??true,
         autostart: true
     }
     
@@ -28,6 +36,13 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
             port: (value) => (value>0 && value<65536) ? null : "Invalid port",
             proto: (value) => ["tcp","http"].includes(value) ? null : "Invalid protocol",
             ip_int: (value) => (value.match(regex_ipv6) || value.match(regex_ipv4)) ? null : "Invalid IP address",
+            batch_size: (value) => (value>0 && value<=1024) ? null : "Invalid batch size",
+            batch_latency: (value) => (value>=0 && value<=1000000) ? null : "Invalid batch latency",
+            threads: (value) => (value>=0 && value<=256) ? null : "Invalid number of threads",
+            cpu_affinity: (value) => value.trim().match(/^(auto|(\d+(-\d+)?)(\s*,\s*\d+(-\d+)?)*)?$/i) ? null : "Invalid cpu affinity",
+            gc_thresholds: (value) => value.trim().match(/^(\d+(\s*,\s*\d+){0,2})?$/) ? null : "Invalid gc thresholds",
+            gc_every_packets: (value) => value>=0 ? null : "Invalid gc packets interval",
+            gc_interval_ms: (value) => value>=0 ? null : "Invalid gc time interval",
         }
     })
 
@@ -47,10 +62,10 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
     const [submitLoading, setSubmitLoading] = useState(false)
     const [error, setError] = useState<string|null>(null)
  
-    const submitRequest = ({ name, port, autostart, proto, ip_int, fail_open }:ServiceAddForm) =>{
+    const submitRequest = ({ name, port, autostart, proto, ip_int, fail_open, batch_size, batch_latency, cpu_affinity, threads, gc_thresholds, gc_every_packets, gc_interval_ms, gc_on_idle }:ServiceAddForm) =>{
         setSubmitLoading(true)
         if (edit){
-            nfproxy.settings(edit.service_id, { port, ip_int, fail_open }).then( res => {
+            nfproxy.settings(edit.service_id, { port, ip_int, fail_open, batch_size, batch_latency, cpu_affinity, threads, gc_thresholds, gc_every_packets, gc_interval_ms, gc_on_idle }).then( res => {
                 if (!res){
                     setSubmitLoading(false)
                     close();
@@ -61,7 +76,7 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
                 setError("Request Failed! [ "+err+" ]")
             })
         }else{
-            nfproxy.servicesadd({ name, port, proto, ip_int, fail_open }).then( res => {
+            nfproxy.servicesadd({ name, port, proto, ip_int, fail_open, batch_size, batch_latency, cpu_affinity, threads, gc_thresholds, gc_every_packets, gc_interval_ms, gc_on_idle }).then( res => {
                 if (res.status === "ok" && res.service_id){
                     setSubmitLoading(false)
                     close();
@@ -109,6 +124,19 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
                         </Box>}
                         {...form.getInputProps('fail_open', { type: 'checkbox' })}
                     />
+                    <Space h="sm" />
+                    <Switch
+                        label={<Box className='center-flex'>
+                            Garbage collect on idle
+                            <Space w="xs" />
+                            <Tooltip label={<>
+                                A full garbage collection of the filters interpreter runs when a worker has no packets to handle
+                            </>}>
+                                <IoMdInformationCircleOutline size={15} />
+                            </Tooltip>
+                        </Box>}
+                        {...form.getInputProps('gc_on_idle', { type: 'checkbox' })}
+                    />
                 </Box>
                 <Box className="flex-spacer"></Box>
                 {edit?null:<SegmentedControl
@@ -118,7 +146,124 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
                     ]}
                     {...form.getInputProps('proto')}
                 />}
-            </Box>      
+            </Box>
+            <Space h="md" />
+            <Box className='center-flex'>
+                <NumberInput
+                    label={<Box className='center-flex'>
+                        Threads
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            Workers filtering the packets, 0 uses the default of firegex<br />changing only this setting doesn't restart the service
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    min={0}
+                    max={256}
+                    allowDecimal={false}
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('threads')}
+                />
+                <Space w="md" />
+                <NumberInput
+                    label={<Box className='center-flex'>
+                        Batch size
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            Max number of packets received and verdicts sent to nfqueue with a single syscall<br />1 disables the batching
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    min={1}
+                    max={1024}
+                    allowDecimal={false}
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('batch_size')}
+                />
+                <Space w="md" />
+                <NumberInput
+                    label={<Box className='center-flex'>
+                        Batch latency (μs)
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            Max time a verdict can wait in the batch before being sent
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    min={0}
+                    max={1000000}
+                    allowDecimal={false}
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('batch_latency')}
+                />
+                <Space w="md" />
+                <TextInput
+                    label={<Box className='center-flex'>
+                        CPU affinity
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            CPUs where the filter threads are pinned (e.g. 0-3,6)<br />auto assigns different CPUs to every service, empty disables the pinning
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    placeholder="auto, 0-3,6"
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('cpu_affinity')}
+                />
+            </Box>
+            <Space h="md" />
+            <Box className='center-flex'>
+                <TextInput
+                    label={<Box className='center-flex'>
+                        GC thresholds
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            Thresholds of the automatic garbage collection of the filters (as python gc.set_threshold, e.g. 700,10,10)<br />empty uses the python defaults, 0 disables the automatic collection
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    placeholder="700,10,10"
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('gc_thresholds')}
+                />
+                <Space w="md" />
+                <NumberInput
+                    label={<Box className='center-flex'>
+                        GC every packets
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            A full garbage collection runs every this number of packets handled by a worker<br />0 disables it
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    min={0}
+                    allowDecimal={false}
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('gc_every_packets')}
+                />
+                <Space w="md" />
+                <NumberInput
+                    label={<Box className='center-flex'>
+                        GC interval (ms)
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            A full garbage collection runs at most every this time, checked when a packet is handled<br />0 disables it
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    min={0}
+                    allowDecimal={false}
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('gc_interval_ms')}
+                />
+            </Box>
 
             <Group justify='flex-end' mt="md" mb="sm">
                 <Button loading={submitLoading} type="submit" disabled={edit?!form.isDirty():false}>{edit?"Edit Service":"Add Service"}</Button>
@@ -13,6 +13,14 @@ export type Service = {
     edited_packets:number,
     blocked_packets:number,
     fail_open:boolean,
+    batch_size:number,
+    batch_latency:number,
+    cpu_affinity:string,
+    threads:number,
+    gc_thresholds:string,
+    gc_every_packets:number,
+    gc_interval_ms:number,
+    gc_on_idle:boolean,
 }
 
 export type ServiceAddForm = {
@@ -21,12 +29,28 @@ export type ServiceAddForm = {
     proto:string,
     ip_int:string,
     fail_open: boolean,
+    batch_size: number,
+    batch_latency: number,
+    cpu_affinity: string,
+    threads: number,
+    gc_thresholds: string,
+    gc_every_packets: number,
+    gc_interval_ms: number,
+    gc_on_idle: boolean,
 }
 
 export type ServiceSettings = {
     port?:number,
     ip_int?:string,
     fail_open?: boolean,
+    batch_size?: number,
+    batch_latency?: number,
+    cpu_affinity?: string,
+    threads?: number,
+    gc_thresholds?: string,
+    gc_every_packets?: number,
+    gc_interval_ms?: number,
+    gc_on_idle?: boolean,
 }
 
 export type ServiceAddResponse = {
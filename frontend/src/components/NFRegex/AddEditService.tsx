@@ -1,4 +1,4 @@
-import { Button, Group, Space, TextInput, Notification, Modal, Switch, SegmentedControl, Box, Tooltip } from '@mantine/core';
+import { Button, Group, Space, TextInput, Notification, Modal, Switch, SegmentedControl, Box, Tooltip, NumberInput } from '@mantine/core';
 import { useForm } from '@mantine/form';
 import { useEffect, useState } from 'react';
 import { okNotify, regex_ipv4, regex_ipv6 } from '../../js/utils';
@@ -18,6 +18,14 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
         ip_int:edit?.ip_int??"",
         proto:edit?.proto??"tcp",
         fail_open: edit?.fail_open??false,
+        batch_size: edit?.batch_size??1,
+        batch_latency: edit?.batch_latency??500,
+        cpu_affinity: edit?.cpu_affinity??"",
+        threads: edit?.threads??0,
+        max_streams: edit?.max_streams??65536,
+        stream_timeout: edit?.stream_timeout??300,
+        tcp_direct_scan: edit?.tcp_direct_scan??false,
+        udp_flow: edit?.udp_flow??false,
         autostart: true
     }
     
@@ -28,6 +36,12 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
             port: (value) => (value>0 && value<65536) ? null : "Invalid port",
             proto: (value) => ["tcp","udp"].includes(value) ? null : "Invalid protocol",
             ip_int: (value) => (value.match(regex_ipv6) || value.match(regex_ipv4)) ? null : "Invalid IP address",
+            batch_size: (value) => (value>0 && value<=1024) ? null : "Invalid batch size",
+            batch_latency: (value) => (value>=0 && value<=1000000) ? null : "Invalid batch latency",
+            threads: (value) => (value>=0 && value<=256) ? null : "Invalid number of threads",
+            max_streams: (value) => (value>=0 && value<=10000000) ? null : "Invalid max streams",
+            stream_timeout: (value) => (value>=0 && value<=86400) ? null : "Invalid stream timeout",
+            cpu_affinity: (value) => value.trim().match(/^(auto|(\d+(-\d+)?)(\s*,\s*\d+(-\d+)?)*)?$/i) ? null : "Invalid cpu affinity",
         }
     })
 
@@ -47,10 +61,10 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
     const [submitLoading, setSubmitLoading] = useState(false)
     const [error, setError] = useState<string|null>(null)
  
-    const submitRequest = ({ name, port, autostart, proto, ip_int, fail_open }:ServiceAddForm) =>{
+    const submitRequest = ({ name, port, autostart, proto, ip_int, fail_open, batch_size, batch_latency, cpu_affinity, threads, max_streams, stream_timeout, tcp_direct_scan, udp_flow }:ServiceAddForm) =>{
         setSubmitLoading(true)
         if (edit){
-            nfregex.settings(edit.service_id, { port, proto, ip_int, fail_open }).then( res => {
+            nfregex.settings(edit.service_id, { port, proto, ip_int, fail_open, batch_size, batch_latency, cpu_affinity, threads, max_streams, stream_timeout, tcp_direct_scan, udp_flow }).then( res => {
                 if (!res){
                     setSubmitLoading(false)
                     close();
@@ -61,7 +75,7 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
                 setError("Request Failed! [ "+err+" ]")
             })
         }else{
-            nfregex.servicesadd({ name, port, proto, ip_int, fail_open }).then( res => {
+            nfregex.servicesadd({ name, port, proto, ip_int, fail_open, batch_size, batch_latency, cpu_affinity, threads, max_streams, stream_timeout, tcp_direct_scan, udp_flow }).then( res => {
                 if (res.status === "ok" && res.service_id){
                     setSubmitLoading(false)
                     close();
@@ -109,6 +123,30 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
                         </Box>}
                         {...form.getInputProps('fail_open', { type: 'checkbox' })}
                     />
+                    <Space h="sm" />
+                    {form.values.proto === "udp"?<Switch
+                        label={<Box className='center-flex'>
+                            UDP flow matching
+                            <Space w="xs" />
+                            <Tooltip label={<>
+                                The datagrams with the same addresses and ports are matched as a single stream<br />so the regexes can match across datagrams, a flow ends after the stream idle timeout
+                            </>}>
+                                <IoMdInformationCircleOutline size={15} />
+                            </Tooltip>
+                        </Box>}
+                        {...form.getInputProps('udp_flow', { type: 'checkbox' })}
+                    />:<Switch
+                        label={<Box className='center-flex'>
+                            Direct TCP scan
+                            <Space w="xs" />
+                            <Tooltip label={<>
+                                The TCP payloads received in order are matched directly from the packets<br />only the out of order segments are buffered, reducing memory and copies
+                            </>}>
+                                <IoMdInformationCircleOutline size={15} />
+                            </Tooltip>
+                        </Box>}
+                        {...form.getInputProps('tcp_direct_scan', { type: 'checkbox' })}
+                    />}
                 </Box>
                 <Box className="flex-spacer"></Box>
                 <SegmentedControl
@@ -118,7 +156,111 @@ function AddEditService({ opened, onClose, edit }:{ opened:boolean, onClose:()=>
                     ]}
                     {...form.getInputProps('proto')}
                 />
-            </Box>      
+            </Box>
+            <Space h="md" />
+            <Box className='center-flex'>
+                <NumberInput
+                    label={<Box className='center-flex'>
+                        Threads
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            Workers filtering the packets, 0 uses the default of firegex<br />changing only this setting doesn't restart the service
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    min={0}
+                    max={256}
+                    allowDecimal={false}
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('threads')}
+                />
+                <Space w="md" />
+                <NumberInput
+                    label={<Box className='center-flex'>
+                        Batch size
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            Max number of packets received and verdicts sent to nfqueue with a single syscall<br />1 disables the batching
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    min={1}
+                    max={1024}
+                    allowDecimal={false}
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('batch_size')}
+                />
+                <Space w="md" />
+                <NumberInput
+                    label={<Box className='center-flex'>
+                        Batch latency (μs)
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            Max time a verdict can wait in the batch before being sent
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    min={0}
+                    max={1000000}
+                    allowDecimal={false}
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('batch_latency')}
+                />
+                <Space w="md" />
+                <TextInput
+                    label={<Box className='center-flex'>
+                        CPU affinity
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            CPUs where the filter threads are pinned (e.g. 0-3,6)<br />auto assigns different CPUs to every service, empty disables the pinning
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    placeholder="auto, 0-3,6"
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('cpu_affinity')}
+                />
+            </Box>
+            <Space h="md" />
+            <Box className='center-flex'>
+                <NumberInput
+                    label={<Box className='center-flex'>
+                        Max streams
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            Max connections (TCP streams or UDP flows) tracked by the filter, when reached the least recently used are evicted<br />0 disables the limit
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    min={0}
+                    max={10000000}
+                    allowDecimal={false}
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('max_streams')}
+                />
+                <Space w="md" />
+                <NumberInput
+                    label={<Box className='center-flex'>
+                        Stream idle timeout (s)
+                        <Space w="xs" />
+                        <Tooltip label={<>
+                            Connections without traffic for this time are evicted<br />0 disables the timeout
+                        </>}>
+                            <IoMdInformationCircleOutline size={15} />
+                        </Tooltip>
+                    </Box>}
+                    min={0}
+                    max={86400}
+                    allowDecimal={false}
+                    style={{ flex: 1 }}
+                    {...form.getInputProps('stream_timeout')}
+                />
+            </Box>
 
             <Group justify='flex-end' mt="md" mb="sm">
                 <Button loading={submitLoading} type="submit" disabled={edit?!form.isDirty():false}>{edit?"Edit Service":"Add Service"}</Button>
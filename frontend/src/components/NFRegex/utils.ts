@@ -13,6 +13,14 @@ export type Service = {
     n_packets:number,
     n_regex:number,
     fail_open:boolean,
+    batch_size:number,
+    batch_latency:number,
+    cpu_affinity:string,
+    threads:number,
+    max_streams:number,
+    stream_timeout:number,
+    tcp_direct_scan:boolean,
+    udp_flow:boolean,
 }
 
 export type ServiceAddForm = {
@@ -21,6 +29,14 @@ export type ServiceAddForm = {
     proto:string,
     ip_int:string,
     fail_open: boolean,
+    batch_size: number,
+    batch_latency: number,
+    cpu_affinity: string,
+    threads: number,
+    max_streams: number,
+    stream_timeout: number,
+    tcp_direct_scan: boolean,
+    udp_flow: boolean,
 }
 
 export type ServiceSettings = {
@@ -28,6 +44,14 @@ export type ServiceSettings = {
     proto?:string,
     ip_int?:string,
     fail_open?: boolean,
+    batch_size?: number,
+    batch_latency?: number,
+    cpu_affinity?: string,
+    threads?: number,
+    max_streams?: number,
+    stream_timeout?: number,
+    tcp_direct_scan?: boolean,
+    udp_flow?: boolean,
 }
 
 export type ServiceAddResponse = {
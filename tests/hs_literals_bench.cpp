@@ -0,0 +1,86 @@
+/*
+Micro-benchmark of the literal rules of nfregex: throughput of the literals compiled in the literals database
+(hs_compile_lit_multi, regex/regex_rules.cpp) against the same rules compiled as regexes, with 1/100/1000 rules.
+
+Build and run (needs the hyperscan headers, as the firegex binaries):
+$ g++ hs_literals_bench.cpp -o hs_literals_bench -std=c++23 -O3 $(pkg-config --cflags --libs libhs)
+$ ./hs_literals_bench
+*/
+#include "../backend/binsrc/regex/regex_rules.cpp"
+#include <chrono>
+#include <iostream>
+#include <iomanip>
+#include <random>
+
+using namespace std;
+using namespace Firegex::Regex;
+
+const size_t PAYLOAD_SIZE = 1500;
+const size_t PAYLOADS = 100000;
+
+string hex_encode(const string& data) {
+    static const char digits[] = "0123456789abcdef";
+    string hex;
+    for (unsigned char c : data) {
+        hex.push_back(digits[c >> 4]);
+        hex.push_back(digits[c & 0xf]);
+    }
+    return hex;
+}
+
+// Flag-like random literals, as the rules used in the attack/defense CTFs
+vector<string> make_literals(size_t n, mt19937_64& rng) {
+    vector<string> literals(n);
+    for (auto& literal : literals) {
+        literal = "FLG";
+        for (int i = 0; i < 12; i++) literal.push_back('A' + rng() % 26);
+    }
+    return literals;
+}
+
+// The group makes the rule a regex: same matches, compiled in the regexes database
+RegexRules make_rules(const vector<string>& literals, bool as_regex) {
+    vector<string> raw_rules;
+    for (auto& literal : literals) {
+        raw_rules.push_back("1C" + hex_encode(as_regex ? "(?:" + literal + ")" : literal));
+    }
+    return RegexRules(raw_rules, false);
+}
+
+// Scans as RegexNfQueue::scan_data in block mode, returns the MB/s
+double scan_throughput(RegexRules& rules, const vector<string>& payloads) {
+    hs_scratch_t* scratch = nullptr;
+    scratch_setup(rules.input_ruleset, scratch);
+    auto on_match = [](unsigned int, unsigned long long, unsigned long long, unsigned int, void*) { return -1; };
+    auto start = chrono::steady_clock::now();
+    for (auto& payload : payloads) {
+        hs_error_t err = HS_SUCCESS;
+        for (hs_database_t* db : {rules.input_ruleset.lit_db, rules.input_ruleset.hs_db}) {
+            if (db != nullptr && err == HS_SUCCESS) {
+                err = hs_scan(db, payload.data(), payload.size(), 0, scratch, on_match, nullptr);
+            }
+        }
+    }
+    chrono::duration<double> elapsed = chrono::steady_clock::now() - start;
+    hs_free_scratch(scratch);
+    return double(PAYLOAD_SIZE * PAYLOADS) / elapsed.count() / 1e6;
+}
+
+int main() {
+    mt19937_64 rng(42);
+    // Printable traffic without matches: every payload is scanned until the end
+    vector<string> payloads(PAYLOADS, string(PAYLOAD_SIZE, ' '));
+    for (auto& payload : payloads) {
+        for (auto& c : payload) c = 'a' + rng() % 26;
+    }
+    cout << setw(10) << "literals" << setw(20) << "regexes (MB/s)" << setw(20) << "literals (MB/s)" << endl;
+    for (size_t n : {1, 100, 1000}) {
+        auto literals = make_literals(n, rng);
+        RegexRules as_regexes = make_rules(literals, true);
+        RegexRules as_literals = make_rules(literals, false);
+        double regex_mbs = scan_throughput(as_regexes, payloads);
+        double literal_mbs = scan_throughput(as_literals, payloads);
+        cout << setw(10) << n << setw(20) << fixed << setprecision(1) << regex_mbs << setw(20) << literal_mbs << endl;
+    }
+    return 0;
+}
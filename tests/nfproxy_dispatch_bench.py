@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the nfproxy packet dispatch (firegex.nfproxy.internals.handle_packet): packets/s of the
+precompiled dispatch plan against the previous implementation (rebuilding the call structures on every packet
+and calling the filters with an eval in the filter globals).
+
+Run from the tests directory (needs the fgex-lib requirements):
+$ python3 nfproxy_dispatch_bench.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../fgex-lib"))
+
+from firegex.nfproxy.internals import handle_packet, get_filter_names  # noqa: E402
+from firegex.nfproxy.internals.data import DataStreamCtx, RawPacket  # noqa: E402
+from firegex.nfproxy.internals.models import Action, PacketHandlerResult  # noqa: E402
+from firegex.nfproxy.internals.exceptions import (  # noqa: E402
+    NotReadyToRun, StreamFullReject, DropPacket, RejectConnection, StreamFullDrop
+)
+
+PACKETS = 100000
+
+FILTER_CODE = """
+from firegex.nfproxy import pyfilter, ACCEPT, DROP, REJECT
+from firegex.nfproxy.models import RawPacket, TCPInputStream, TCPOutputStream
+
+FGEX_STREAM_MAX_SIZE = 4096
+
+@pyfilter
+def block_flag_leak(packet: RawPacket):
+    if b"FLAG{" in packet.data:
+        return DROP
+
+@pyfilter
+def block_big_packets(packet: RawPacket):
+    if packet.l4_size > 1400:
+        return REJECT
+
+@pyfilter
+def block_path_traversal(stream: TCPInputStream):
+    if b"../" in stream.data:
+        return REJECT
+
+@pyfilter
+def block_shell(packet: RawPacket, stream: TCPOutputStream):
+    if b"/bin/sh" in stream.data:
+        return DROP
+
+@pyfilter
+def accept_all(packet: RawPacket):
+    return ACCEPT
+"""
+
+
+def direct_call(glob, func, *args):
+    return func(*args)
+
+
+def legacy_context_call(glob, func, *args, **kargs):
+    glob["__firegex_tmp_args"] = args
+    glob["__firegex_tmp_kargs"] = kargs
+    glob["__firege_tmp_call"] = func
+    res = eval("__firege_tmp_call(*__firegex_tmp_args, **__firegex_tmp_kargs)", glob, glob)
+    if "__firegex_tmp_args" in glob.keys():
+        del glob["__firegex_tmp_args"]
+    if "__firegex_tmp_kargs" in glob.keys():
+        del glob["__firegex_tmp_kargs"]
+    if "__firege_tmp_call" in glob.keys():
+        del glob["__firege_tmp_call"]
+    return res
+
+
+def legacy_handle_packet(glob: dict, call=legacy_context_call) -> None:
+    """handle_packet before the dispatch plan (the stream full and exception actions are simplified)"""
+    internal_data = DataStreamCtx(glob)
+    cache_call = {}
+    cache_call[RawPacket] = internal_data.current_pkt
+    result = PacketHandlerResult(glob)
+    for filter in internal_data.filter_call_info:
+        final_params = []
+        skip_call = False
+        for data_type, data_func in filter.params.items():
+            if data_type not in cache_call.keys():
+                try:
+                    cache_call[data_type] = data_func(internal_data)
+                except NotReadyToRun:
+                    cache_call[data_type] = None
+                    skip_call = True
+                    break
+                except (StreamFullDrop, StreamFullReject, DropPacket, RejectConnection):
+                    result.action = Action.DROP
+                    result.matched_by = filter.name
+                    return result.set_result()
+            if cache_call[data_type] is None:
+                skip_call = True
+                break
+            final_params.append(cache_call[data_type])
+        if skip_call:
+            continue
+
+        def try_to_call(params: list):
+            is_base_call = True
+            for i in range(len(params)):
+                if isinstance(params[i], list):
+                    new_params = params.copy()
+                    for ele in params[i]:
+                        new_params[i] = ele
+                        yield from try_to_call(new_params)
+                    is_base_call = False
+                    break
+            if is_base_call:
+                yield call(glob, filter.func, *params)
+
+        for res in try_to_call(final_params):
+            if res is None:
+                continue
+            if res == Action.MANGLE:
+                result.matched_by = filter.name
+                result.mangled_packet = internal_data.current_pkt.raw_packet
+                result.action = Action.MANGLE
+            elif res != Action.ACCEPT:
+                result.matched_by = filter.name
+                result.action = res
+                result.mangled_packet = None
+                return result.set_result()
+    return result.set_result()
+
+
+def make_glob() -> dict:
+    code = FILTER_CODE + (
+        "\n__firegex_pyfilter_enabled = " + repr(get_filter_names(FILTER_CODE, "tcp")) + "\n"
+        "__firegex_proto = 'tcp'\n"
+        "import firegex.nfproxy.internals\n"
+        "firegex.nfproxy.internals.compile(globals())\n"
+    )
+    glob = {}
+    exec(code, glob, glob)
+    return glob
+
+
+def packets_per_second(handler) -> float:
+    glob = make_glob()
+    payload = b"GET /index.html HTTP/1.1\r\nHost: service\r\n\r\n" * 8
+    header = b"\x45" + b"\x00" * 39
+    start = time.perf_counter()
+    for i in range(PACKETS):
+        glob["__firegex_packet_info"] = {
+            "data": payload,
+            "l4_size": len(payload),
+            "raw_packet": header + payload,
+            "is_input": i % 2 == 0,
+            "is_ipv6": False,
+            "is_tcp": True,
+        }
+        handler(glob)
+        del glob["__firegex_packet_info"]
+        if glob["__firegex_pyfilter_result"]["action"] != Action.ACCEPT.value:
+            raise Exception("Unexpected filter result")
+    return PACKETS / (time.perf_counter() - start)
+
+
+class NativePacket:
+    "Stand-in of the packet object of the c++ core (binsrc/pyproxy/packet.cpp)"
+    
+    def __init__(self, payload: bytes, header: bytes):
+        self.data = payload
+        self.raw_packet = header + payload
+        self.l4_size = len(payload)
+        self.header_size = len(header)
+        self.is_input = True
+        self.is_ipv6 = False
+        self.is_tcp = True
+
+
+def check_packet_released():
+    """
+    The c++ core copies the packet buffers when the packet object is still referenced after the handling (kept by
+    the filters): the dispatch must not keep a reference of its own, or every packet is copied
+    """
+    glob = make_glob()
+    packet = NativePacket(b"GET / HTTP/1.1\r\n\r\n", b"\x45" + b"\x00" * 39)
+    refs = sys.getrefcount(packet)
+    glob["__firegex_packet_info"] = packet
+    handle_packet(glob)
+    del glob["__firegex_packet_info"]
+    if sys.getrefcount(packet) != refs:
+        raise Exception("The packet is still referenced after the handling")
+
+
+if __name__ == "__main__":
+    check_packet_released()
+    results = [
+        ("before", packets_per_second(legacy_handle_packet)),
+        ("before, without eval", packets_per_second(lambda glob: legacy_handle_packet(glob, direct_call))),
+        ("dispatch plan", packets_per_second(handle_packet)),
+    ]
+    print(f"{'implementation':>25}{'packets/s':>15}")
+    for name, pps in results:
+        print(f"{name:>25}{pps:>15.0f}")
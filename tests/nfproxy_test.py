@@ -361,6 +361,51 @@ else:
 
 checkFilter(secret, BASE_FILTER_VERDICT_NAME, mangle_with=mangle_result)
 
+
+def checkMangleOnResize(threads):
+    """A mangled connection moved to another worker on resize keeps its seq/ack offsets and is filtered there"""
+    global n_mangled
+    pre_packet = secrets.token_bytes(40)
+    server.connect_client()
+    server.send_packet(pre_packet + secret)
+    if server.recv_packet() != pre_packet + mangle_result:
+        puts(
+            "Test Failed: The request wasn't mangled before the resize ✗",
+            color=colors.red,
+        )
+        exit_test(1)
+    n_mangled += 1
+    if not firegex.nfproxy_resize_service(service_id, threads):
+        puts(
+            f"Test Failed: Couldn't resize the service to {threads} workers ✗",
+            color=colors.red,
+        )
+        exit_test(1)
+    server.send_packet(pre_packet)
+    if server.recv_packet() != pre_packet:
+        puts(
+            "Test Failed: Couldn't communicate on the mangled connection after the resize ✗",
+            color=colors.red,
+        )
+        exit_test(1)
+    server.send_packet(pre_packet + secret)
+    if server.recv_packet() != pre_packet + mangle_result:
+        puts(
+            "Test Failed: The request on the connection opened before the resize wasn't mangled ✗",
+            color=colors.red,
+        )
+        exit_test(1)
+    n_mangled += 1
+    server.close_client()
+    puts(
+        f"The mangled connection kept working across the resize to {threads} workers ✔",
+        color=colors.green,
+    )
+
+
+checkMangleOnResize(4)
+checkMangleOnResize(1)
+
 remove_filters()
 
 secret = b"8331ee1bf75893dd7fa3d34f29bac7fc8935aa3ef6c565fe8b395ef7f485"
@@ -821,6 +866,208 @@ server.close_client()
 
 remove_filters()
 
+
+def stream_echoes(n_packets):
+    """Sends n_packets on a new connection, one at a time, and returns how many of them were echoed back"""
+    server.connect_client()
+    echoed = 0
+    for _ in range(n_packets):
+        packet = secrets.token_bytes(40)
+        server.send_packet(packet)
+        if server.recv_packet() != packet:
+            break
+        echoed += 1
+    server.close_client()
+    return echoed
+
+
+# The filters are called directly with the module globals: the state rebound by a filter is seen by the others
+GLOBAL_STATE_TEST = """
+from firegex.nfproxy.models import RawPacket
+from firegex.nfproxy import pyfilter, ACCEPT, REJECT
+
+input_packets = 0
+
+@pyfilter
+def global_count_test(packet:RawPacket):
+    global input_packets
+    if packet.is_input:
+        input_packets += 1
+
+@pyfilter
+def global_state_test(packet:RawPacket):
+    if packet.is_input and input_packets > 2:
+        return REJECT
+"""
+
+if firegex.nfproxy_set_code(service_id, GLOBAL_STATE_TEST):
+    puts("Sucessfully added filters sharing the module state ✔", color=colors.green)
+else:
+    puts("Test Failed: Couldn't add the filters sharing the module state ✗", color=colors.red)
+    exit_test(1)
+
+if stream_echoes(3) == 2:
+    puts("The module state set by a filter was read by the other one ✔", color=colors.green)
+else:
+    puts("Test Failed: The module state set by a filter wasn't read by the other one ✗", color=colors.red)
+    exit_test(1)
+
+time.sleep(1)
+if firegex.nfproxy_get_pyfilter(service_id, "global_state_test")["blocked_packets"] == 1:
+    puts("The packet was reported as blocked by the filter reading the state ✔", color=colors.green)
+else:
+    puts("Test Failed: The packet wasn't reported as blocked by the filter reading the state ✗", color=colors.red)
+    exit_test(1)
+
+if stream_echoes(2) == 2:
+    puts("A new stream starts from the initial module state ✔", color=colors.green)
+else:
+    puts("Test Failed: A new stream didn't start from the initial module state ✗", color=colors.red)
+    exit_test(1)
+
+remove_filters()
+
+# The streams start from the module state left by the filter code, every stream has its own copy
+# (also of the classes defined by the filter code and of the mutable default arguments)
+CLASS_STATE_TEST = """
+from firegex.nfproxy.models import RawPacket
+from firegex.nfproxy import pyfilter, ACCEPT, REJECT
+
+class Counter:
+    packets = 0
+    def add(self):
+        Counter.packets += 1
+        return Counter.packets
+
+def seen_packets(packet, seen=[]):
+    seen.append(packet)
+    return len(seen)
+
+@pyfilter
+def class_state_test(packet:RawPacket):
+    if not packet.is_input:
+        return ACCEPT
+    if Counter().add() > 2 or seen_packets(packet.data) > 2:
+        return REJECT
+"""
+
+if firegex.nfproxy_set_code(service_id, CLASS_STATE_TEST):
+    puts("Sucessfully added filter with class based module state ✔", color=colors.green)
+else:
+    puts("Test Failed: Couldn't add the filter with class based module state ✗", color=colors.red)
+    exit_test(1)
+
+if stream_echoes(2) == 2 and stream_echoes(2) == 2:
+    puts("The class based module state is kept for each stream ✔", color=colors.green)
+else:
+    puts("Test Failed: The class based module state is shared between the streams ✗", color=colors.red)
+    exit_test(1)
+
+if stream_echoes(3) == 2:
+    puts("The class based module state is kept between the packets of a stream ✔", color=colors.green)
+else:
+    puts("Test Failed: The class based module state wasn't kept in the stream ✗", color=colors.red)
+    exit_test(1)
+
+remove_filters()
+
+# The packets are read by the filters only when needed, a packet kept by a filter is still readable after its verdict
+KEPT_PACKET_TEST = """
+from firegex.nfproxy.models import RawPacket
+from firegex.nfproxy import pyfilter, ACCEPT, UNSTABLE_MANGLE
+
+kept = []
+
+@pyfilter
+def kept_packet_test(packet:RawPacket):
+    if not packet.is_input:
+        return ACCEPT
+    kept.append(packet) # Its data is never read while the packet is handled
+    if len(kept) == 2:
+        packet.l4_data = kept[0].data + kept[0].l4_data
+        return UNSTABLE_MANGLE
+"""
+
+if firegex.nfproxy_set_code(service_id, KEPT_PACKET_TEST):
+    puts("Sucessfully added filter keeping the packets ✔", color=colors.green)
+else:
+    puts("Test Failed: Couldn't add the filter keeping the packets ✗", color=colors.red)
+    exit_test(1)
+
+first_packet = secrets.token_bytes(40)
+server.connect_client()
+server.send_packet(first_packet)
+if server.recv_packet() == first_packet:
+    puts("The packet kept by the filter was sent unchanged ✔", color=colors.green)
+else:
+    puts("Test Failed: The packet kept by the filter was changed ✗", color=colors.red)
+    exit_test(1)
+server.send_packet(secrets.token_bytes(40))
+if server.recv_packet() == first_packet + first_packet:
+    puts("The packet kept by the filter was read after its verdict ✔", color=colors.green)
+else:
+    puts("Test Failed: The packet kept by the filter wasn't readable after its verdict ✗", color=colors.red)
+    exit_test(1)
+server.close_client()
+
+remove_filters()
+
+# Garbage collection policy of the filters interpreters
+if not firegex.nfproxy_gc_settings_service(service_id, gc_thresholds="700,a"):
+    puts("Invalid gc thresholds were refused ✔", color=colors.green)
+else:
+    puts("Test Failed: Invalid gc thresholds were accepted ✗", color=colors.red)
+    exit_test(1)
+
+if not firegex.nfproxy_gc_settings_service(service_id, gc_thresholds="0", gc_on_idle=False):
+    puts("A gc policy that never collects was refused ✔", color=colors.green)
+else:
+    puts("Test Failed: A gc policy that never collects was accepted ✗", color=colors.red)
+    exit_test(1)
+
+
+def getGcCollections():
+    collections = 0
+    for metric in firegex.nfproxy_get_metrics().split("\n"):
+        if metric.startswith("firegex_gc_collections_total{") and f'service_name="{args.service_name}"' in metric:
+            collections += int(metric.split(" ")[-1])
+    return collections
+
+
+if firegex.nfproxy_set_code(service_id, get_vedict_test(secret.decode(), "REJECT")):
+    puts(f"Sucessfully added filter for {str(secret)} in REJECT mode ✔", color=colors.green)
+else:
+    puts(f"Test Failed: Couldn't add the filter {str(secret)} ✗", color=colors.red)
+    exit_test(1)
+
+if firegex.nfproxy_gc_settings_service(service_id, gc_thresholds="0", gc_every_packets=1, gc_on_idle=False):
+    puts("Sucessfully set the gc to collect after every packet ✔", color=colors.green)
+else:
+    puts("Test Failed: Couldn't set the gc policy ✗", color=colors.red)
+    exit_test(1)
+
+time.sleep(0.5)
+if stream_echoes(3) == 3:
+    puts("The packets were filtered with the gc policy ✔", color=colors.green)
+else:
+    puts("Test Failed: The packets weren't filtered with the gc policy ✗", color=colors.red)
+    exit_test(1)
+
+time.sleep(1)
+if getGcCollections() >= 3:
+    puts("The collections were reported in the metrics ✔", color=colors.green)
+else:
+    puts("Test Failed: The collections weren't reported in the metrics ✗", color=colors.red)
+    exit_test(1)
+
+if firegex.nfproxy_gc_settings_service(service_id, gc_thresholds="", gc_every_packets=0, gc_on_idle=True):
+    puts("Sucessfully restored the default gc policy ✔", color=colors.green)
+else:
+    puts("Test Failed: Couldn't restore the default gc policy ✗", color=colors.red)
+    exit_test(1)
+
+remove_filters()
+
 # Rename service
 if firegex.nfproxy_rename_service(service_id, f"{args.service_name}2"):
     puts(f"Sucessfully renamed service to {args.service_name}2 ✔", color=colors.green)
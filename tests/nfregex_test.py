@@ -15,6 +15,8 @@ parser.add_argument("--service_name", "-n", type=str , required=False, help='Nam
 parser.add_argument("--port", "-P", type=int , required=False, help='Port of the test service', default=1337)
 parser.add_argument("--ipv6", "-6" , action="store_true", help='Test Ipv6', default=False)
 parser.add_argument("--proto", "-m" , type=str, required=False, choices=["tcp","udp"], help='Select the protocol', default="tcp")
+parser.add_argument("--direct-scan", "-D" , action="store_true", help='Scan the TCP segments without reassembly', default=False)
+parser.add_argument("--udp-flow", "-F" , action="store_true", help='Match the datagrams of a UDP flow as a stream', default=False)
 
 args = parser.parse_args()
 sep()
@@ -48,7 +50,7 @@ for ele in srvs:
     if ele['name'] == args.service_name:
         firegex.nfregex_delete_service(ele['service_id'])
 
-service_id = firegex.nfregex_add_service(args.service_name, args.port, args.proto , "::1" if args.ipv6 else "127.0.0.1" )
+service_id = firegex.nfregex_add_service(args.service_name, args.port, args.proto , "::1" if args.ipv6 else "127.0.0.1", tcp_direct_scan=args.direct_scan, udp_flow=args.udp_flow)
 if service_id:
     puts(f"Sucessfully created service {service_id} ✔", color=colors.green)
 else:
@@ -216,6 +218,92 @@ checkRegex(secret)
 
 clear_regexes()
 
+#Add regexes in bulk, the invalid one has to be reported without affecting the others
+results = firegex.nfregex_add_regexes(service_id, [secret, b"(unclosed", secret], "B", active=True, is_case_sensitive=True)
+if results[0] == "ok" and results[1] != "ok" and results[2] != "ok":
+    puts(f"Sucessfully added regexes in bulk with per-regex results {results} ✔", color=colors.green)
+else:
+    puts(f"Test Failed: Unexpected bulk add results {results} ✗", color=colors.red)
+    exit_test(1)
+
+checkRegex(secret)
+
+clear_regexes()
+
+#Export and import back the regexes of the service
+firegex.nfregex_add_regex(service_id,secret,"B",active=True,is_case_sensitive=True)
+exported = firegex.nfregex_export_regexes(service_id)
+clear_regexes()
+results = firegex.nfregex_import_regexes(service_id, exported)
+if len(exported) == 1 and results == ["ok"]:
+    puts("Sucessfully exported and imported the regexes ✔", color=colors.green)
+else:
+    puts(f"Test Failed: Unexpected import results {results} ✗", color=colors.red)
+    exit_test(1)
+
+checkRegex(secret)
+
+clear_regexes()
+
+def open_connection():
+    """Opens a connection exchanging some data, it's kept open while the service is resized"""
+    server.connect_client()
+    data = secrets.token_bytes(40)
+    server.send_packet(data)
+    if server.recv_packet() != data:
+        puts("Test Failed: Couldn't communicate before the resize ✗", color=colors.red)
+        exit_test(1)
+
+def checkRegexOnOpenConnection():
+    """The connection opened before the resize can be moved to another worker: its data has to be matched there"""
+    global n_blocked
+    server.send_packet(secrets.token_bytes(40) + secret + secrets.token_bytes(40))
+    blocked = not server.recv_packet()
+    server.close_client()
+    if blocked:
+        puts("The malicious request on the connection opened before the resize was blocked ✔", color=colors.green)
+        n_blocked += 1
+    else:
+        puts("Test Failed: The request on the connection opened before the resize wasn't blocked ✗", color=colors.red)
+        exit_test(1)
+
+#Resize the workers of the running service, the filtering has to continue without a restart
+firegex.nfregex_add_regex(service_id,secret,"B",active=True,is_case_sensitive=True)
+if args.proto == "tcp":
+    open_connection()
+if firegex.nfregex_resize_service(service_id, 4) and firegex.nfregex_get_service(service_id)["threads"] == 4:
+    puts("Sucessfully resized the service workers ✔", color=colors.green)
+else:
+    puts("Test Failed: Coulnd't resize the service workers ✗", color=colors.red)
+    exit_test(1)
+
+if args.proto == "tcp":
+    checkRegexOnOpenConnection()
+checkRegex(secret)
+
+if args.proto == "tcp":
+    open_connection()
+if not firegex.nfregex_resize_service(service_id, 1):
+    puts("Test Failed: Coulnd't shrink the service workers ✗", color=colors.red)
+    exit_test(1)
+
+if args.proto == "tcp":
+    checkRegexOnOpenConnection()
+checkRegex(secret)
+
+clear_regexes()
+
+#In UDP flow mode a regex split between the datagrams of the same flow has to be matched
+if args.udp_flow and args.proto == "udp":
+    firegex.nfregex_add_regex(service_id,secret,"B",active=True,is_case_sensitive=True)
+    half = len(secret)//2
+    if not server.sendCheckSplitData([secrets.token_bytes(40) + secret[:half], secret[half:] + secrets.token_bytes(40)]):
+        puts("The regex split between the datagrams of the flow was blocked ✔", color=colors.green)
+    else:
+        puts("Test Failed: The regex split between the datagrams of the flow wasn't blocked ✗", color=colors.red)
+        exit_test(1)
+    clear_regexes()
+
 #Rename service
 if(firegex.nfregex_rename_service(service_id,f"{args.service_name}2")):
     puts(f"Sucessfully renamed service to {args.service_name}2 ✔", color=colors.green)
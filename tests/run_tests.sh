@@ -19,10 +19,14 @@ echo "Running Netfilter Regex TCP ipv4"
 python3 nfregex_test.py -p $PASSWORD -m tcp || ERROR=1
 echo "Running Netfilter Regex TCP ipv6"
 python3 nfregex_test.py -p $PASSWORD -m tcp -6 || ERROR=1
+echo "Running Netfilter Regex TCP ipv4 with direct scan"
+python3 nfregex_test.py -p $PASSWORD -m tcp -D || ERROR=1
 echo "Running Netfilter Regex UDP ipv4"
 python3 nfregex_test.py -p $PASSWORD -m udp || ERROR=1
 echo "Running Netfilter Regex UDP ipv6"
 python3 nfregex_test.py -p $PASSWORD -m udp -6 || ERROR=1
+echo "Running Netfilter Regex UDP ipv4 with flow matching"
+python3 nfregex_test.py -p $PASSWORD -m udp -F || ERROR=1
 echo "Running Port Hijack TCP ipv4"
 python3 ph_test.py -p $PASSWORD -m tcp || ERROR=1
 echo "Running Port Hijack TCP ipv6"
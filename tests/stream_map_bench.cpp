@@ -0,0 +1,79 @@
+/*
+Micro-benchmark of the stream lookups of the filters: StreamMap (open addressing, classes/stream_map.cpp)
+against the std::map used before, with 10k/100k/1M concurrent streams.
+
+Build and run (needs the libtins headers, as the firegex binaries):
+$ g++ stream_map_bench.cpp -o stream_map_bench -std=c++23 -O3 $(pkg-config --cflags --libs libtins)
+$ ./stream_map_bench
+*/
+#include "../backend/binsrc/classes/stream_map.cpp"
+#include <chrono>
+#include <iostream>
+#include <iomanip>
+#include <map>
+#include <random>
+
+using namespace std;
+using Firegex::NfQueue::stream_id;
+using Firegex::NfQueue::StreamMap;
+
+const size_t LOOKUPS = 5000000;
+
+// Random IPv4 connections to a single service, as seen by a firegex worker
+vector<stream_id> make_streams(size_t n, mt19937_64& rng) {
+    vector<stream_id> streams(n);
+    for (auto& sid : streams) {
+        uint64_t rnd = rng();
+        sid.min_address.fill(0);
+        sid.max_address.fill(0);
+        sid.min_address[10] = sid.min_address[11] = sid.max_address[10] = sid.max_address[11] = 0xff;
+        sid.min_address[12] = 10;
+        sid.min_address[15] = 1;
+        sid.min_address_port = 8080;
+        sid.max_address[12] = 10;
+        memcpy(&sid.max_address[13], &rnd, 3);
+        sid.max_address_port = 1024 + (rnd >> 24) % 64000;
+    }
+    return streams;
+}
+
+struct stream_id_less {
+    bool operator()(const stream_id& a, const stream_id& b) const {
+        return a < b;
+    }
+};
+
+template <typename F>
+double ns_per_op(size_t ops, F&& func) {
+    auto start = chrono::steady_clock::now();
+    func();
+    auto elapsed = chrono::duration_cast<chrono::nanoseconds>(chrono::steady_clock::now() - start);
+    return double(elapsed.count()) / ops;
+}
+
+int main() {
+    mt19937_64 rng(42);
+    cout << setw(10) << "streams" << setw(20) << "std::map (ns)" << setw(20) << "StreamMap (ns)" << endl;
+    for (size_t n : {10000, 100000, 1000000}) {
+        auto streams = make_streams(n, rng);
+        vector<uint32_t> order(LOOKUPS);
+        for (auto& i : order) i = rng() % n;
+
+        map<stream_id, void*, stream_id_less> tree;
+        StreamMap<void*> table;
+        for (auto& sid : streams) {
+            tree.insert_or_assign(sid, (void*)&sid);
+            table.insert_or_assign(sid, (void*)&sid);
+        }
+
+        volatile uintptr_t sink = 0;
+        double tree_ns = ns_per_op(LOOKUPS, [&]() {
+            for (auto i : order) sink = sink + (uintptr_t)tree.find(streams[i])->second;
+        });
+        double table_ns = ns_per_op(LOOKUPS, [&]() {
+            for (auto i : order) sink = sink + (uintptr_t)*table.find(streams[i]);
+        });
+        cout << setw(10) << n << setw(20) << fixed << setprecision(1) << tree_ns << setw(20) << table_ns << endl;
+    }
+    return 0;
+}
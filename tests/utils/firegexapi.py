@@ -107,6 +107,10 @@ class FiregexAPI:
         req = self.s.put(f"{self.address}api/nfregex/services/{service_id}/settings" , json={"port":port, "proto":proto, "ip_int":ip_int, "fail_open":fail_open})
         return verify(req)
 
+    def nfregex_resize_service(self,service_id: str, threads: int):
+        req = self.s.put(f"{self.address}api/nfregex/services/{service_id}/settings" , json={"threads":threads})
+        return verify(req)
+
     def nfregex_get_service_regexes(self,service_id: str):
         req = self.s.get(f"{self.address}api/nfregex/services/{service_id}/regexes")
         data = req.json()
@@ -138,9 +142,22 @@ class FiregexAPI:
             json={"service_id": service_id, "regex": base64.b64encode(regex).decode(), "mode": mode, "active": active, "is_case_sensitive": is_case_sensitive})
         return verify(req)
 
-    def nfregex_add_service(self, name: str, port: int, proto: str, ip_int: str, fail_open: bool = False):
+    def nfregex_add_regexes(self, service_id: str, regexes: list, mode: str, active: bool, is_case_sensitive: bool):
+        regexes = [regex.encode() if isinstance(regex, str) else regex for regex in regexes]
+        return self.nfregex_import_regexes(service_id,
+            [{"regex": base64.b64encode(regex).decode(), "mode": mode, "active": active, "is_case_sensitive": is_case_sensitive} for regex in regexes])
+
+    def nfregex_export_regexes(self, service_id: str):
+        req = self.s.get(f"{self.address}api/nfregex/services/{service_id}/regexes/export")
+        return req.json()
+
+    def nfregex_import_regexes(self, service_id: str, regexes: list):
+        req = self.s.post(f"{self.address}api/nfregex/services/{service_id}/regexes/bulk", json=regexes)
+        return [ele["status"] for ele in req.json()]
+
+    def nfregex_add_service(self, name: str, port: int, proto: str, ip_int: str, fail_open: bool = False, tcp_direct_scan: bool = False, udp_flow: bool = False):
         req = self.s.post(f"{self.address}api/nfregex/services" , 
-            json={"name":name,"port":port, "proto": proto, "ip_int": ip_int, "fail_open": fail_open})
+            json={"name":name,"port":port, "proto": proto, "ip_int": ip_int, "fail_open": fail_open, "tcp_direct_scan": tcp_direct_scan, "udp_flow": udp_flow})
         return req.json()["service_id"] if verify(req) else False 
 
     def nfregex_get_metrics(self):
@@ -209,6 +226,14 @@ class FiregexAPI:
         req = self.s.put(f"{self.address}api/nfproxy/services/{service_id}/settings" , json={"port":port, "ip_int":ip_int, "fail_open":fail_open})
         return verify(req)
 
+    def nfproxy_resize_service(self,service_id: str, threads: int):
+        req = self.s.put(f"{self.address}api/nfproxy/services/{service_id}/settings" , json={"threads":threads})
+        return verify(req)
+
+    def nfproxy_gc_settings_service(self,service_id: str, **gc_settings):
+        req = self.s.put(f"{self.address}api/nfproxy/services/{service_id}/settings" , json=gc_settings)
+        return verify(req)
+
     def nfproxy_get_service_pyfilters(self,service_id: str):
         req = self.s.get(f"{self.address}api/nfproxy/services/{service_id}/pyfilters")
         return req.json()
@@ -236,4 +261,8 @@ class FiregexAPI:
     
     def nfproxy_set_code(self, service_id: str, code: str):
         req = self.s.put(f"{self.address}api/nfproxy/services/{service_id}/code", json={"code":code})
-        return verify(req)
\ No newline at end of file
+        return verify(req)
+
+    def nfproxy_get_metrics(self):
+        req = self.s.get(f"{self.address}api/nfproxy/metrics")
+        return req.text
\ No newline at end of file
@@ -24,6 +24,20 @@ class UdpServer:
     def stop(self):
         self.server.terminate()
 
+    def sendCheckSplitData(self,parts):
+        """Send the parts from the same socket (a single flow), True if every datagram is echoed back"""
+        s = socket.socket(socket.AF_INET6 if self.ipv6 else socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(2)
+        for data in parts:
+            s.sendto(data, ('::1' if self.ipv6 else '127.0.0.1', self.proxy_port if self.proxy_port else self.port))
+            try:
+                received_data = s.recvfrom(432)
+            except Exception:
+                return False
+            if received_data[0] != data:
+                return False
+        return True
+
     def sendCheckData(self,data):
         s = socket.socket(socket.AF_INET6 if self.ipv6 else socket.AF_INET, socket.SOCK_DGRAM)
         s.settimeout(2)